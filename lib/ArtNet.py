@@ -12,7 +12,12 @@ class ArtNet():
         # UDP ArtNet Port
         self.port = port
 
-    def broadcastDMX(self, dmxdata, address):
+        # the packets are constructed once for each address and size, only the data is copied in
+        self.packets = {}
+        # ArtSync, this tells the nodes to output the data that they have received
+        self.syncpacket = b'Art-Net\x00' + struct.pack('<H', 0x5200) + struct.pack('>H', 14) + b'\x00\x00'
+
+    def template(self, address, size):
         content = []
         # Name, 7byte + 0x00
         content.append(b'Art-Net\x00')
@@ -28,14 +33,26 @@ class ArtNet():
         net, subnet, universe = address
         content.append(struct.pack('<H', net << 8 | subnet << 4 | universe))
         # Length of DMX Data, High Byte First
-        content.append(struct.pack('>H', len(dmxdata)))
-        # append the actual DMX Data
-        for d in dmxdata:
-            content.append(struct.pack('B', d))
-        # stitch it together
-        content = b''.join(content)
+        content.append(struct.pack('>H', size))
+        # followed by the actual DMX Data
+        content.append(bytes(size))
+        return bytearray(b''.join(content))
+
+    def broadcastDMX(self, dmxdata, address):
+        # the data can be a list of integers, bytes or a uint8 NumPy array
+        key = (tuple(address), len(dmxdata))
+        if key not in self.packets:
+            packet = self.template(address, len(dmxdata))
+            self.packets[key] = (packet, memoryview(packet)[18:])
+        packet, data = self.packets[key]
+        if isinstance(dmxdata, list):
+            dmxdata = bytes(dmxdata)
+        data[:] = dmxdata
         # send
-        self.s.sendto(content, (self.ip, self.port))
+        self.s.sendto(packet, (self.ip, self.port))
+
+    def broadcastSync(self):
+        self.s.sendto(self.syncpacket, (self.ip, self.port))
 
     def close(self):
         self.s.close()
@@ -1,6 +1,4 @@
-from copy import deepcopy
 from math import ceil, floor
-from struct import pack, unpack
 import calendar
 import datetime
 import numpy as np
@@ -19,15 +17,31 @@ def padtrim(buf, num):
     # convert output from char to bytes
     return retval.encode()
 
+def int24_to_int32(buf):
+    # convert an array with 3 little-endian bytes along the last dimension into 32-bit integers
+    buf = buf.astype(np.int32)
+    val = buf[..., 0] | (buf[..., 1] << 8) | (buf[..., 2] << 16)
+    # shift the sign bit into place
+    return (val << 8) >> 8
+
+def int32_to_int24(val):
+    # convert 32-bit integers into an array with 3 little-endian bytes along the last dimension
+    buf = np.asarray(val, dtype='<i4').reshape(-1, 1).view(np.uint8)
+    return buf[:, 0:3]
+
 ####################################################################################################
 # the EDF header is represented as a tuple of (meas_info, chan_info)
 # meas_info should have ['record_length', 'magic', 'hour', 'subject_id', 'recording_id', 'n_records', 'month', 'subtype', 'second', 'nchan', 'data_size', 'data_offset', 'lowpass', 'year', 'highpass', 'day', 'minute']
 # chan_info should have ['physical_min', 'transducers', 'physical_max', 'digital_max', 'ch_names', 'n_samps', 'units', 'digital_min']
+#
+# the data is stored in records, each record contains n_samps[i] samples of each channel i, one
+# channel after the other; the samples are 16-bit integers for EDF and 24-bit integers for BDF
 ####################################################################################################
 
 class EDFWriter():
     def __init__(self, fname=None):
         self.fname = None
+        self.fid = None
         self.meas_info = None
         self.chan_info = None
         self.calibrate = None
@@ -37,30 +51,18 @@ class EDFWriter():
             self.open(fname)
 
     def open(self, fname):
-        with open(fname, 'wb') as fid:
-            assert(fid.tell() == 0)
+        # the file remains open while writing
+        self.fid = open(fname, 'wb')
+        assert(self.fid.tell() == 0)
         self.fname = fname
 
     def close(self):
         # it is still needed to update the number of records in the header
-        # this requires copying the whole file content
-        meas_info = self.meas_info
-        chan_info = self.chan_info
-        # update the n_records value in the file
-        tempname = self.fname + '.bak'
-        os.rename(self.fname, tempname)
-        with open(tempname, 'rb') as fid1:
-            assert(fid1.tell() == 0)
-            with open(self.fname, 'wb') as fid2:
-                assert(fid2.tell() == 0)
-                fid2.write(fid1.read(236))
-                fid1.read(8)                                    # skip this part
-                fid2.write(padtrim(str(self.n_records), 8))     # but write this instead
-                fid2.write(fid1.read(meas_info['data_offset'] - 236 - 8))
-                blocksize = np.sum(chan_info['n_samps']) * meas_info['data_size']
-                for block in range(self.n_records):
-                    fid2.write(fid1.read(blocksize))
-        os.remove(tempname)
+        if self.meas_info is not None:
+            self.fid.seek(236)
+            self.fid.write(padtrim(str(self.n_records), 8))
+        self.fid.close()
+        self.fid = None
         self.fname = None
         self.meas_info = None
         self.chan_info = None
@@ -76,65 +78,73 @@ class EDFWriter():
         chan_size = 256 * meas_info['nchan']
         # note that the file is opened in binary mode, but the initial header is largely text
         # the padtrim function also converts the text to bytes
-        with open(self.fname, 'wb') as fid:
-            assert(fid.tell() == 0)
-
-            # fill in the missing or incomplete information
-            if not 'subject_id' in meas_info:
-                meas_info['subject_id'] = ''
-            if not 'recording_id' in meas_info:
-                meas_info['recording_id'] = ''
-            if not 'subtype' in meas_info:
-                meas_info['subtype'] = 'edf'
-            nchan = meas_info['nchan']
-            if not 'ch_names' in chan_info or len(chan_info['ch_names'])<nchan:
-                chan_info['ch_names'] = [str(i) for i in range(nchan)]
-            if not 'transducers' in chan_info or len(chan_info['transducers'])<nchan:
-                chan_info['transducers'] = ['' for i in range(nchan)]
-            if not 'units' in chan_info or len(chan_info['units'])<nchan:
-                chan_info['units'] = ['' for i in range(nchan)]
-
-            if meas_info['subtype'] in ('24BIT', 'bdf'):
-                meas_info['data_size'] = 3  # 24-bit (3 byte) integers
-            else:
-                meas_info['data_size'] = 2  # 16-bit (2 byte) integers
-
+        fid = self.fid
+        fid.seek(0)
+        fid.truncate()
+
+        # fill in the missing or incomplete information
+        if not 'subject_id' in meas_info:
+            meas_info['subject_id'] = ''
+        if not 'recording_id' in meas_info:
+            meas_info['recording_id'] = ''
+        if not 'subtype' in meas_info:
+            meas_info['subtype'] = 'edf'
+        nchan = meas_info['nchan']
+        if not 'ch_names' in chan_info or len(chan_info['ch_names'])<nchan:
+            chan_info['ch_names'] = [str(i) for i in range(nchan)]
+        if not 'transducers' in chan_info or len(chan_info['transducers'])<nchan:
+            chan_info['transducers'] = ['' for i in range(nchan)]
+        if not 'units' in chan_info or len(chan_info['units'])<nchan:
+            chan_info['units'] = ['' for i in range(nchan)]
+
+        if meas_info['subtype'] in ('24BIT', 'bdf'):
+            meas_info['data_size'] = 3  # 24-bit (3 byte) integers
+        else:
+            meas_info['data_size'] = 2  # 16-bit (2 byte) integers
+
+        if meas_info['data_size'] == 3:
+            fid.write(b'\xffBIOSEMI')
+        else:
             fid.write(padtrim('0', 8))
-            fid.write(padtrim(meas_info['subject_id'], 80))
-            fid.write(padtrim(meas_info['recording_id'], 80))
-            fid.write(padtrim('{:0>2d}.{:0>2d}.{:0>2d}'.format(meas_info['day'], meas_info['month'], meas_info['year']), 8))
-            fid.write(padtrim('{:0>2d}.{:0>2d}.{:0>2d}'.format(meas_info['hour'], meas_info['minute'], meas_info['second']), 8))
-            fid.write(padtrim(str(meas_size + chan_size), 8))
+        fid.write(padtrim(meas_info['subject_id'], 80))
+        fid.write(padtrim(meas_info['recording_id'], 80))
+        fid.write(padtrim('{:0>2d}.{:0>2d}.{:0>2d}'.format(meas_info['day'], meas_info['month'], meas_info['year']), 8))
+        fid.write(padtrim('{:0>2d}.{:0>2d}.{:0>2d}'.format(meas_info['hour'], meas_info['minute'], meas_info['second']), 8))
+        fid.write(padtrim(str(meas_size + chan_size), 8))
+        if meas_info['data_size'] == 3:
+            fid.write(padtrim('24BIT', 44))
+        else:
             fid.write(' '.encode() * 44)
-            fid.write(padtrim(str(-1), 8))  # the final n_records should be inserted on byte 236
-            fid.write(padtrim(str(meas_info['record_length']), 8))
-            fid.write(padtrim(str(meas_info['nchan']), 4))
-
-            # ensure that these are all np arrays rather than lists
-            for key in ['physical_min', 'transducers', 'physical_max', 'digital_max', 'ch_names', 'n_samps', 'units', 'digital_min']:
-                chan_info[key] = np.asarray(chan_info[key])
-
-            for i in range(meas_info['nchan']):
-                fid.write(padtrim(    chan_info['ch_names'][i], 16))
-            for i in range(meas_info['nchan']):
-                fid.write(padtrim(    chan_info['transducers'][i], 80))
-            for i in range(meas_info['nchan']):
-                fid.write(padtrim(    chan_info['units'][i], 8))
-            for i in range(meas_info['nchan']):
-                fid.write(padtrim(str(chan_info['physical_min'][i]), 8))
-            for i in range(meas_info['nchan']):
-                fid.write(padtrim(str(chan_info['physical_max'][i]), 8))
-            for i in range(meas_info['nchan']):
-                fid.write(padtrim(str(chan_info['digital_min'][i]), 8))
-            for i in range(meas_info['nchan']):
-                fid.write(padtrim(str(chan_info['digital_max'][i]), 8))
-            for i in range(meas_info['nchan']):
-                fid.write(' '.encode() * 80) # prefiltering
-            for i in range(meas_info['nchan']):
-                fid.write(padtrim(str(chan_info['n_samps'][i]), 8))
-            for i in range(meas_info['nchan']):
-                fid.write(' '.encode() * 32) # reserved
-            meas_info['data_offset'] = fid.tell()
+        fid.write(padtrim(str(-1), 8))  # the final n_records should be inserted on byte 236
+        fid.write(padtrim(str(meas_info['record_length']), 8))
+        fid.write(padtrim(str(meas_info['nchan']), 4))
+
+        # ensure that these are all np arrays rather than lists
+        for key in ['physical_min', 'transducers', 'physical_max', 'digital_max', 'ch_names', 'n_samps', 'units', 'digital_min']:
+            chan_info[key] = np.asarray(chan_info[key])
+
+        for i in range(meas_info['nchan']):
+            fid.write(padtrim(    chan_info['ch_names'][i], 16))
+        for i in range(meas_info['nchan']):
+            fid.write(padtrim(    chan_info['transducers'][i], 80))
+        for i in range(meas_info['nchan']):
+            fid.write(padtrim(    chan_info['units'][i], 8))
+        for i in range(meas_info['nchan']):
+            fid.write(padtrim(str(chan_info['physical_min'][i]), 8))
+        for i in range(meas_info['nchan']):
+            fid.write(padtrim(str(chan_info['physical_max'][i]), 8))
+        for i in range(meas_info['nchan']):
+            fid.write(padtrim(str(chan_info['digital_min'][i]), 8))
+        for i in range(meas_info['nchan']):
+            fid.write(padtrim(str(chan_info['digital_max'][i]), 8))
+        for i in range(meas_info['nchan']):
+            fid.write(' '.encode() * 80) # prefiltering
+        for i in range(meas_info['nchan']):
+            fid.write(padtrim(str(chan_info['n_samps'][i]), 8))
+        for i in range(meas_info['nchan']):
+            fid.write(' '.encode() * 32) # reserved
+        meas_info['data_offset'] = fid.tell()
+        fid.flush()
 
         self.meas_info = meas_info
         self.chan_info = chan_info
@@ -146,39 +156,55 @@ class EDFWriter():
               self.calibrate[ch] = 1;
               self.offset[ch]    = 0;
 
+        # these are repeated for each sample in a record, so that a whole record can be scaled at once
+        n_samps = chan_info['n_samps'].astype(int)
+        self.record_calibrate = np.repeat(self.calibrate, n_samps)
+        self.record_offset    = np.repeat(self.offset, n_samps)
+        self.record_physical  = (np.repeat(chan_info['physical_min'].astype(float), n_samps), np.repeat(chan_info['physical_max'].astype(float), n_samps))
+        self.record_digital   = (np.repeat(chan_info['digital_min'].astype(float), n_samps), np.repeat(chan_info['digital_max'].astype(float), n_samps))
+
     def writeBlock(self, data):
+        # the data is a list with one array per channel, or a channels x samples array
         meas_info = self.meas_info
         chan_info = self.chan_info
-        with open(self.fname, 'ab') as fid:
-            assert(fid.tell() > 0)
-            for i in range(meas_info['nchan']):
-                raw = deepcopy(data[i])
-                raw = np.asarray(raw, dtype=np.float64)
-
-                assert(len(raw)==chan_info['n_samps'][i])
-                if min(raw)<chan_info['physical_min'][i]:
-                    warnings.warn('Value exceeds physical_min: ' + str(min(raw)) );
-                if max(raw)>chan_info['physical_max'][i]:
-                    warnings.warn('Value exceeds physical_max: '+ str(max(raw)));
-
-                raw -= self.offset[i]  # FIXME I am not sure about the order of calibrate and offset
-                raw /= self.calibrate[i]
-
-                raw = np.asarray(raw, dtype=np.int16)
-                buf = [pack('h', x) for x in raw]
-                for val in buf:
-                    fid.write(val)
-            self.n_records += 1
+        if isinstance(data, np.ndarray) and data.ndim == 2:
+            assert(data.shape[0] == meas_info['nchan'])
+            raw = np.asarray(data, dtype=np.float64).reshape(-1)
+        else:
+            assert(len(data) == meas_info['nchan'])
+            raw = np.concatenate([np.asarray(x, dtype=np.float64).reshape(-1) for x in data])
+        assert(len(raw)==np.sum(chan_info['n_samps']))
+
+        if np.any(raw<self.record_physical[0]):
+            warnings.warn('Value exceeds physical_min: ' + str(np.min(raw[raw<self.record_physical[0]])));
+        if np.any(raw>self.record_physical[1]):
+            warnings.warn('Value exceeds physical_max: ' + str(np.max(raw[raw>self.record_physical[1]])));
+
+        raw = (raw - self.record_offset) / self.record_calibrate  # FIXME I am not sure about the order of calibrate and offset
+        # values outside the digital range would otherwise wrap around
+        raw = np.clip(np.round(raw), self.record_digital[0], self.record_digital[1])
+
+        if meas_info['data_size'] == 3:
+            self.fid.write(int32_to_int24(raw.astype(np.int32)).tobytes())
+        else:
+            self.fid.write(raw.astype('<i2').tobytes())
+        self.fid.flush()
+        self.n_records += 1
 
 ####################################################################################################
 
 class EDFReader():
+    # the data records are available as a memory mapped array with the digital values, which has
+    # one row per record and the samples of all channels one after the other in the columns
+
     def __init__(self, fname=None):
         self.fname = None
         self.meas_info = None
         self.chan_info = None
         self.calibrate = None
         self.offset    = None
+        self.records   = None
+        self.chan_beg  = None
         if fname:
             self.open(fname)
 
@@ -187,6 +213,7 @@ class EDFReader():
             assert(fid.tell() == 0)
         self.fname = fname
         self.readHeader()
+        self.mapRecords()
         return self.meas_info, self.chan_info
 
     def close(self):
@@ -195,6 +222,30 @@ class EDFReader():
         self.chan_info = None
         self.calibrate = None
         self.offset    = None
+        self.records   = None
+        self.chan_beg  = None
+
+    def mapRecords(self):
+        meas_info = self.meas_info
+        chan_info = self.chan_info
+        # the first sample of each channel within a record
+        self.chan_beg = np.concatenate(([0], np.cumsum(chan_info['n_samps'])))
+        n_records = meas_info['n_records']
+        n_samples = int(self.chan_beg[-1])
+        if n_records == 0:
+            self.records = np.zeros((0, n_samples), dtype=np.int32)
+        elif meas_info['data_size'] == 3:
+            self.records = np.memmap(self.fname, dtype=np.uint8, mode='r', offset=meas_info['data_offset'], shape=(n_records, n_samples, 3))
+        else:
+            self.records = np.memmap(self.fname, dtype='<i2', mode='r', offset=meas_info['data_offset'], shape=(n_records, n_samples))
+
+    def readDigital(self, begrecord, endrecord, begsample, endsample):
+        # returns the digital values of a range of records and samples within the records
+        dat = self.records[begrecord:(endrecord+1), begsample:(endsample+1)]
+        if self.meas_info['data_size'] == 3:
+            return int24_to_int32(dat)
+        else:
+            return np.asarray(dat)
 
     def readHeader(self):
         # the following is copied over from MNE-Python and subsequently modified
@@ -204,7 +255,7 @@ class EDFReader():
         with open(self.fname, 'rb') as fid:
             assert(fid.tell() == 0)
 
-            meas_info['magic']        = fid.read(8).strip().decode()
+            meas_info['magic']        = fid.read(8).strip().decode('latin-1')  # this starts with 0xFF for BDF
             meas_info['subject_id']   = fid.read(80).strip().decode()  # subject id
             meas_info['recording_id'] = fid.read(80).strip().decode()  # recording id
 
@@ -306,33 +357,35 @@ class EDFReader():
 
     def readBlock(self, block):
         assert(block>=0)
-        meas_info = self.meas_info
-        chan_info = self.chan_info
+        raw = self.readDigital(block, block, 0, self.chan_beg[-1] - 1)[0].astype(np.float32)
         data = []
-        with open(self.fname, 'rb') as fid:
-            assert(fid.tell() == 0)
-            blocksize = np.sum(chan_info['n_samps']) * meas_info['data_size']
-            fid.seek(meas_info['data_offset'] + block * blocksize)
-            for i in range(meas_info['nchan']):
-                buf = fid.read(chan_info['n_samps'][i]*meas_info['data_size'])
-                raw = np.asarray(unpack('<{}h'.format(chan_info['n_samps'][i]), buf), dtype=np.float32)
-                raw *= self.calibrate[i]
-                raw += self.offset[i]  # FIXME I am not sure about the order of calibrate and offset
-                data.append(raw)
+        for i in range(self.meas_info['nchan']):
+            data.append(raw[self.chan_beg[i]:self.chan_beg[i+1]] * np.float32(self.calibrate[i]) + np.float32(self.offset[i]))  # FIXME I am not sure about the order of calibrate and offset
         return data
 
     def readSamples(self, channel, begsample, endsample):
-        meas_info = self.meas_info
-        chan_info = self.chan_info
-        n_samps = chan_info['n_samps'][channel]
+        n_samps = self.chan_info['n_samps'][channel]
+        begblock = int(floor((begsample) / n_samps))
+        endblock = int(floor((endsample) / n_samps))
+        # the records are read at once, and the channel is selected from each of them
+        raw = self.readDigital(begblock, endblock, self.chan_beg[channel], self.chan_beg[channel+1] - 1).reshape(-1)
+        begsample -= begblock*n_samps
+        endsample -= begblock*n_samps
+        raw = raw[begsample:(endsample+1)].astype(np.float32)
+        return raw * np.float32(self.calibrate[channel]) + np.float32(self.offset[channel])  # FIXME I am not sure about the order of calibrate and offset
+
+    def readChannels(self, begsample, endsample):
+        # returns a samples x channels array, this requires all channels to have the same number of samples per record
+        n_samps = self.chan_info['n_samps'][0]
+        assert(np.all(self.chan_info['n_samps'] == n_samps))
         begblock = int(floor((begsample) / n_samps))
         endblock = int(floor((endsample) / n_samps))
-        data = self.readBlock(begblock)[channel]
-        for block in range(begblock+1, endblock+1):
-            data = np.append(data, self.readBlock(block)[channel])
+        raw = self.readDigital(begblock, endblock, 0, self.chan_beg[-1] - 1)
+        raw = raw.reshape(-1, self.meas_info['nchan'], n_samps).transpose(0, 2, 1).reshape(-1, self.meas_info['nchan'])
         begsample -= begblock*n_samps
         endsample -= begblock*n_samps
-        return data[begsample:(endsample+1)]
+        raw = raw[begsample:(endsample+1), :].astype(np.float32)
+        return raw * self.calibrate.astype(np.float32) + self.offset.astype(np.float32)
 
 ####################################################################################################
 # the following are a number of helper functions to make the behaviour of this EDFReader
@@ -3,15 +3,23 @@ from __future__ import print_function
 import sys
 import time
 import threading
+import heapq
+import bisect
+import collections
 import math
 import numpy as np
-from scipy.signal import firwin, butter, bessel, lfilter, lfiltic, iirnotch
+from scipy.signal import firwin, butter, bessel, lfilter, lfiltic, iirnotch, sosfilt, sosfilt_zi, tf2sos
 import logging
 from logging import Formatter
 import colorama
 import termcolor
 from termcolor import colored
 
+if sys.version_info < (3,0):
+    import Queue as queue
+else:
+    import queue
+
 ###################################################################################################
 def formatkeyval(key, val):
     if sys.version_info < (3,0):
@@ -245,16 +253,88 @@ class patch():
       item=key1,key2    get the value of key1 and key2 from Redis
       item=key1,5       get the value of key1 from Redis
       item=0,key2       get the value of key2 from Redis
+
+    Optionally the values that are retrieved from Redis can be cached, which is
+    enabled with cache=1 in the [redis] section of the ini file. The cached value
+    of a key is invalidated when a message is published on it, as patch.setvalue
+    does, or when the Redis keyspace notifications report a change. The cached
+    values moreover expire after a number of seconds, which can be specified with
+    expire in the [redis] section. With expire=0 they only are invalidated.
+
+    Many items can be retrieved at once with a single round trip to Redis.
+      patch.getfloats('input', ['channel1', 'channel2'], default=0)
+
+    Many values can be written at once with a single round trip to Redis, optionally
+    only those that changed since they were last written by this module.
+      patch.setvalues({'key1': 1, 'key2': 2}, changed=True)
+
+    Values that are written with a duration are switched off again by the shared
+    scheduler, unless they have been written again in the mean time. The returned
+    event can also be passed to scheduler.cancel().
+      event = patch.setvalue('key', 1, duration=0.1)
+
+    patch.hits    - number of values that were taken from the cache
+    patch.misses  - number of values that were retrieved from Redis
+    patch.stop()  - stop listening for invalidation messages
     """
 
-    def __init__(self, c, r):
+    def __init__(self, c, r, cache=None, expire=None):
         self.config = c
         self.redis  = r
+        if cache == None:
+            cache = c.has_option('redis', 'cache') and c.getint('redis', 'cache')
+        if expire == None:
+            expire = c.getfloat('redis', 'expire') if c.has_option('redis', 'expire') else 1.0
+        self.cache   = bool(cache)
+        self.expire  = expire
+        self.items   = {}   # the parsed items from the ini file
+        self.values  = {}   # the cached values from Redis, with the time they were retrieved
+        self.changes = 0    # incremented on every invalidation
+        self.hits    = 0
+        self.misses  = 0
+        self.previous = {}  # the values that were last written
+        self.resets   = {}  # the pending switch off for the values that were written with a duration
+        self.listener = None
+        if self.cache:
+            self.keyspace()
+            self.listener = dispatcher(r, workers=1)
+            self.listener.subscribe('*', self._invalidate)
+            self.listener.start()
 
     ####################################################################
-    def getfloat(self, section, item, multiple=False, default=None):
+    def keyspace(self):
+        # the keyspace notifications of Redis are disabled by default, enable them for the string commands
+        try:
+            flags = self.redis.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+            if not 'K' in flags or not ('$' in flags or 'A' in flags):
+                self.redis.config_set('notify-keyspace-events', ''.join(sorted(set(flags + 'K$'))))
+        except Exception:
+            # rely on the published messages and on the expiration
+            pass
+
+    ####################################################################
+    def stop(self):
+        if self.listener != None:
+            self.listener.stop()
+            self.listener = None
+
+    ####################################################################
+    def _invalidate(self, msg):
+        key = msg['channel']
+        if isinstance(key, bytes):
+            key = key.decode()
+        if key.startswith('__keyspace@'):
+            key = key.split(':', 1)[1]
+        self.changes += 1
+        self.values.pop(key, None)
+
+    ####################################################################
+    def _getitems(self, section, item, multiple):
+        # get all items from the ini file as a list of strings, or None if absent
+        if self.cache and (section, item, multiple) in self.items:
+            return self.items[(section, item, multiple)]
+
         if self.config.has_option(section, item) and len(self.config.get(section, item))>0:
-            # get all items from the ini file, there might be one or multiple
             items = self.config.get(section, item)
 
             if multiple:
@@ -273,7 +353,131 @@ class patch():
             else:
                 # make a list with a single item
                 items = [items]
+        else:
+            items = None
+
+        if self.cache:
+            self.items[(section, item, multiple)] = items
+        return items
+
+    ####################################################################
+    def _getvalue(self, key):
+        # get the value of a key from Redis, or from the cache
+        if not self.cache:
+            return self.redis.get(key)
+
+        now = time.time()
+        try:
+            (val, timestamp) = self.values[key]
+            if self.expire <= 0 or (now - timestamp) < self.expire:
+                self.hits += 1
+                return val
+        except KeyError:
+            pass
+
+        self.misses += 1
+        changes = self.changes
+        val = self.redis.get(key)
+        if changes == self.changes:
+            # only keep it if it was not invalidated while being retrieved
+            self.values[key] = (val, now)
+        return val
+
+    ####################################################################
+    def _getvalues(self, keys):
+        # get the values of multiple keys from Redis with a single MGET, or from the cache
+        if not self.cache:
+            if len(keys):
+                return self.redis.mget(keys)
+            else:
+                return []
+
+        now = time.time()
+        val = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            try:
+                (val[i], timestamp) = self.values[key]
+                if self.expire <= 0 or (now - timestamp) < self.expire:
+                    self.hits += 1
+                    continue
+            except KeyError:
+                pass
+            missing.append(i)
+
+        if len(missing):
+            self.misses += len(missing)
+            changes = self.changes
+            retrieved = self.redis.mget([keys[i] for i in missing])
+            for i, v in zip(missing, retrieved):
+                val[i] = v
+            if changes == self.changes:
+                # only keep them if nothing was invalidated while being retrieved
+                for i, v in zip(missing, retrieved):
+                    self.values[keys[i]] = (v, now)
+        return val
+
+    ####################################################################
+    def getfloats(self, section, items, multiple=False, default=None):
+        # this is the same as getfloat for a list of items, but all values are retrieved
+        # from Redis in one round trip; if multiple is False, the section and the default
+        # can also be specified as a list with one element for each item
+        if isinstance(section, (list, tuple)):
+            sections = section
+        else:
+            sections = [section] * len(items)
+        if not multiple and isinstance(default, (list, tuple)):
+            defaults = default
+        else:
+            defaults = [default] * len(items)
+
+        val = [None] * len(items)
+        keys = []
+        index = []
+        for i, (section, item, default) in enumerate(zip(sections, items, defaults)):
+            parsed = self._getitems(section, item, multiple)
+            if parsed == None:
+                # the configuration file does not contain the item
+                if multiple and default == None:
+                    val[i] = []
+                elif multiple:
+                    val[i] = [float(x) for x in default]
+                elif default != None:
+                    val[i] = float(default)
+                continue
 
+            # set the default
+            if default != None:
+                val[i] = [float(default)] * len(parsed)
+            else:
+                val[i] = [default] * len(parsed)
+
+            for j, item in enumerate(parsed):
+                try:
+                    # if it resembles a value, use that
+                    val[i][j] = float(item)
+                except ValueError:
+                    # if it is a string, get the value from Redis
+                    keys.append(item)
+                    index.append((i, j))
+
+        for (i, j), v in zip(index, self._getvalues(keys)):
+            try:
+                val[i][j] = float(v)
+            except TypeError:
+                pass
+
+        if not multiple:
+            # return a single value for each item
+            val = [x[0] if isinstance(x, list) else x for x in val]
+        return val
+
+    ####################################################################
+    def getfloat(self, section, item, multiple=False, default=None):
+        # get all items from the ini file, there might be one or multiple
+        items = self._getitems(section, item, multiple)
+
+        if items != None:
             # set the default
             if default != None:
                 val = [float(default)] * len(items)
@@ -288,7 +492,7 @@ class patch():
                 except ValueError:
                     # if it is a string, get the value from Redis
                     try:
-                        val[i] = float(self.redis.get(item))
+                        val[i] = float(self._getvalue(item))
                     except TypeError:
                         pass
         else:
@@ -314,27 +518,10 @@ class patch():
 
     ####################################################################
     def getint(self, section, item, multiple=False, default=None):
-        if self.config.has_option(section, item) and len(self.config.get(section, item))>0:
-            # get all items from the ini file, there might be one or multiple
-            items = self.config.get(section, item)
-
-            if multiple:
-                # convert the items to a list
-                if items.find(",") > -1:
-                    separator = ","
-                elif items.find("-") > -1:
-                    separator = "-"
-                elif items.find("\t") > -1:
-                    separator = "\t"
-                else:
-                    separator = " "
-                items = squeeze(' ', items)        # remove excess whitespace
-                items = squeeze(separator, items)  # remove double separators
-                items = items.split(separator)     # split on the separator
-            else:
-                # make a list with a single item
-                items = [items]
+        # get all items from the ini file, there might be one or multiple
+        items = self._getitems(section, item, multiple)
 
+        if items != None:
             # set the default
             if default != None:
                 val = [int(default)] * len(items)
@@ -349,7 +536,7 @@ class patch():
                 except ValueError:
                     # if it is a string, get the value from Redis
                     try:
-                        val[i] = int(round(float(self.redis.get(item))))
+                        val[i] = int(round(float(self._getvalue(item))))
                     except TypeError:
                         pass
         else:
@@ -416,11 +603,682 @@ class patch():
 
     ####################################################################
     def setvalue(self, item, val, duration=0):
+        if self.cache:
+            self.changes += 1
+            self.values.pop(item, None)
+        # a pending switch off should not apply to the new value
+        self.resets.pop(item, None)
+        self.previous[item] = val
         self.redis.set(item, val)      # set it as control channel
         self.redis.publish(item, val)  # send it as trigger
         if duration > 0:
             # switch off after a certain amount of time
-            threading.Timer(duration, self.setvalue, args=[item, 0.]).start()
+            return self._schedulereset([item], duration)
+
+    ####################################################################
+    def setvalues(self, values, duration=0, changed=False):
+        # set multiple values as control channel and send them as trigger, using a single pipeline
+        if changed:
+            # skip the values that are identical to what was last written
+            values = dict([(item, val) for item, val in values.items() if item not in self.previous or self.previous[item] != val])
+        if len(values) == 0:
+            return
+        if self.cache:
+            self.changes += 1
+            for item in values:
+                self.values.pop(item, None)
+        for item in values:
+            self.resets.pop(item, None)
+        self.previous.update(values)
+        pipe = self.redis.pipeline(transaction=False)
+        for item, val in values.items():
+            pipe.set(item, val)      # set it as control channel
+            pipe.publish(item, val)  # send it as trigger
+        pipe.execute()
+        if duration > 0:
+            # switch off after a certain amount of time
+            return self._schedulereset(list(values.keys()), duration)
+
+    ####################################################################
+    def _schedulereset(self, items, duration):
+        # the token identifies the most recent write of each item
+        token = object()
+        for item in items:
+            self.resets[item] = token
+        return getscheduler().enter(duration, self._reset, args=[items, token])
+
+    ####################################################################
+    def _reset(self, items, token):
+        # only switch off the values that have not been written again in the mean time
+        items = [item for item in items if self.resets.get(item) is token]
+        if len(items):
+            self.setvalues(dict([(item, 0.) for item in items]))
+
+
+###################################################################################################
+class dispatcher():
+    """Class to receive the Redis messages for many trigger channels with a single pubsub
+    connection and a single listening thread. The messages are passed on to a small pool of
+    worker threads that call the callback functions. All messages on the same channel are
+    handled by the same worker, hence in the order in which they were published.
+
+    dispatcher.subscribe(channel, callback, args) - call callback(item, *args) for each message
+    dispatcher.start()                            - start listening, after all subscriptions are made
+    dispatcher.stop()                             - stop listening and wait for the threads to finish
+
+    The channel can also be a pattern like "launchcontrol.note*", which is subscribed to using
+    psubscribe. The item that is passed to the callback is the message as returned by Redis.
+    """
+
+    def __init__(self, r, workers=4, timeout=0.1):
+        self.redis = r
+        self.workers = int(workers)
+        self.timeout = timeout
+        self.callbacks = {}
+        self.pubsub = None
+        self.threads = []
+        self.queues = []
+        self.running = False
+
+    def subscribe(self, channel, callback, args=()):
+        if self.running:
+            raise RuntimeError('cannot subscribe while the dispatcher is running')
+        self.callbacks.setdefault(channel, []).append((callback, tuple(args)))
+
+    def start(self):
+        channels = [channel for channel in self.callbacks if not any(c in channel for c in '*?[')]
+        patterns = [channel for channel in self.callbacks if channel not in channels]
+        self.running = True
+        self.queues = [queue.Queue() for i in range(self.workers)]
+        self.threads = [threading.Thread(target=self._work, args=(q,)) for q in self.queues]
+        if len(self.callbacks):
+            self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            if len(channels):
+                self.pubsub.subscribe(*channels)
+            if len(patterns):
+                self.pubsub.psubscribe(*patterns)
+            self.threads.append(threading.Thread(target=self._listen))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        # the listening thread checks regularly whether it should stop, there is no need to unblock it
+        self.running = False
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        if self.pubsub is not None:
+            self.pubsub.close()
+            self.pubsub = None
+
+    def _listen(self):
+        while self.running:
+            item = self.pubsub.get_message(timeout=self.timeout)
+            if item is None:
+                continue
+            if item['type'] == 'pmessage':
+                channel = item['pattern']
+            elif item['type'] == 'message':
+                channel = item['channel']
+            else:
+                continue
+            # all messages on a channel go to the same worker to keep them in order
+            q = self.queues[hash(channel) % self.workers]
+            for callback, args in self.callbacks.get(channel, []):
+                q.put((callback, item, args))
+
+    def _work(self, q):
+        while True:
+            job = q.get()
+            if job is None:
+                break
+            callback, item, args = job
+            try:
+                callback(item, *args)
+            except Exception:
+                logging.getLogger(__name__).exception('error while processing %s' % item['channel'])
+
+
+###################################################################################################
+class scheduler():
+    """Class to call functions at a later moment from a single thread, rather than starting
+    a threading.Timer for each of them. The pending events are kept in a heap that is sorted
+    on their deadline, the deadlines are expressed in the time of scheduler.clock().
+
+    scheduler.enter(delay, function, args)       - call function(*args) after a delay in seconds
+    scheduler.enterabs(deadline, function, args) - call function(*args) at the deadline
+    scheduler.cancel(event)                      - cancel an event that has not been called yet
+    scheduler.stop()                             - stop the thread, pending events are discarded
+
+    The thread is started when the first event is scheduled. Events with the same deadline
+    are called in the order in which they were scheduled. A single scheduler is shared by
+    all parts of a module, it is returned by EEGsynth.getscheduler().
+    """
+
+    def __init__(self):
+        if sys.version_info < (3,3):
+            self.clock = time.time
+        else:
+            self.clock = time.monotonic
+        self.condition = threading.Condition()
+        self.events = []
+        self.counter = 0
+        self.thread = None
+        self.running = False
+
+    def enter(self, delay, function, args=()):
+        return self.enterabs(self.clock() + delay, function, args)
+
+    def enterabs(self, deadline, function, args=()):
+        with self.condition:
+            if not self.running:
+                self.running = True
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            # the counter ensures that events with the same deadline remain in order
+            self.counter += 1
+            event = [deadline, self.counter, function, tuple(args)]
+            heapq.heappush(self.events, event)
+            if self.events[0] is event:
+                # the thread needs to wake up earlier
+                self.condition.notify()
+        return event
+
+    def cancel(self, event):
+        # the event remains in the heap but will be skipped
+        event[2] = None
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.events = []
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    if len(self.events) == 0:
+                        self.condition.wait()
+                    elif self.events[0][0] > self.clock():
+                        self.condition.wait(self.events[0][0] - self.clock())
+                    else:
+                        break
+                if not self.running:
+                    break
+                (deadline, counter, function, args) = heapq.heappop(self.events)
+            if function is None:
+                continue
+            try:
+                function(*args)
+            except Exception:
+                logging.getLogger(__name__).exception('error while calling %s' % function)
+
+
+####################################################################
+_scheduler = None
+_schedulerlock = threading.Lock()
+
+def getscheduler():
+    # returns the scheduler that is shared by all parts of the module
+    global _scheduler
+    with _schedulerlock:
+        if _scheduler is None:
+            _scheduler = scheduler()
+        return _scheduler
+
+
+###################################################################################################
+class ringbuffer():
+    """Class to keep the most recent samples of a multichannel signal in a preallocated
+    buffer. Every sample is stored twice, which allows the content of the buffer to be
+    returned in chronological order as a contiguous view without copying.
+
+    ringbuffer.append(dat)  - add a block of data, samples x channels
+    ringbuffer.get()        - returns the most recent samples, oldest sample first
+    ringbuffer.clear()      - remove all samples
+
+    ringbuffer.length       - the maximal number of samples
+    ringbuffer.count        - the number of samples that are currently in the buffer
+    """
+
+    def __init__(self, length, nchans=1, dtype=np.double):
+        self.length = int(length)
+        self.nchans = int(nchans)
+        self.buffer = np.zeros((2 * self.length, self.nchans), dtype=dtype)
+        self.clear()
+
+    def clear(self):
+        self.pointer = 0
+        self.count = 0
+
+    def append(self, dat):
+        dat = np.asarray(dat)
+        if dat.ndim == 1:
+            dat = dat.reshape(-1, self.nchans)
+        nsamples = dat.shape[0]
+        if nsamples >= self.length:
+            # only the most recent samples fit in the buffer
+            dat = dat[-self.length:]
+            nsamples = self.length
+        first = min(nsamples, self.length - self.pointer)
+        # write the first part at the current position and its copy one length further
+        self.buffer[self.pointer:self.pointer + first] = dat[:first]
+        self.buffer[self.pointer + self.length:self.pointer + self.length + first] = dat[:first]
+        if first < nsamples:
+            # the remainder wraps around to the start
+            self.buffer[:nsamples - first] = dat[first:]
+            self.buffer[self.length:self.length + nsamples - first] = dat[first:]
+        self.pointer = (self.pointer + nsamples) % self.length
+        self.count = min(self.count + nsamples, self.length)
+
+    def get(self):
+        return self.buffer[self.pointer + self.length - self.count:self.pointer + self.length]
+
+
+###################################################################################################
+class sosfilter():
+    """Class to filter a multichannel signal that arrives in consecutive blocks. The filter
+    is specified as second-order sections, which remain numerically stable for high orders
+    and low cutoff frequencies. The filter state is carried over from one block to the next,
+    so that the filtered blocks join without edge effects.
+
+    sosfilter.filter(dat)   - filter a block of data, samples x channels
+    sosfilter.reset()       - start again, the state is initialized on the next block
+
+    The sections of multiple filters can be combined with np.vstack, an empty list of
+    sections results in no filtering at all. See also EEGsynth.butter_sos().
+    """
+
+    def __init__(self, sos, nchans=1):
+        self.sos = np.asarray(sos, dtype=np.double).reshape(-1, 6)
+        self.nchans = int(nchans)
+        self.reset()
+
+    def reset(self):
+        self.zi = None
+
+    def filter(self, dat):
+        dat = np.asarray(dat, dtype=np.double)
+        if dat.ndim == 1:
+            dat = dat.reshape(-1, self.nchans)
+        if self.sos.shape[0] == 0 or dat.shape[0] == 0:
+            return dat
+        if self.zi is None:
+            # start in the steady state for the first sample, this prevents a large transient
+            self.zi = sosfilt_zi(self.sos)[:, :, np.newaxis] * dat[0]
+        dat, self.zi = sosfilt(self.sos, dat, axis=0, zi=self.zi)
+        return dat
+
+
+###################################################################################################
+class channelreducer():
+    """Class to compute measures over a sliding window of a multichannel signal, for all
+    channels at once. The data can be passed in blocks that only contain the new samples,
+    in which case the sums over the window are updated incrementally. A block that is at
+    least as long as the window replaces the complete window.
+
+    channelreducer.append(dat)     - add a block of data, samples x channels
+    channelreducer.rms()           - returns the root-mean-square over the window
+    channelreducer.meanabs()       - returns the mean absolute value over the window
+    channelreducer.peak()          - returns the maximal absolute value over the window
+    channelreducer.crossings(threshold, refractory)
+                                   - returns the channels whose maximum in the last block exceeds the
+                                     threshold, and the maximum, without triggering again within the
+                                     refractory interval that is expressed in samples
+    channelreducer.clear()         - remove all samples
+
+    channelreducer.count           - the number of samples that are currently in the window
+    channelreducer.nsamples        - the total number of samples that has been added
+    """
+
+    def __init__(self, length, nchans=1):
+        self.length = int(length)
+        self.nchans = int(nchans)
+        self.buffer = ringbuffer(self.length, self.nchans)
+        self.clear()
+
+    def clear(self):
+        self.buffer.clear()
+        self.count = 0
+        self.nsamples = 0
+        self.block = np.zeros((0, self.nchans))
+        self.sumsq = np.zeros(self.nchans)
+        self.sumabs = np.zeros(self.nchans)
+        self.updates = 0
+        self.previous = np.full(self.nchans, -np.inf)
+
+    def append(self, dat):
+        dat = np.asarray(dat, dtype=np.double)
+        if dat.ndim == 1:
+            dat = dat.reshape(-1, self.nchans)
+        nsamples = dat.shape[0]
+        ndrop = max(self.buffer.count + nsamples - self.length, 0)
+        self.updates += nsamples
+        if nsamples >= self.length or self.updates >= self.length:
+            # compute the sums over the complete window, this also prevents the accumulation of rounding errors
+            self.buffer.append(dat)
+            window = self.buffer.get()
+            self.sumsq = np.sum(window * window, axis=0)
+            self.sumabs = np.sum(np.abs(window), axis=0)
+            self.updates = 0
+        else:
+            # only the samples that enter and leave the window need to be considered
+            if ndrop:
+                old = self.buffer.get()[:ndrop]
+                self.sumsq -= np.sum(old * old, axis=0)
+                self.sumabs -= np.sum(np.abs(old), axis=0)
+            self.buffer.append(dat)
+            self.sumsq += np.sum(dat * dat, axis=0)
+            self.sumabs += np.sum(np.abs(dat), axis=0)
+        self.block = dat
+        self.count = self.buffer.count
+        self.nsamples += nsamples
+
+    def rms(self):
+        # the sum can become slightly negative due to rounding errors
+        return np.sqrt(np.maximum(self.sumsq, 0) / max(self.count, 1))
+
+    def meanabs(self):
+        return np.maximum(self.sumabs, 0) / max(self.count, 1)
+
+    def peak(self):
+        if self.count == 0:
+            return np.zeros(self.nchans)
+        return np.max(np.abs(self.buffer.get()), axis=0)
+
+    def crossings(self, threshold, refractory=0):
+        if self.block.shape[0] == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        channel = np.arange(self.nchans)
+        maxind = np.argmax(self.block, axis=0)
+        maxval = self.block[maxind, channel]
+        sample = self.nsamples - self.block.shape[0] + maxind
+        hit = (maxval >= threshold) & ((sample - self.previous) >= refractory)
+        self.previous[hit] = sample[hit]
+        return channel[hit], maxval[hit]
+
+
+###################################################################################################
+class channelmap():
+    """Class to map control values onto the channels of one or multiple DMX universes. The
+    channels are specified as channel001, channel002, etc. and are numbered continuously over
+    the universes, i.e. channel513 is the first channel of the second universe. The mapping
+    is compiled once, the channels that are not specified are skipped. The values, scales and
+    offsets of all channels are retrieved in a single round trip, and are applied together
+    with the limits to all channels at once.
+
+    channelmap.update()     - get the values from Redis and update the frame, returns the
+                              channels that changed
+    channelmap.universe(i)  - returns the frame of universe i as a view
+
+    channelmap.frame        - the uint8 values of all universes
+    channelmap.size         - the number of channels, after the last one that is specified
+    """
+
+    def __init__(self, patch, section='input', nuniverses=1, universesize=512, scale=255, offset=0, lo=0, hi=255):
+        self.patch = patch
+        self.universesize = int(universesize)
+        self.lo = lo
+        self.hi = hi
+        channels = []
+        for item, val in patch.config.items(section):
+            if item.startswith('channel') and item[7:].isdigit() and 0 < int(item[7:]) <= nuniverses * self.universesize:
+                channels.append(item)
+        self.channels = sorted(channels, key=lambda item: int(item[7:]))
+        self.index = np.array([int(item[7:]) - 1 for item in self.channels], dtype=int)
+        self.size = int(self.index.max()) + 1 if len(self.index) else 0
+        self.frame = np.zeros(nuniverses * self.universesize, dtype=np.uint8)
+        n = len(self.channels)
+        self.sections = [section] * n + ['scale'] * n + ['offset'] * n
+        self.items = self.channels * 3
+        self.defaults = [None] * n + [scale] * n + [offset] * n
+
+    def update(self):
+        n = len(self.channels)
+        if n == 0:
+            return np.zeros(0, dtype=int)
+        # the values that are not present are returned as None, which becomes NaN
+        val = np.array(self.patch.getfloats(self.sections, self.items, default=self.defaults), dtype=np.double)
+        val = val[0:n] * val[n:2*n] + val[2*n:3*n]
+        present = ~np.isnan(val)
+        index = self.index[present]
+        val = np.clip(val[present], self.lo, self.hi).astype(np.uint8)
+        changed = self.frame[index] != val
+        self.frame[index[changed]] = val[changed]
+        return index[changed]
+
+    def universe(self, i):
+        return self.frame[i * self.universesize:(i + 1) * self.universesize]
+
+
+###################################################################################################
+class sortedlist():
+    """Class to keep a large number of values in sorted order, while values are inserted and
+    removed. The values are stored in a list of sorted sublists, which makes inserting and
+    removing a value much faster than in a single sorted list.
+
+    sortedlist.insert(val)      - insert a value
+    sortedlist.remove(val)      - remove a value, it must be present
+    sortedlist.bisect_left(val) - returns the number of values smaller than val
+    sortedlist[k]               - returns the k-th smallest value
+    """
+
+    def __init__(self, load=512):
+        self.load = load
+        self.lists = []
+        self.maxes = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, val):
+        if self.count == 0:
+            self.lists = [[val]]
+            self.maxes = [val]
+        else:
+            i = bisect.bisect_left(self.maxes, val)
+            if i == len(self.maxes):
+                # it is larger than all values, append it to the last sublist
+                i -= 1
+                self.lists[i].append(val)
+                self.maxes[i] = val
+            else:
+                bisect.insort(self.lists[i], val)
+            if len(self.lists[i]) > 2 * self.load:
+                # split the sublist in two halves
+                half = self.lists[i][self.load:]
+                del self.lists[i][self.load:]
+                self.maxes[i] = self.lists[i][-1]
+                self.lists.insert(i + 1, half)
+                self.maxes.insert(i + 1, half[-1])
+        self.count += 1
+
+    def remove(self, val):
+        i = bisect.bisect_left(self.maxes, val)
+        j = bisect.bisect_left(self.lists[i], val)
+        del self.lists[i][j]
+        if len(self.lists[i]) == 0:
+            del self.lists[i]
+            del self.maxes[i]
+        else:
+            self.maxes[i] = self.lists[i][-1]
+        self.count -= 1
+
+    def bisect_left(self, val):
+        # returns the number of values that are smaller than val
+        i = bisect.bisect_left(self.maxes, val)
+        if i == len(self.maxes):
+            return self.count
+        return sum([len(x) for x in self.lists[0:i]]) + bisect.bisect_left(self.lists[i], val)
+
+    def __getitem__(self, k):
+        if k < 0:
+            k += self.count
+        for sublist in self.lists:
+            if k < len(sublist):
+                return sublist[k]
+            k -= len(sublist)
+        raise IndexError('index out of range')
+
+
+###################################################################################################
+class runningstatistics():
+    """Class to compute statistics over the most recent values of a signal. The statistics are
+    updated incrementally when values are added to and removed from the window, rather than being
+    recomputed over the whole window. Values that are NaN are ignored, like np.nanmean etc.
+
+    runningstatistics.append(dat)     - add one or multiple values, the oldest values drop out
+    runningstatistics.get()           - returns the values in the window, oldest first
+    runningstatistics.mean()
+    runningstatistics.std()
+    runningstatistics.min()
+    runningstatistics.max()
+    runningstatistics.median()        - only if the order statistics are kept
+    runningstatistics.percentile(p)   - only if the order statistics are kept, p is between 0 and 100
+    runningstatistics.mad()           - only if the order statistics are kept, median absolute deviation
+
+    The mean, standard deviation, minimum and maximum are updated in constant time. The order
+    statistics, which are needed for the median, percentiles and MAD, are kept in a sortedlist.
+    """
+
+    def __init__(self, length, order=True):
+        self.length = int(length)
+        self.order = order
+        self.buffer = ringbuffer(self.length)
+        self.sorted = sortedlist()
+        self.maxima = collections.deque()  # decreasing values, with their sequence number
+        self.minima = collections.deque()  # increasing values, with their sequence number
+        self.sequence = 0
+        self.updates = 0
+        self.count = 0
+        self.sum = 0.
+        self.sumsq = 0.
+
+    def append(self, dat):
+        dat = np.asarray(dat, dtype=np.double).reshape(-1)
+        if len(dat) > self.length:
+            # only the most recent values fit in the window
+            self.sequence += len(dat) - self.length
+            dat = dat[-self.length:]
+        nold = max(self.buffer.count + len(dat) - self.length, 0)
+        old = self.buffer.get()[0:nold, 0]
+        old = old[~np.isnan(old)]
+        new = dat[~np.isnan(dat)]
+
+        self.count += len(new) - len(old)
+        self.sum += np.sum(new) - np.sum(old)
+        self.sumsq += np.sum(new * new) - np.sum(old * old)
+        if self.order:
+            for val in old.tolist():
+                self.sorted.remove(val)
+            for val in new.tolist():
+                self.sorted.insert(val)
+
+        for val in dat.tolist():
+            self.sequence += 1
+            if val != val:
+                # skip NaN
+                continue
+            while len(self.maxima) and self.maxima[-1][0] <= val:
+                self.maxima.pop()
+            self.maxima.append((val, self.sequence))
+            while len(self.minima) and self.minima[-1][0] >= val:
+                self.minima.pop()
+            self.minima.append((val, self.sequence))
+        # remove the extremes that dropped out of the window
+        while len(self.maxima) and self.maxima[0][1] <= self.sequence - self.length:
+            self.maxima.popleft()
+        while len(self.minima) and self.minima[0][1] <= self.sequence - self.length:
+            self.minima.popleft()
+
+        self.buffer.append(dat)
+        self.updates += len(dat)
+        if self.updates >= self.length:
+            # prevent the accumulation of rounding errors
+            window = self.buffer.get()[:, 0]
+            window = window[~np.isnan(window)]
+            self.sum = np.sum(window)
+            self.sumsq = np.sum(window * window)
+            self.updates = 0
+
+    def get(self):
+        return self.buffer.get()[:, 0]
+
+    def mean(self):
+        if self.count == 0:
+            return np.nan
+        return float(self.sum) / self.count
+
+    def std(self):
+        if self.count == 0:
+            return np.nan
+        return math.sqrt(max(self.sumsq / self.count - (self.sum / self.count) ** 2, 0.))
+
+    def min(self):
+        if len(self.minima) == 0:
+            return np.nan
+        return self.minima[0][0]
+
+    def max(self):
+        if len(self.maxima) == 0:
+            return np.nan
+        return self.maxima[0][0]
+
+    def percentile(self, p):
+        # this uses linear interpolation, like np.percentile
+        if self.count == 0:
+            return np.nan
+        h = (self.count - 1) * p / 100.
+        k = int(math.floor(h))
+        if k + 1 < self.count:
+            return self.sorted[k] + (h - k) * (self.sorted[k + 1] - self.sorted[k])
+        else:
+            return self.sorted[k]
+
+    def median(self):
+        return self.percentile(50)
+
+    def mad(self):
+        if self.count == 0:
+            return np.nan
+        # the absolute deviations below and above the median form two sorted sequences
+        m = self.median()
+        n = self.count
+        p = self.sorted.bisect_left(m)
+        below = lambda i: m - self.sorted[p - 1 - i]
+        above = lambda j: self.sorted[p + j] - m
+        if n % 2:
+            return self._kth(below, p, above, n - p, n // 2)
+        else:
+            return (self._kth(below, p, above, n - p, n // 2 - 1) + self._kth(below, p, above, n - p, n // 2)) / 2
+
+    def _kth(self, a, na, b, nb, k):
+        # returns the k-th smallest value of the union of two sorted sequences
+        lo, hi = max(0, k + 1 - nb), min(k + 1, na)
+        while lo < hi:
+            # take i values from a and k+1-i values from b
+            i = (lo + hi) // 2
+            if a(i) < b(k - i):
+                lo = i + 1
+            else:
+                hi = i
+        i = lo
+        j = k + 1 - i
+        if i == 0:
+            return b(j - 1)
+        elif j == 0:
+            return a(i - 1)
+        else:
+            return max(a(i - 1), b(j - 1))
 
 
 ####################################################################
@@ -514,6 +1372,22 @@ def squeeze(char, string):
         string = string.replace(char*2, char)
     return string
 
+####################################################################
+def bandpower_weights(frequency, bandlo, bandhi):
+    '''
+    Returns a frequencies x bands weight matrix that averages the power over all
+    frequency bins that fall within each band. The power in each band is then
+    computed for all channels at once as np.abs(F)**2 @ weights. Bands without
+    any frequency bins, or with an unknown lower or upper limit, get zero power.
+    '''
+    frequency = np.asarray(frequency, dtype=np.double)[:, np.newaxis]
+    bandlo = np.asarray(bandlo, dtype=np.double)[np.newaxis, :]
+    bandhi = np.asarray(bandhi, dtype=np.double)[np.newaxis, :]
+    with np.errstate(invalid='ignore'):
+        inside = np.logical_and(frequency >= bandlo, frequency <= bandhi)
+    count = np.sum(inside, axis=0)
+    return inside / np.maximum(count, 1).astype(np.double)
+
 ####################################################################
 def initialize_online_notchfilter(fsample, fnotch, quality, x, axis=-1):
     nyquist = fsample / 2.
@@ -653,6 +1527,25 @@ def notch(f0, fs, Q=30):
     b, a = iirnotch(w0, Q)
     return b, a
 
+####################################################################
+def butter_sos(fs, highpass=None, lowpass=None, order=9, fnotch=None, Q=30):
+    '''
+    Returns the second-order sections of a Butterworth filter, optionally combined
+    with a notch filter. Frequencies that are None or NaN are not used.
+    '''
+    valid = lambda f: f is not None and not np.isnan(f)
+    nyq = 0.5 * fs
+    sos = np.zeros((0, 6))
+    if valid(highpass) and valid(lowpass):
+        sos = butter(order, [highpass / nyq, lowpass / nyq], btype='band', output='sos')
+    elif valid(lowpass):
+        sos = butter(order, lowpass / nyq, btype='lowpass', output='sos')
+    elif valid(highpass):
+        sos = butter(order, highpass / nyq, btype='highpass', output='sos')
+    if valid(fnotch):
+        sos = np.vstack((sos, tf2sos(*notch(fnotch, fs, Q=Q))))
+    return sos
+
 ####################################################################
 def butter_bandpass_filter(dat, lowcut, highcut, fs, order=9):
     '''
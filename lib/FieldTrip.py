@@ -9,6 +9,12 @@ import socket
 import struct
 import numpy
 import unicodedata
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 VERSION = 1
 
@@ -89,11 +95,11 @@ def serialize(A):
 
         if A.flags['C_CONTIGUOUS']:
             # great, just use the array's buffer interface
-            return (ft, A.tostring())
+            return (ft, A.tobytes())
 
         # otherwise, we need a copy to C order
         AC = A.copy('C')
-        return (ft, AC.tostring())
+        return (ft, AC.tobytes())
 
     if isinstance(A, int):
         return (DATATYPE_INT32, struct.pack('i', A))
@@ -219,6 +225,13 @@ class Client:
     def __init__(self):
         self.isConnected = False
         self.sock = []
+        # the first sample of the next block that will be returned by readNext
+        self.nextSample = None
+        # the number of samples in the buffer when readNext last waited for data
+        self.availableSamples = None
+        # preallocated buffers for receiving, these are reused for every response
+        self.rxhdr = bytearray(24)
+        self.rxbuf = bytearray(4096)
 
     def connect(self, hostname, port=1972):
         """
@@ -229,6 +242,7 @@ class Client:
         self.sock.connect((hostname, port))
         self.sock.setblocking(True)
         self.isConnected = True
+        self.nextSample = None
 
     def disconnect(self):
         """disconnect() -- close a connection."""
@@ -247,6 +261,27 @@ class Client:
         while nw < N:
             nw += self.sock.send(request[nw:])
 
+    def sendParts(self, parts):
+        """Send all bytes of the buffers in the list 'parts' out to socket,
+        using scatter-gather I/O where possible to avoid concatenating them."""
+        if not(self.isConnected):
+            raise IOError('Not connected to FieldTrip buffer')
+
+        views = [memoryview(x).cast('B') for x in parts]
+        if not hasattr(self.sock, 'sendmsg'):
+            # not all platforms support scatter-gather I/O
+            for view in views:
+                self.sock.sendall(view)
+            return
+
+        while views:
+            nw = self.sock.sendmsg(views)
+            # drop the buffers that have been sent completely
+            while views and nw >= len(views[0]):
+                nw -= len(views.pop(0))
+            if nw:
+                views[0] = views[0][nw:]
+
     def sendRequest(self, command, payload=None):
         if payload is None:
             request = struct.pack('HHI', VERSION, command, 0)
@@ -255,15 +290,42 @@ class Client:
                 'HHI', VERSION, command, len(payload)) + payload
         self.sendRaw(request)
 
-    def receiveResponse(self, minBytes=0):
+    def receiveRaw(self, buf):
         """
-        Receive response from server on socket 's' and return it as
-        (status,bufsize,payload).
+        Receive exactly as many bytes from the socket as fit in the writable
+        buffer 'buf', which can be a bytearray, memoryview or Numpy array.
+        """
+        if isinstance(buf, numpy.ndarray):
+            buf = buf.reshape(-1).view(numpy.uint8)
+        view = memoryview(buf)
+        N = len(view)
+        nr = 0
+        while nr < N:
+            n = self.sock.recv_into(view[nr:], N - nr)
+            if n == 0:
+                self.disconnect()
+                raise IOError('Connection closed by buffer server - disconnecting')
+            nr += n
+
+    def receiveBuffer(self, bufsize):
         """
+        Receive 'bufsize' bytes into the preallocated receive buffer, which
+        grows as needed. This returns a memoryview that is only valid until
+        the next response is received.
+        """
+        if bufsize > len(self.rxbuf):
+            self.rxbuf = bytearray(max(bufsize, 2 * len(self.rxbuf)))
+        view = memoryview(self.rxbuf)[0:bufsize]
+        self.receiveRaw(view)
+        return view
 
-        resp_hdr = self.sock.recv(8)
-        while len(resp_hdr) < 8:
-            resp_hdr += self.sock.recv(8 - len(resp_hdr))
+    def receiveHeader(self):
+        """
+        Receive the 8-byte response header from the server and return it as
+        (status,bufsize).
+        """
+        resp_hdr = memoryview(self.rxhdr)[0:8]
+        self.receiveRaw(resp_hdr)
 
         (version, command, bufsize) = struct.unpack('HHI', resp_hdr)
 
@@ -271,10 +333,20 @@ class Client:
             self.disconnect()
             raise IOError('Bad response from buffer server - disconnecting')
 
+        return (command, bufsize)
+
+    def receiveResponse(self, minBytes=0):
+        """
+        Receive response from server on socket 's' and return it as
+        (status,bufsize,payload). The payload is a memoryview on the
+        preallocated receive buffer and is only valid until the next
+        response is received.
+        """
+
+        (command, bufsize) = self.receiveHeader()
+
         if bufsize > 0:
-            payload = self.sock.recv(bufsize)
-            while len(payload) < bufsize:
-                payload += self.sock.recv(bufsize - len(payload))
+            payload = self.receiveBuffer(bufsize)
         else:
             payload = None
         return (command, bufsize, payload)
@@ -318,7 +390,7 @@ class Client:
                 offset += 8
                 if offset + chunk_len > bufsize:
                     break
-                H.chunks[chunk_type] = payload[offset:offset + chunk_len]
+                H.chunks[chunk_type] = bytes(payload[offset:offset + chunk_len])
                 offset += chunk_len
 
             if CHUNK_CHANNEL_NAMES in H.chunks:
@@ -378,12 +450,15 @@ class Client:
             if status != PUT_OK:
                 raise IOError('Header could not be written')
 
-    def getData(self, index=None):
+    def getData(self, index=None, out=None):
         """
-        getData([indices]) -- retrieve data samples and return them as a
+        getData([indices, out]) -- retrieve data samples and return them as a
         Numpy array, samples in rows(!). The 'indices' argument is optional,
         and if given, must be a tuple or list with inclusive, zero-based
-        start/end indices.
+        start/end indices. The 'out' argument is optional, and if given, must
+        be a Numpy array with the shape of the requested data. The samples
+        are then received directly into this array, or converted to its data
+        type, and the array is returned.
         """
 
         if index is None:
@@ -394,8 +469,18 @@ class Client:
             request = struct.pack('HHIII', VERSION, GET_DAT, 8, indS, indE)
         self.sendRaw(request)
 
-        (status, bufsize, payload) = self.receiveResponse()
+        return self.receiveData(out)
+
+    def receiveData(self, out=None):
+        """
+        Receive the response to a GET_DAT request and return the samples as
+        a Numpy array, or None if the data could not be read.
+        """
+
+        (status, bufsize) = self.receiveHeader()
         if status == GET_ERR:
+            if bufsize > 0:
+                self.receiveBuffer(bufsize)
             return None
 
         if status != GET_OK:
@@ -406,13 +491,29 @@ class Client:
             self.disconnect()
             raise IOError('Invalid DATA packet received (too few bytes)')
 
-        (nchans, nsamp, datype, bfsiz) = struct.unpack('IIII', payload[0:16])
-
-        if bfsiz < bufsize - 16 or datype >= len(numpyType):
-            raise IOError('Invalid DATA packet received')
+        datadef = memoryview(self.rxhdr)[8:24]
+        self.receiveRaw(datadef)
+        (nchans, nsamp, datype, bfsiz) = struct.unpack('IIII', datadef)
 
-        raw = payload[16:bfsiz + 16]
-        D = numpy.ndarray((nsamp, nchans), dtype=numpyType[datype], buffer=raw)
+        if bfsiz != bufsize - 16 or datype >= len(numpyType) or bfsiz != nsamp * nchans * wordSize[datype]:
+            self.disconnect()
+            raise IOError('Invalid DATA packet received - disconnecting')
+
+        if out is None:
+            # receive the samples directly into a new array
+            D = numpy.empty((nsamp, nchans), dtype=numpyType[datype])
+            self.receiveRaw(D)
+        elif out.shape == (nsamp, nchans) and out.dtype == numpy.dtype(numpyType[datype]) and out.flags['C_CONTIGUOUS']:
+            # receive the samples directly into the array given by the caller
+            D = out
+            self.receiveRaw(D)
+        else:
+            raw = self.receiveBuffer(bfsiz)
+            if out.shape != (nsamp, nchans):
+                raise ValueError('The output array does not match the shape of the data (%d x %d)' % (nsamp, nchans))
+            # convert the samples to the data type of the array given by the caller
+            D = out
+            D[...] = numpy.frombuffer(raw, dtype=numpyType[datype]).reshape(nsamp, nchans)
 
         return D
 
@@ -441,6 +542,11 @@ class Client:
             self.disconnect()
             raise IOError('Bad response from buffer server - disconnecting')
 
+        # the events should not refer to the receive buffer, since that will be reused
+        if resp_buf is None:
+            return []
+        resp_buf = bytes(resp_buf)
+
         offset = 0
         E = []
         while 1:
@@ -497,18 +603,25 @@ class Client:
         nSamp = D.shape[0]
         nChan = D.shape[1]
 
-        (dataType, dataBuf) = serialize(D)
+        dt = D.dtype
+        if not(dt.isnative) or dt.num < 1 or dt.num >= len(dataType) or dataType[dt.num] == -1:
+            raise ValueError('Data type %s is not supported' % dt)
 
-        dataBufSize = len(dataBuf)
+        if not(D.flags['C_CONTIGUOUS']):
+            # we need a copy to C order
+            D = D.copy('C')
+
+        dataBufSize = D.nbytes
 
         if response:
             command = PUT_DAT
         else:
             command = PUT_DAT_NORESPONSE
 
-        request = struct.pack('HHI', VERSION, command, 16 + dataBufSize)
-        dataDef = struct.pack('IIII', nChan, nSamp, dataType, dataBufSize)
-        self.sendRaw(request + dataDef + dataBuf)
+        # the samples are sent straight from the array, without copying them
+        request = struct.pack('HHIIIII', VERSION, command, 16 + dataBufSize,
+                              nChan, nSamp, dataType[dt.num], dataBufSize)
+        self.sendParts([request, D])
 
         if response:
             (status, bufsize, resp_buf) = self.receiveResponse()
@@ -539,6 +652,226 @@ class Client:
 
         return struct.unpack('II', resp_buf[0:8])
 
+    def readNext(self, nsamples, timeout=30, begsample=None, out=None):
+        """
+        readNext(nsamples [, timeout, begsample, out]) -- wait for the next
+        block of 'nsamples' samples and return it as (D, begsample, endsample),
+        or None if the block did not become available within the timeout in
+        seconds. The wait and the data request are sent together, so that the
+        block is read in a single round trip. The blocks are contiguous, unless
+        the zero-based 'begsample' is specified. If neither that nor a previous
+        block is known, reading starts at the most recent samples. A
+        RuntimeError is raised when a reset of the buffer is detected. The
+        number of samples in the buffer is kept in 'availableSamples', this
+        can be used to detect that the reader is lagging behind.
+        """
+
+        nsamples = int(nsamples)
+
+        if begsample is not None:
+            self.nextSample = int(begsample)
+        elif self.nextSample is None:
+            (nSamples, nEvents) = self.poll()
+            self.nextSample = max(nSamples - nsamples, 0)
+
+        begsample = self.nextSample
+        endsample = self.nextSample + nsamples - 1
+
+        # the buffer responds to WAIT_DAT when the number of samples exceeds the threshold,
+        # the threshold for the events is set such that new events are ignored
+        wait = struct.pack('HHIIII', VERSION, WAIT_DAT, 12, endsample, 0xFFFFFFFF, int(timeout * 1000))
+        request = struct.pack('HHIII', VERSION, GET_DAT, 8, begsample, endsample)
+        self.sendRaw(wait + request)
+
+        (status, bufsize, resp_buf) = self.receiveResponse()
+        if status != WAIT_OK or bufsize < 8:
+            # the response to the data request still needs to be consumed
+            self.receiveData()
+            raise IOError('Wait request failed.')
+
+        (nSamples, nEvents) = struct.unpack('II', resp_buf[0:8])
+        self.availableSamples = nSamples
+        D = self.receiveData(out)
+
+        if nSamples < begsample:
+            self.nextSample = None
+            raise RuntimeError('Buffer reset detected')
+
+        if D is None:
+            # the timeout expired before the requested samples were available
+            return None
+
+        self.nextSample = endsample + 1
+        return (D, begsample, endsample)
+
+
+class Writer:
+
+    """
+    Class for writing samples to a FieldTrip buffer from a background thread.
+    Consecutive chunks are coalesced into blocks of 'blocksize' samples; an
+    incomplete block is written once its oldest sample has been waiting for
+    'latency' seconds, also when the queue does not run empty. Hence a block
+    never spans more than 'latency' seconds of queued chunks. The blocks are
+    written with PUT_DAT_NORESPONSE, hence write errors only surface at the
+    next putData, flush or close. While the writer is open, the client should
+    not be used from another thread.
+    """
+
+    def __init__(self, client, blocksize=None, latency=None):
+        self.client = client
+        self.blocksize = blocksize
+        self.latency = latency
+        self.queue = queue.Queue()
+        self.error = None
+        # the counters for the blocks that have been written
+        self.blocks = 0
+        self.samples = 0
+        self.elapsed = 0.
+        self.maxelapsed = 0.
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __str__(self):
+        (mean, maximum) = self.latencies()
+        return ('%d chunks queued, %d samples written in %d blocks, latency %.1f ms mean, %.1f ms max' %
+                (self.depth(), self.samples, self.blocks, mean * 1000, maximum * 1000))
+
+    def putData(self, D):
+        """
+        putData(D) -- queues samples for writing that must be given as a
+        NUMPY array, samples x channels. The array should not be modified
+        afterwards, since it is not copied when queued.
+        """
+        if self.error is not None:
+            raise self.error
+        if not(isinstance(D, numpy.ndarray)) or len(D.shape) != 2:
+            raise ValueError(
+                'Data must be given as a NUMPY array (samples x channels)')
+        dt = D.dtype
+        if not(dt.isnative) or dt.num < 1 or dt.num >= len(dataType) or dataType[dt.num] == -1:
+            raise ValueError('Data type %s is not supported' % dt)
+        self.queue.put((D, time.monotonic()))
+
+    def depth(self):
+        """depth() -- returns the number of chunks waiting in the queue."""
+        return self.queue.qsize()
+
+    def latencies(self):
+        """latencies() -- returns the mean and maximum write latency in seconds."""
+        return (self.elapsed / max(self.blocks, 1), self.maxelapsed)
+
+    def flush(self):
+        """flush() -- writes all queued samples and waits for completion."""
+        self.queue.put((None, False))
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """close() -- writes all queued samples and stops the thread."""
+        if self.thread.is_alive():
+            self.queue.put((None, True))
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def write(self, D, timestamp):
+        if self.error is not None:
+            # the samples are discarded after an error
+            return
+        try:
+            self.client.putData(D, response=False)
+        except Exception as e:
+            self.error = IOError('Samples could not be written: %s' % e)
+            return
+        elapsed = time.monotonic() - timestamp
+        self.blocks += 1
+        self.samples += D.shape[0]
+        self.elapsed += elapsed
+        self.maxelapsed = max(self.maxelapsed, elapsed)
+
+    def run(self):
+        block = None    # preallocated block in which the chunks are coalesced
+        nblock = 0      # number of samples in the block
+        first = None    # time at which the oldest sample in the block was queued
+        while True:
+            if nblock and self.latency is not None:
+                timeout = max(first + self.latency - time.monotonic(), 0)
+            else:
+                timeout = None
+            try:
+                (D, arg) = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                # the oldest sample has been waiting long enough
+                self.write(block[:nblock], first)
+                nblock = 0
+                continue
+
+            if D is None:
+                # this is a request to flush or to close
+                if nblock:
+                    self.write(block[:nblock], first)
+                    nblock = 0
+                self.queue.task_done()
+                if arg:
+                    break
+                continue
+
+            try:
+                if self.blocksize is None and self.latency is None:
+                    # nothing to coalesce
+                    self.write(D, arg)
+                    continue
+
+                if nblock and self.latency is not None and arg >= first + self.latency:
+                    # the chunk was queued after the oldest sample had been waiting long enough,
+                    # this also applies when the queue never runs empty
+                    self.write(block[:nblock], first)
+                    nblock = 0
+
+                if block is not None and (block.shape[1] != D.shape[1] or block.dtype != D.dtype):
+                    # the samples cannot be combined with the previous ones
+                    if nblock:
+                        self.write(block[:nblock], first)
+                        nblock = 0
+                    block = None
+
+                offset = 0
+                while offset < D.shape[0]:
+                    if nblock == 0 and self.blocksize and D.shape[0] - offset >= self.blocksize:
+                        # write complete blocks straight from the chunk
+                        self.write(D[offset:offset + self.blocksize], arg)
+                        offset += self.blocksize
+                        continue
+                    if self.blocksize:
+                        n = min(self.blocksize - nblock, D.shape[0] - offset)
+                    else:
+                        n = D.shape[0] - offset
+                    if block is None or nblock + n > block.shape[0]:
+                        # the block only grows when there is no fixed block size
+                        size = self.blocksize or max(2 * (nblock + n), 64)
+                        grown = numpy.empty((size, D.shape[1]), dtype=D.dtype)
+                        if nblock:
+                            grown[:nblock] = block[:nblock]
+                        block = grown
+                    block[nblock:nblock + n] = D[offset:offset + n]
+                    if nblock == 0:
+                        first = arg
+                    nblock += n
+                    offset += n
+                    if nblock == self.blocksize:
+                        self.write(block[:nblock], first)
+                        nblock = 0
+            except Exception as e:
+                # the thread should keep on running, otherwise flush and close would wait forever
+                if self.error is None:
+                    self.error = IOError('Samples could not be written: %s' % e)
+            finally:
+                self.queue.task_done()
+
+
 if __name__ == "__main__":
     # Just a small demo for testing purposes...
     # This should be moved to a separate file at some point
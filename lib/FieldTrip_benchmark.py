@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for the FieldTrip buffer client. This includes a minimal FieldTrip
+buffer server in pure Python that serves as stand-in for the real buffer.
+"""
+
+import argparse
+import socket
+import struct
+import threading
+import time
+import numpy
+
+from FieldTrip import *
+
+
+class Server:
+
+    """
+    Minimal FieldTrip buffer (V1) server that keeps all data in memory. It
+    supports the header and data requests, but not the events.
+    """
+
+    def __init__(self, hostname='localhost', port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((hostname, port))
+        self.sock.listen(5)
+        self.hostname, self.port = self.sock.getsockname()
+        self.condition = threading.Condition()
+        self.hdr = None
+        self.nChannels = 0
+        self.nSamples = 0
+        self.dataType = DATATYPE_UNKNOWN
+        self.data = bytearray()
+        self.running = True
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+
+    def accept(self):
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def receive(self, conn, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        nr = 0
+        while nr < size:
+            n = conn.recv_into(view[nr:], size - nr)
+            if n == 0:
+                raise IOError('Connection closed by client')
+            nr += n
+        return buf
+
+    def respond(self, conn, command, *payload):
+        size = sum([len(x) for x in payload])
+        conn.sendall(struct.pack('HHI', VERSION, command, size))
+        for x in payload:
+            conn.sendall(x)
+
+    def handle(self, conn):
+        try:
+            while True:
+                (version, command, bufsize) = struct.unpack('HHI', self.receive(conn, 8))
+                payload = self.receive(conn, bufsize)
+                self.process(conn, command, payload)
+        except (IOError, socket.error, struct.error):
+            conn.close()
+
+    def process(self, conn, command, payload):
+        if command in (PUT_HDR, PUT_HDR_NORESPONSE):
+            (nchans, nsamp, nevt, fsamp, dtype, bfsiz) = struct.unpack('IIIfII', payload[0:24])
+            with self.condition:
+                self.hdr = bytes(payload)
+                self.nChannels = nchans
+                self.dataType = dtype
+                self.nSamples = 0
+                self.data = bytearray()
+            if command == PUT_HDR:
+                self.respond(conn, PUT_OK)
+
+        elif command in (PUT_DAT, PUT_DAT_NORESPONSE):
+            (nchans, nsamp, dtype, bfsiz) = struct.unpack('IIII', payload[0:16])
+            with self.condition:
+                ok = self.hdr is not None and nchans == self.nChannels and dtype == self.dataType
+                if ok:
+                    self.data += payload[16:16 + bfsiz]
+                    self.nSamples += nsamp
+                    self.condition.notify_all()
+            if command == PUT_DAT:
+                self.respond(conn, PUT_OK if ok else PUT_ERR)
+
+        elif command == GET_HDR:
+            with self.condition:
+                if self.hdr is None:
+                    self.respond(conn, GET_ERR)
+                else:
+                    hdr = bytearray(self.hdr)
+                    hdr[4:8] = struct.pack('I', self.nSamples)
+                    self.respond(conn, GET_OK, hdr)
+
+        elif command == GET_DAT:
+            with self.condition:
+                if len(payload) >= 8:
+                    (begsample, endsample) = struct.unpack('II', payload[0:8])
+                else:
+                    (begsample, endsample) = (0, self.nSamples - 1)
+                if self.hdr is None or begsample > endsample or endsample >= self.nSamples:
+                    self.respond(conn, GET_ERR)
+                    return
+                nbytes = self.nChannels * wordSize[self.dataType]
+                data = memoryview(self.data)[begsample * nbytes:(endsample + 1) * nbytes]
+                datadef = struct.pack('IIII', self.nChannels, endsample - begsample + 1, self.dataType, len(data))
+                self.respond(conn, GET_OK, datadef, data)
+
+        elif command == WAIT_DAT:
+            (nsamples, nevents, timeout) = struct.unpack('III', payload[0:12])
+            deadline = time.time() + timeout / 1000.
+            with self.condition:
+                while self.nSamples <= nsamples and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                self.respond(conn, WAIT_OK, struct.pack('II', self.nSamples, 0))
+
+        elif command == FLUSH_DAT:
+            with self.condition:
+                self.nSamples = 0
+                self.data = bytearray()
+            self.respond(conn, FLUSH_OK)
+
+        else:
+            self.respond(conn, GET_ERR)
+
+
+def legacy_getData(client, index):
+    """
+    This is how the data used to be received, it serves as reference.
+    """
+    request = struct.pack('HHIII', VERSION, GET_DAT, 8, int(index[0]), int(index[1]))
+    client.sendRaw(request)
+
+    resp_hdr = client.sock.recv(8)
+    while len(resp_hdr) < 8:
+        resp_hdr += client.sock.recv(8 - len(resp_hdr))
+    (version, status, bufsize) = struct.unpack('HHI', resp_hdr)
+
+    payload = client.sock.recv(bufsize)
+    while len(payload) < bufsize:
+        payload += client.sock.recv(bufsize - len(payload))
+
+    (nchans, nsamp, datype, bfsiz) = struct.unpack('IIII', payload[0:16])
+    raw = payload[16:bfsiz + 16]
+    return numpy.ndarray((nsamp, nchans), dtype=numpyType[datype], buffer=raw)
+
+
+def legacy_putData(client, D):
+    """
+    This is how the data used to be written, it serves as reference.
+    """
+    (datype, buf) = serialize(D)
+    request = struct.pack('HHI', VERSION, PUT_DAT, 16 + len(buf))
+    datadef = struct.pack('IIII', D.shape[1], D.shape[0], datype, len(buf))
+    client.sendRaw(request + datadef + buf)
+    (status, bufsize, resp_buf) = client.receiveResponse()
+
+
+def writer_putData(client, chunks, blocksize, latency):
+    writer = Writer(client, blocksize, latency)
+    for D in chunks:
+        writer.putData(D)
+    writer.close()
+
+
+class StalledClient:
+
+    """
+    Stands in for the client of the writer, the writes only start once it is
+    released. The chunks that arrive in the mean time pile up in the queue.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.released = threading.Event()
+
+    def putData(self, D, response=True):
+        self.released.wait()
+        self.client.putData(D, response)
+
+
+def stalled_writer(client, chunk, latency, duration):
+    # the chunks arrive more often than the latency, while the writer cannot write them
+    stalled = StalledClient(client)
+    writer = Writer(stalled, None, latency)
+    start = time.time()
+    while time.time() - start < duration:
+        writer.putData(chunk)
+        time.sleep(latency / 10)
+    # the writer now never finds the queue empty, but each block should still span the latency at most
+    stalled.released.set()
+    writer.close()
+    return writer
+
+
+def timeit(fun, repeat):
+    start = time.time()
+    for i in range(repeat):
+        fun()
+    return (time.time() - start) / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hostname", default=None, help="hostname of a running buffer, the default is to start a Python stand-in")
+    parser.add_argument("--port", type=int, default=1972, help="port of a running buffer")
+    parser.add_argument("--channels", type=int, default=256, help="number of channels")
+    parser.add_argument("--fsample", type=float, default=1000., help="sampling frequency in Hz")
+    parser.add_argument("--blocks", type=float, nargs='+', default=[1, 5, 10, 30, 60], help="block length in seconds")
+    parser.add_argument("--chunk", type=int, default=10, help="number of samples per chunk that is written")
+    parser.add_argument("--repeat", type=int, default=5, help="number of repetitions")
+    args = parser.parse_args()
+
+    if args.hostname is None:
+        server = Server()
+        hostname, port = server.hostname, server.port
+    else:
+        server = None
+        hostname, port = args.hostname, args.port
+
+    ftc = Client()
+    ftc.connect(hostname, port)
+
+    nsamples = int(max(args.blocks) * args.fsample)
+    ftc.putHeader(args.channels, args.fsample, DATATYPE_FLOAT32)
+    for begsample in range(0, nsamples, int(args.fsample)):
+        ftc.putData(numpy.random.randn(int(args.fsample), args.channels).astype(numpy.float32))
+
+    print('%8s %10s %12s %12s %12s %10s' % ('seconds', 'MB', 'legacy (ms)', 'getData (ms)', 'out= (ms)', 'speedup'))
+    for block in args.blocks:
+        n = int(block * args.fsample)
+        index = [0, n - 1]
+        out = numpy.empty((n, args.channels), dtype=numpy.float32)
+
+        if not numpy.array_equal(legacy_getData(ftc, index), ftc.getData(index)):
+            raise RuntimeError('the received data does not match the reference')
+
+        t_legacy = timeit(lambda: legacy_getData(ftc, index), args.repeat)
+        t_new = timeit(lambda: ftc.getData(index), args.repeat)
+        t_out = timeit(lambda: ftc.getData(index, out=out), args.repeat)
+        print('%8g %10.1f %12.2f %12.2f %12.2f %10.2f' % (block, out.nbytes / 1e6, t_legacy * 1000, t_new * 1000, t_out * 1000, t_legacy / t_out))
+
+    chunks = [numpy.random.randn(args.chunk, args.channels).astype(numpy.float32) for i in range(int(args.fsample / args.chunk))]
+    print('')
+    print('%8s %12s %12s %12s %10s' % ('chunk', 'legacy (ms)', 'putData (ms)', 'writer (ms)', 'speedup'))
+    t_legacy = timeit(lambda: [legacy_putData(ftc, D) for D in chunks], args.repeat)
+    t_new = timeit(lambda: [ftc.putData(D) for D in chunks], args.repeat)
+    t_writer = timeit(lambda: writer_putData(ftc, chunks, int(args.fsample / 10), 0.1), args.repeat)
+    print('%8d %12.2f %12.2f %12.2f %10.2f' % (args.chunk, t_legacy * 1000, t_new * 1000, t_writer * 1000, t_legacy / t_writer))
+
+    # the latency should also be respected when the queue never runs empty
+    writer = stalled_writer(ftc, chunks[0], 0.01, 0.5)
+    print('')
+    print('stalled writer: %s' % writer)
+    if writer.blocks < 0.5 / 0.01 / 2:
+        raise RuntimeError('the writer does not respect the latency')
+
+    ftc.disconnect()
+    if server is not None:
+        server.stop()
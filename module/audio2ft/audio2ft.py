@@ -94,7 +94,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     """
     global parser, args, config, r, response, patch, name
-    global monitor, debug, device, rate, blocksize, nchans, ft_host, ft_port, ft_output, p, info, i, devinfo, stream, startfeedback, countfeedback
+    global monitor, debug, device, rate, blocksize, nchans, ft_host, ft_port, ft_output, ft_blocksize, ft_latency, ft_writer, p, info, i, devinfo, stream, startfeedback, countfeedback
 
 
     # this can be used to show parameters that have changed
@@ -149,6 +149,15 @@ def _start():
 
     ft_output.putHeader(nchans, float(rate), FieldTrip.DATATYPE_INT16)
 
+    # the samples can be coalesced and written to the buffer from a background thread
+    ft_blocksize = patch.getint("fieldtrip", "blocksize")
+    ft_latency = patch.getfloat("fieldtrip", "latency")
+    if ft_blocksize or ft_latency:
+        ft_writer = FieldTrip.Writer(ft_output, blocksize=ft_blocksize, latency=ft_latency)
+        monitor.info("Writing blocks of %s samples with a latency of %s seconds" % (ft_blocksize, ft_latency))
+    else:
+        ft_writer = ft_output
+
     startfeedback = time.time()
     countfeedback = 0
 
@@ -173,7 +182,7 @@ def _loop_once():
 
     # convert raw buffer to numpy array and write to output buffer
     data = np.reshape(np.frombuffer(data, dtype=np.int16), (blocksize, nchans))
-    ft_output.putData(data)
+    ft_writer.putData(data)
 
     countfeedback += blocksize
 
@@ -181,6 +190,8 @@ def _loop_once():
     if countfeedback >= rate:
         # this gets printed approximately once per second
         monitor.debug("streamed " + str(countfeedback) + " samples in " + str((time.time() - startfeedback) * 1000) + " ms")
+        if ft_writer is not ft_output:
+            monitor.debug(str(ft_writer))
         startfeedback = time.time()
         countfeedback = 0
 
@@ -201,10 +212,13 @@ def _loop_forever():
 def _stop():
     """Stop and clean up on SystemExit, KeyboardInterrupt
     """
-    global stream, p
+    global monitor, stream, p, ft_output, ft_writer
     stream.stop_stream()
     stream.close()
     p.terminate()
+    if ft_writer is not ft_output:
+        ft_writer.close()
+        monitor.info(str(ft_writer))
     sys.exit()
 
 
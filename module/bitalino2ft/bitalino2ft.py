@@ -95,7 +95,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     """
     global parser, args, config, r, response, patch, name
-    global  monitor, debug, device, fsample, blocksize, channels, batterythreshold, nchans, startfeedback, countfeedback, ft_host, ft_port, ft_output, datatype, digitalOutput
+    global  monitor, debug, device, fsample, blocksize, channels, batterythreshold, nchans, startfeedback, countfeedback, ft_host, ft_port, ft_output, ft_blocksize, ft_latency, ft_writer, datatype, digitalOutput
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint("general", "debug"))
@@ -131,6 +131,15 @@ def _start():
     datatype = FieldTrip.DATATYPE_FLOAT32
     ft_output.putHeader(nchans, float(fsample), datatype)
 
+    # the samples can be coalesced and written to the buffer from a background thread
+    ft_blocksize = patch.getint("fieldtrip", "blocksize")
+    ft_latency = patch.getfloat("fieldtrip", "latency")
+    if ft_blocksize or ft_latency:
+        ft_writer = FieldTrip.Writer(ft_output, blocksize=ft_blocksize, latency=ft_latency)
+        monitor.info("Writing blocks of %s samples with a latency of %s seconds" % (ft_blocksize, ft_latency))
+    else:
+        ft_writer = ft_output
+
     try:
         # Connect to BITalino
         device = BITalino(device)
@@ -161,7 +170,7 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     """
     global parser, args, config, r, response, patch
-    global monitor, debug, device, fsample, blocksize, channels, batterythreshold, nchans, startfeedback, countfeedback, ft_host, ft_port, ft_output, datatype, digitalOutput
+    global monitor, debug, device, fsample, blocksize, channels, batterythreshold, nchans, startfeedback, countfeedback, ft_host, ft_port, ft_output, ft_blocksize, ft_latency, ft_writer, datatype, digitalOutput
     global start, dat
 
     # measure the time that it takes
@@ -172,7 +181,7 @@ def _loop_once():
     # it starts with 5 extra channels, the first is the sample number (running from 0 to 15), the next 4 seem to be binary
     dat = dat[:, 5:]
     # write the data to the output buffer
-    ft_output.putData(dat.astype(np.float32))
+    ft_writer.putData(dat.astype(np.float32))
 
     countfeedback += blocksize
 
@@ -180,6 +189,8 @@ def _loop_once():
     if countfeedback >= fsample:
         # this gets printed approximately once per second
         monitor.debug("streamed " + str(countfeedback) + " samples in " + str((time.time() - startfeedback) * 1000) + " ms")
+        if ft_writer is not ft_output:
+            monitor.debug(str(ft_writer))
         startfeedback = time.time()
         countfeedback = 0
 
@@ -200,10 +211,13 @@ def _loop_forever():
 def _stop():
     """Stop and clean up on SystemExit, KeyboardInterrupt
     """
-    global device
+    global monitor, device, ft_output, ft_writer
     # Stop acquisition and close connection
     device.stop()
     device.close()
+    if ft_writer is not ft_output:
+        ft_writer.close()
+        monitor.info(str(ft_writer))
     sys.exit()
 
 
@@ -57,7 +57,7 @@ class TriggerThread(threading.Thread):
         self.previous = None  # keep the time of the previous trigger
         self.interval = None  # estimate the interval between triggers
         self.running = True
-        self.timer = []
+        self.events = []      # the scheduled triggers in between the incoming ones
 
     def stop(self):
         self.running = False
@@ -75,13 +75,13 @@ class TriggerThread(threading.Thread):
                 if not self.running or not item['type'] == 'message':
                     break
                 if item['channel'] == self.redischannel:
-                    now = time.time()
+                    now = scheduler.clock()
                     count += 1          # this is for the total count
 
-                    # cancel all timers that are still running
-                    for t in self.timer:
-                        t.cancel()
-                    self.timer = []
+                    # cancel all triggers that are still pending
+                    for event in self.events:
+                        scheduler.cancel(event)
+                    self.events = []
 
                     if self.previous == None:
                         # it is not yet possible to estimate the interval
@@ -102,12 +102,10 @@ class TriggerThread(threading.Thread):
                     # send the first one immediately
                     patch.setvalue(self.key, val)
 
-                    # schedule the subsequent ones after some time
+                    # schedule the subsequent ones relative to the incoming trigger
                     for number in range(1, self.rate):
-                        delay = number * (self.interval / self.rate)
-                        t = threading.Timer(delay, patch.setvalue, args=[self.key, val])
-                        t.start()
-                        self.timer.append(t)
+                        deadline = now + number * (self.interval / self.rate)
+                        self.events.append(scheduler.enterabs(deadline, patch.setvalue, args=[self.key, val]))
 
 
 def _setup():
@@ -142,7 +140,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, debug, channels, multipliers, lrate, count, triggers, channel, multiplier, thread
+    global monitor, debug, channels, multipliers, lrate, count, scheduler, triggers, channel, multiplier, thread
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general','debug'))
@@ -156,6 +154,9 @@ def _start():
     # for keeping track of the number of received triggers
     count = 0
 
+    # the triggers in between the incoming ones are all scheduled from a single thread
+    scheduler = EEGsynth.getscheduler()
+
     triggers = []
     for channel in channels:
         for multiplier in multipliers:
@@ -176,7 +177,7 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, debug, channels, multipliers, lrate, count, triggers, channel, multiplier, thread
+    global monitor, debug, channels, multipliers, lrate, count, scheduler, triggers, channel, multiplier, thread
 
     monitor.update("count", count / len(multipliers))
 
@@ -198,7 +199,7 @@ def _loop_forever():
 def _stop():
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
-    global monitor, triggers, r
+    global monitor, scheduler, triggers, r
 
     monitor.success('Closing threads')
     for thread in triggers:
@@ -206,6 +207,7 @@ def _stop():
     r.publish('CLOCKMULTIPLIER_UNBLOCK', 1)
     for thread in triggers:
         thread.join()
+    scheduler.stop()
     sys.exit()
 
 
@@ -57,6 +57,29 @@ import EEGsynth
 import FieldTrip
 
 
+# these are the metrics that NeuroKit.complexity() can compute, each can be switched on or off
+metric_options = ['shannon', 'sampen', 'multiscale', 'spectral', 'svd', 'correlation', 'higushi', 'petrosian', 'fisher', 'hurst', 'dfa', 'lyap_r', 'lyap_e']
+
+
+def compute_metric(chan, metric, timeseries, fsample):
+    # this is executed in one of the worker processes
+    # it computes a single metric for a single channel and returns how long it took
+    options = dict([(option, option == metric) for option in metric_options])
+    start = time.time()
+    result = complexity(timeseries, sampling_rate=fsample, **options)
+    return chan, metric, result, time.time() - start
+
+
+def shorten(metric):
+    # remove some leading information from the names of the results
+    shortmetric = metric.lower()
+    if shortmetric.startswith('entropy_'):
+        shortmetric = shortmetric[len('entropy_'):]
+    if shortmetric.startswith('fractal_dimension_'):
+        shortmetric = shortmetric[len('fractal_dimension_'):]
+    return shortmetric
+
+
 def _setup():
     '''Initialize the module
     This adds a set of global variables
@@ -101,7 +124,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input, name
-    global timeout, hdr_input, start, channel_items, channame, chanindx, item, shannon, sampen, multiscale, spectral, svd, correlation, higushi, petrosian, fisher, hurst, dfa, lyap_r, lyap_e, window, taper, frequency, begsample, endsample
+    global timeout, hdr_input, start, channel_items, channame, chanindx, item, metric, selection, interval, lastupdate, pending, timing, report, lastreport, pool, window, taper, frequency, begsample, endsample
 
     # this is the timeout for the FieldTrip buffer
     timeout = patch.getfloat('fieldtrip', 'timeout', default=30)
@@ -129,19 +152,27 @@ def _start():
 
     monitor.info(str(channame) + " " + str(chanindx))
 
-    shannon     = patch.getint('metrics', 'shannon',     default=0) != 0
-    sampen      = patch.getint('metrics', 'sampen',      default=0) != 0
-    multiscale  = patch.getint('metrics', 'multiscale',  default=0) != 0
-    spectral    = patch.getint('metrics', 'spectral',    default=0) != 0
-    svd         = patch.getint('metrics', 'svd',         default=0) != 0
-    correlation = patch.getint('metrics', 'correlation', default=0) != 0
-    higushi     = patch.getint('metrics', 'higushi',     default=0) != 0
-    petrosian   = patch.getint('metrics', 'petrosian',   default=0) != 0
-    fisher      = patch.getint('metrics', 'fisher',      default=0) != 0
-    hurst       = patch.getint('metrics', 'hurst',       default=0) != 0
-    dfa         = patch.getint('metrics', 'dfa',         default=0) != 0
-    lyap_r      = patch.getint('metrics', 'lyap_r',      default=0) != 0
-    lyap_e      = patch.getint('metrics', 'lyap_e',      default=0) != 0
+    # each metric can be computed for all channels (1), for none (0), or for a list of channel names
+    selection = {}
+    interval = {}
+    for metric in metric_options:
+        item = [name.strip() for name in patch.getstring('metrics', metric, default='0', multiple=True)]
+        if len(item) == 1 and item[0].isdigit():
+            selection[metric] = list(range(len(channame))) if int(item[0]) else []
+        else:
+            selection[metric] = [channame.index(name) for name in item if name in channame]
+        # expensive metrics can be updated less often, the interval is in seconds
+        interval[metric] = patch.getfloat('interval', metric, default=0)
+        monitor.info('%s = %s, interval = %g' % (metric, str([channame[chan] for chan in selection[metric]]), interval[metric]))
+
+    # the metrics are computed in parallel, each channel and metric is a separate task
+    pool = multiprocessing.Pool(processes=patch.getint('processing', 'workers', default=multiprocessing.cpu_count()))
+    lastupdate = {}     # the time at which the computation of each metric for each channel started
+    pending = {}        # the computations that have not yet finished
+    timing = {}         # the number of computations and the total time that they took for each metric
+    report = patch.getfloat('processing', 'report', default=10)  # in seconds
+    lastreport = time.time()
+
     window      = patch.getfloat('processing','window')  # in seconds
 
     window      = int(round(window * hdr_input.fSample)) # in samples
@@ -160,8 +191,8 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input
-    global timeout, hdr_input, start, channel_items, channame, chanindx, item, shannon, sampen, multiscale, spectral, svd, correlation, higushi, petrosian, fisher, hurst, dfa, lyap_r, lyap_e, window, taper, frequency, begsample, endsample
-    global dat, meandat, chan, sample, metrics, timeseries, metric_names, metric, shortmetric, key, val
+    global timeout, hdr_input, start, channel_items, channame, chanindx, item, metric, selection, interval, lastupdate, pending, timing, report, lastreport, pool, window, taper, frequency, begsample, endsample
+    global dat, now, chan, task, result, elapsed, key, val
 
     hdr_input = ft_input.getHeader()
     if (hdr_input.nSamples - 1) < endsample:
@@ -177,47 +208,36 @@ def _loop_once():
     dat = ft_input.getData([begsample, endsample]).astype(np.double)
     dat = dat[:, chanindx]
 
-    # subtract the channel mean and apply the taper to each sample
-    meandat = dat.mean(0)
-    for chan in range(dat.shape[1]):
-        for sample in range(dat.shape[0]):
-            dat[sample, chan] -= meandat[chan]
-            dat[sample, chan] *= taper[sample]
-
-    # compute complexity over the sample direction
-    metrics = []
-    for timeseries in dat.T:
-        metrics.append(complexity(timeseries,
-                        sampling_rate=hdr_input.fSample,
-                        shannon=shannon,
-                        sampen=sampen,
-                        multiscale=multiscale,
-                        spectral=spectral,
-                        svd=svd,
-                        correlation=correlation,
-                        higushi=higushi,
-                        petrosian=petrosian,
-                        fisher=fisher,
-                        hurst=hurst,
-                        dfa=dfa,
-                        lyap_r=lyap_r,
-                        lyap_e=lyap_e,
-                        ))
-
-    metric_names = list(metrics[0].keys())
-
-    for chan in chanindx:
-        for metric in metric_names:
-            shortmetric = metric.lower()
-            # remove some trailing information
-            if shortmetric.startswith('entropy_'):
-                shortmetric = shortmetric[len('entropy_'):]
-            if shortmetric.startswith('fractal_dimension_'):
-                shortmetric = shortmetric[len('fractal_dimension_'):]
-            key = "{}.{}".format(channame[chan], shortmetric)
-            val = metrics[chan][metric]
+    # subtract the channel mean and apply the taper
+    dat = (dat - dat.mean(axis=0)) * taper[:, np.newaxis]
+
+    # start the computations that are due, unless the previous one is still running
+    now = time.time()
+    for metric in metric_options:
+        for chan in selection[metric]:
+            task = (chan, metric)
+            if task in pending or now - lastupdate.get(task, -np.inf) < interval[metric]:
+                continue
+            lastupdate[task] = now
+            pending[task] = pool.apply_async(compute_metric, (chan, metric, dat[:, chan], hdr_input.fSample))
+
+    # write the results of the computations that have finished
+    for task in [task for task in pending if pending[task].ready()]:
+        chan, metric, result, elapsed = pending.pop(task).get()
+        for key, val in result.items():
+            key = "{}.{}".format(channame[chan], shorten(key))
             patch.setvalue(key, val)
             monitor.update(key, val)
+        # keep track of the computational time per metric, this helps to budget the CPU
+        timing[metric] = (timing.get(metric, (0, 0.))[0] + 1, timing.get(metric, (0, 0.))[1] + elapsed)
+        monitor.debug('%s for %s took %.3f s' % (metric, channame[chan], elapsed))
+
+    # report the computational time per metric and the fraction of the CPU time that it uses
+    if report > 0 and now - lastreport >= report:
+        for metric in timing:
+            monitor.info('%-12s %4d times, %8.3f s on average, %6.1f%% CPU' % (metric, timing[metric][0], timing[metric][1] / timing[metric][0], 100 * timing[metric][1] / (now - lastreport)))
+        timing = {}
+        lastreport = now
 
 
 def _loop_forever():
@@ -233,7 +253,8 @@ def _loop_forever():
 def _stop():
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
-    global monitor, ft_input
+    global monitor, ft_input, pool
+    pool.terminate()
     ft_input.disconnect()
     monitor.success('Disconnected from input FieldTrip buffer')
     sys.exit()
@@ -51,36 +51,18 @@ sys.path.insert(0, os.path.join(path, '../../lib'))
 import EEGsynth
 
 
-class TriggerThread(threading.Thread):
-    def __init__(self, redischannel, midichannel):
-        threading.Thread.__init__(self)
-        self.redischannel = redischannel
-        self.midichannel = midichannel
-        self.running = True
-
-    def stop(self):
-        self.running = False
-
-    def run(self):
-        pubsub = r.pubsub()
-        pubsub.subscribe('ENDORPHINES_UNBLOCK')  # this message unblocks the redis listen command
-        pubsub.subscribe(self.redischannel)      # this message contains the note
-        while self.running:
-            for item in pubsub.listen():
-                if not self.running or not item['type'] == 'message':
-                    break
-                if item['channel'] == self.redischannel:
-                    monitor.info(item)
-                    if int(float(item['data'])) > 0:
-                        pitch = int(8191)
-                    else:
-                        pitch = int(0)
-                    msg = mido.Message('pitchwheel', pitch=pitch, channel=self.midichannel)
-                    monitor.debug(msg)
-                    with lock:
-                        outputport.send(msg)
-                    # keep it at the present value for a minimal amount of time
-                    time.sleep(patch.getfloat('general', 'pulselength'))
+def HandleTrigger(item, midichannel):
+    monitor.info(item)
+    if int(float(item['data'])) > 0:
+        pitch = int(8191)
+    else:
+        pitch = int(0)
+    msg = mido.Message('pitchwheel', pitch=pitch, channel=midichannel)
+    monitor.debug(msg)
+    with lock:
+        outputport.send(msg)
+    # keep it at the present value for a minimal amount of time
+    time.sleep(patch.getfloat('general', 'pulselength'))
 
 
 def _setup():
@@ -142,21 +124,19 @@ def _start():
     lock = threading.Lock()
 
     # each of the gates that can be triggered is mapped onto a different message
-    trigger = []
+    # each gate is kept at its value for some time, more workers prevent this from delaying the other gates
+    trigger = EEGsynth.dispatcher(r, workers=16)
     for channel in range(0, 16):
 
         # channels are one-offset in the ini file, zero-offset in the code
         name = 'channel{}'.format(channel + 1)
         if config.has_option('gate', name):
 
-            # start the background thread that deals with this channel
-            this = TriggerThread(patch.getstring('gate', name), channel)
-            trigger.append(this)
+            trigger.subscribe(patch.getstring('gate', name), HandleTrigger, args=(channel,))
             monitor.debug(name + ' trigger configured')
 
-    # start the thread for each of the notes
-    for thread in trigger:
-        thread.start()
+    # start receiving the messages for all gates
+    trigger.start()
 
     # control values are only relevant when different from the previous value
     previous_val = {}
@@ -273,11 +253,7 @@ def _stop():
     """
     global monitor, trigger, r
     monitor.success('Closing threads')
-    for thread in trigger:
-        thread.stop()
-    r.publish('ENDORPHINES_UNBLOCK', 1)
-    for thread in trigger:
-        thread.join()
+    trigger.stop()
     sys.exit()
 
 
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Measurement of the timing jitter and drift of the clock ticks in the generateclock module
+#
+# This software is part of the EEGsynth project, see <https://github.com/eegsynth/eegsynth>.
+#
+# Copyright (C) 2020 EEGsynth project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import numpy as np
+import os
+import sys
+import threading
+import time
+
+path = os.path.split(os.path.abspath(__file__))[0]
+
+# eegsynth/lib contains shared modules
+sys.path.insert(0, os.path.join(path, '../../lib'))
+import EEGsynth
+
+sys.path.insert(0, path)
+import generateclock
+
+
+def deadline_clock(rate, duration, spin):
+    # returns the ideal and the actual time at which each tick is received by an output
+    clockthread = generateclock.ClockThread(rate=rate, spin=spin)
+    ticks = clockthread.subscribe()
+    ideal, actual = [], []
+    clockthread.start()
+    stop = time.perf_counter() + duration
+    while time.perf_counter() < stop:
+        tick, deadline = ticks.get()
+        actual.append(time.perf_counter())
+        ideal.append(deadline)
+    clockthread.stop()
+    clockthread.join()
+    return np.array(ideal), np.array(actual)
+
+
+def sleep_clock(rate, duration):
+    # this is how the clock used to be generated, it serves as reference
+    clock = [threading.Event() for tick in range(24)]
+    running = [True]
+
+    def run():
+        slip = 0
+        while running[0]:
+            start = time.time()
+            delay = 60 / rate
+            delay -= slip
+            jiffy = delay / 24
+            for tick in range(24):
+                clock[tick].set()
+                clock[tick].clear()
+                if jiffy > 0:
+                    time.sleep(jiffy)
+            slip = time.time() - start - delay
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    actual = []
+    stop = time.perf_counter() + duration
+    while time.perf_counter() < stop:
+        for tick in clock:
+            # a tick that is missed results in a wait of one beat
+            if tick.wait(60 / rate):
+                actual.append(time.perf_counter())
+    running[0] = False
+    thread.join()
+    actual = np.array(actual)
+    # the ideal timing is relative to the first tick
+    ideal = actual[0] + np.arange(len(actual)) * 60. / (rate * 24)
+    return ideal, actual
+
+
+def report(label, ideal, actual, rate):
+    error = (actual - ideal) * 1000
+    interval = np.diff(actual) * 1000 - 60000. / (rate * 24)
+    minute = int(60 * rate * 24 / 60)
+    drift = np.median(error[-minute:]) - np.median(error[:minute])
+    print('%-10s %8d %8.3f %8.3f %8.3f %8.3f %8.3f %10.3f %10.3f' % ((label, len(actual)) + tuple(np.percentile(error, [50, 90, 99, 99.9])) + (np.max(error), np.std(interval), drift)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=120., help="clock rate in beats per minute")
+    parser.add_argument("--duration", type=float, default=600., help="duration of the run in seconds")
+    parser.add_argument("--spin", type=float, default=0.001, help="time in seconds to busy wait before each deadline")
+    parser.add_argument("--reference", action='store_true', help="also measure the original sleep-based clock")
+    args = parser.parse_args()
+
+    # the clock thread uses the monitor for logging
+    generateclock.monitor = EEGsynth.monitor(name='benchmark', debug=0)
+
+
+    print('the ticks are late by (ms), the interval jitter and the drift between the first and last minute are in ms')
+    print('%-10s %8s %8s %8s %8s %8s %8s %10s %10s' % ('clock', 'ticks', 'p50', 'p90', 'p99', 'p99.9', 'max', 'jitter', 'drift'))
+    ideal, actual = deadline_clock(args.rate, args.duration, args.spin)
+    report('deadline', ideal, actual, args.rate)
+    if args.reference:
+        ideal, actual = sleep_clock(args.rate, args.duration)
+        report('sleep', ideal, actual, args.rate)
@@ -24,6 +24,7 @@ import mido
 from fuzzywuzzy import process
 import numpy as np
 import os
+import queue
 import redis
 import sys
 import threading
@@ -57,88 +58,114 @@ def find_nearest_value(list, value):
 
 
 class ClockThread(threading.Thread):
-    def __init__(self):
+    """Generate the 24 MIDI clock ticks per quarter note at absolute deadlines.
+
+    The deadline of every tick is computed from a monotonic anchor, i.e. the time and the
+    tick at which the current rate took effect, rather than from the previous tick. Hence
+    the timing errors of the individual ticks do not accumulate. A rate change takes effect
+    at the next tick boundary, at which point the anchor is moved. Each tick is put in the
+    queue of every subscribed output thread, so that slow outputs cannot miss a tick.
+    """
+
+    def __init__(self, rate=60, spin=0.001):
         threading.Thread.__init__(self)
         self.running = True
-        self.rate = 60              # the rate is in bpm, i.e. quarter notes per minute
+        self.rate = rate            # the rate is in bpm, i.e. quarter notes per minute
+        self.spin = spin            # the last part of the interval until each deadline is spent busy waiting
+        self.queues = []
+
+    def subscribe(self):
+        ticks = queue.Queue()
+        # the list is replaced rather than modified, this does not require a lock
+        self.queues = self.queues + [ticks]
+        return ticks
 
     def setRate(self, rate):
-        if rate != self.rate:
-            with lock:
-                self.rate = rate
+        # assigning the value is atomic, it will be picked up at the next tick boundary
+        self.rate = rate
 
     def stop(self):
         self.running = False
 
     def run(self):
-        slip = 0
+        rate = self.rate
+        anchor = time.perf_counter()
+        first = 0
+        tick = 0
         while self.running:
-            monitor.debug('clock beat')
-            start = time.time()
-            delay = 60 / self.rate   # the rate is in bpm
-            delay -= slip            # correct for the slip from the previous iteration
-            jiffy = delay / 24
-            for tick in range(24):
-                clock[tick].set()
-                clock[tick].clear()
-                if jiffy > 0:
-                    time.sleep(jiffy)
-            # the actual time used in this loop will be slightly different than desired
-            # this will be corrected on the next iteration
-            slip = time.time() - start - delay
+            deadline = anchor + (tick - first) * 60. / (rate * 24)
+            if self.rate != rate:
+                # the interval up to this tick uses the previous rate, the next ones the new rate
+                anchor, first, rate = deadline, tick, self.rate
+
+            # sleep most of the time and wait for the last bit to get an accurate timing
+            naptime = deadline - time.perf_counter()
+            if naptime > self.spin:
+                time.sleep(naptime - self.spin)
+            while time.perf_counter() < deadline:
+                pass
+
+            for ticks in self.queues:
+                ticks.put((tick, deadline))
+            if tick % 24 == 0:
+                monitor.debug('clock beat')
+            tick += 1
 
 
 class MidiThread(threading.Thread):
-    def __init__(self):
+    def __init__(self, ticks):
         threading.Thread.__init__(self)
         self.running = True
         self.enabled = False
+        self.ticks = ticks
 
     def setEnabled(self, enabled):
         self.enabled = enabled
 
     def stop(self):
-        self.enables = False
+        self.enabled = False
         self.running = False
 
     def run(self):
         msg = mido.Message('clock')
         while self.running:
+            try:
+                tick, deadline = self.ticks.get(timeout=stepsize)
+            except queue.Empty:
+                continue
+            # the ticks are also consumed while disabled, to keep the queue empty
             if self.enabled and midiport:
-                monitor.debug('midi beat')
-                for tick in clock:
-                    tick.wait()
-                    midiport.send(msg)
-            else:
-                time.sleep(patch.getfloat('general', 'delay'))
+                if tick % 24 == 0:
+                    monitor.debug('midi beat')
+                midiport.send(msg)
 
 
 class RedisThread(threading.Thread):
-    def __init__(self):
+    def __init__(self, ticks):
         threading.Thread.__init__(self)
         self.running = True
         self.enabled = False
+        self.ticks = ticks
         self.ppqn = 1      # this determines how many messages are sent per quarter note
         self.shift = 0     # this determines by how many ticks the Redis message is shifted
         # it will send a message on the selected clock ticks
-        self.clock = [0]
+        self.clock = set([0])
         self.key = "{}.note".format(patch.getstring('output', 'prefix'))
 
+    def select(self, ppqn, shift):
+        # the set is replaced rather than modified, this does not require a lock
+        self.clock = set(np.mod(np.arange(0, 24, 24 / ppqn) + shift, 24).astype(int).tolist())
+        monitor.info("redis select = " + str(sorted(self.clock)))
+
     def setPpqn(self, ppqn):
         if ppqn != self.ppqn:
-            with lock:
-                self.ppqn = ppqn
-                self.clock = np.mod(
-                    np.arange(0, 24, 24 / self.ppqn) + self.shift, 24).astype(int)
-                monitor.info("redis select = " + str(self.clock))
+            self.ppqn = ppqn
+            self.select(self.ppqn, self.shift)
 
     def setShift(self, shift):
         if shift != self.shift:
-            with lock:
-                self.shift = shift
-                self.clock = np.mod(
-                    np.arange(0, 24, 24 / self.ppqn) + self.shift, 24).astype(int)
-                monitor.info("redis select = " + str(self.clock))
+            self.shift = shift
+            self.select(self.ppqn, self.shift)
 
     def setEnabled(self, enabled):
         self.enabled = enabled
@@ -149,13 +176,15 @@ class RedisThread(threading.Thread):
 
     def run(self):
         while self.running:
-            if self.enabled:
-                monitor.debug('redis beat')
-                for tick in [clock[indx] for indx in self.clock]:
-                    tick.wait()
-                    patch.setvalue(self.key, 1.)
-            else:
-                time.sleep(patch.getfloat('general', 'delay'))
+            try:
+                tick, deadline = self.ticks.get(timeout=stepsize)
+            except queue.Empty:
+                continue
+            # the ticks are also consumed while disabled, to keep the queue empty
+            if self.enabled and (tick % 24) in self.clock:
+                if tick % 24 == min(self.clock):
+                    monitor.debug('redis beat')
+                patch.setvalue(self.key, 1.)
 
 
 def _setup():
@@ -190,7 +219,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     """
     global parser, args, config, r, response, patch, name
-    global monitor, stepsize, scale_rate, offset_rate, scale_shift, offset_shift, scale_ppqn, offset_ppqn, lock, clock, i, clockthread, midithread, redisthread, midiport, previous_midi_play, previous_midi_start, previous_redis_play
+    global monitor, stepsize, scale_rate, offset_rate, scale_shift, offset_shift, scale_ppqn, offset_ppqn, clockthread, midithread, redisthread, midiport, previous_midi_play, previous_midi_start, previous_redis_play
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
@@ -206,26 +235,17 @@ def _start():
     scale_ppqn = patch.getfloat('scale', 'ppqn')
     offset_ppqn = patch.getfloat('offset', 'ppqn')
 
-    # this is to prevent two threads accesing a variable at the same time
-    lock = threading.Lock()
-
-    # this is to synchronize the clocks
-    clock = []
-    for i in range(0, 24):
-        clock.append(threading.Event())
-
     # create and start the thread that manages the clock
     clockthread = ClockThread()
-    clockthread.start()
 
-    # create and start the thread for the MIDI output
-    midithread = MidiThread()
+    # create and start the threads for the MIDI and Redis output, each receives the clock ticks in its own queue
+    midithread = MidiThread(clockthread.subscribe())
     midithread.start()
-
-    # create and start the thread for the Redis output
-    redisthread = RedisThread()
+    redisthread = RedisThread(clockthread.subscribe())
     redisthread.start()
 
+    clockthread.start()
+
     # the MIDI interface will only be started when needed
     midiport = None
 
@@ -243,7 +263,7 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     """
     global parser, args, config, r, response, patch
-    global monitor, stepsize, scale_rate, offset_rate, scale_shift, offset_shift, scale_ppqn, offset_ppqn, lock, clock, i, clockthread, midithread, redisthread, midiport, previous_midi_play, previous_midi_start, previous_redis_play
+    global monitor, stepsize, scale_rate, offset_rate, scale_shift, offset_shift, scale_ppqn, offset_ppqn, clockthread, midithread, redisthread, midiport, previous_midi_play, previous_midi_start, previous_redis_play
     global start, redis_play, midi_play, midi_start, rate, shift, ppqn, elapsed, naptime
 
     redis_play = patch.getint('redis', 'play')
@@ -265,7 +285,7 @@ def _loop_once():
         mididevice = EEGsynth.trimquotes(mididevice)
         mididevice = process.extractOne(mididevice, mido.get_output_names())[0]  # select the closest match
         try:
-            outputport = mido.open_output(mididevice)
+            midiport = mido.open_output(mididevice)
             monitor.success('Connected to MIDI output')
         except:
             raise RuntimeError("cannot connect to MIDI output")
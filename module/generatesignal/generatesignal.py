@@ -99,7 +99,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_output, name
-    global nchannels, fsample, shape, scale_frequency, scale_amplitude, scale_offset, scale_noise, scale_dutycycle, offset_frequency, offset_amplitude, offset_offset, offset_noise, offset_dutycycle, blocksize, datatype, block, begsample, endsample, stepsize, timevec, phasevec
+    global nchannels, fsample, shape, scale_frequency, scale_amplitude, scale_offset, scale_noise, scale_dutycycle, offset_frequency, offset_amplitude, offset_offset, offset_noise, offset_dutycycle, blocksize, datatype, block, begsample, endsample, stepsize, timevec, phasevec, ft_blocksize, ft_latency, ft_writer
 
     # get the options from the configuration file
     nchannels = patch.getint('generate', 'nchannels')
@@ -139,6 +139,15 @@ def _start():
     elif datatype == 'float64':
         ft_output.putHeader(nchannels, fsample, FieldTrip.DATATYPE_FLOAT64)
 
+    # the samples can be coalesced and written to the buffer from a background thread
+    ft_blocksize = patch.getint('fieldtrip', 'blocksize')
+    ft_latency = patch.getfloat('fieldtrip', 'latency')
+    if ft_blocksize or ft_latency:
+        ft_writer = FieldTrip.Writer(ft_output, blocksize=ft_blocksize, latency=ft_latency)
+        monitor.info('Writing blocks of %s samples with a latency of %s seconds' % (ft_blocksize, ft_latency))
+    else:
+        ft_writer = ft_output
+
     monitor.debug("nchannels = " + str(nchannels))
     monitor.debug("fsample = " + str(fsample))
     monitor.debug("blocksize = " + str(blocksize))
@@ -162,7 +171,7 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_output
-    global nchannels, fsample, shape, scale_frequency, scale_amplitude, scale_offset, scale_noise, scale_dutycycle, offset_frequency, offset_amplitude, offset_offset, offset_noise, offset_dutycycle, blocksize, datatype, block, begsample, endsample, stepsize, timevec, phasevec
+    global nchannels, fsample, shape, scale_frequency, scale_amplitude, scale_offset, scale_noise, scale_dutycycle, offset_frequency, offset_amplitude, offset_offset, offset_noise, offset_dutycycle, blocksize, datatype, block, begsample, endsample, stepsize, timevec, phasevec, ft_blocksize, ft_latency, ft_writer
     global start, frequency, amplitude, offset, noise, dutycycle, signal, dat_output, chan, elapsed, naptime
 
     if patch.getint('signal', 'rewind', default=0):
@@ -225,21 +234,23 @@ def _loop_once():
 
     # write the data to the output buffer
     if datatype == 'uint8':
-        ft_output.putData(dat_output.astype(np.uint8))
+        ft_writer.putData(dat_output.astype(np.uint8))
     elif datatype == 'int8':
-        ft_output.putData(dat_output.astype(np.int8))
+        ft_writer.putData(dat_output.astype(np.int8))
     elif datatype == 'uint16':
-        ft_output.putData(dat_output.astype(np.uint16))
+        ft_writer.putData(dat_output.astype(np.uint16))
     elif datatype == 'int16':
-        ft_output.putData(dat_output.astype(np.int16))
+        ft_writer.putData(dat_output.astype(np.int16))
     elif datatype == 'uint32':
-        ft_output.putData(dat_output.astype(np.uint32))
+        ft_writer.putData(dat_output.astype(np.uint32))
     elif datatype == 'int32':
-        ft_output.putData(dat_output.astype(np.int32))
+        ft_writer.putData(dat_output.astype(np.int32))
     elif datatype == 'float32':
-        ft_output.putData(dat_output.astype(np.float32))
+        ft_writer.putData(dat_output.astype(np.float32))
     elif datatype == 'float64':
-        ft_output.putData(dat_output.astype(np.float64))
+        ft_writer.putData(dat_output.astype(np.float64))
+    if ft_writer is not ft_output:
+        monitor.debug(str(ft_writer))
 
     begsample += blocksize
     endsample += blocksize
@@ -272,7 +283,10 @@ def _loop_forever():
 def _stop():
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
-    global monitor, ft_output
+    global monitor, ft_output, ft_writer
+    if ft_writer is not ft_output:
+        ft_writer.close()
+        monitor.info(str(ft_writer))
     ft_output.disconnect()
     monitor.success('Disconnected from output FieldTrip buffer')
     sys.exit()
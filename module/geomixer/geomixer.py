@@ -133,17 +133,15 @@ def _loop_once():
     global monitor, debug, stepsize, number, prefix, scale_input, scale_time, scale_precision, offset_input, offset_time, offset_precision, channel_name, vertex, dwelltime, edge, previous
     global switch_time, switch_precision, input, lower_treshold, upper_treshold, change, key, channel_val, this, next, val, desired, elapsed, naptime, s
 
-    # these can change on the fly
-    switch_time = patch.getfloat('switch', 'time', default=1.0)
+    # these can change on the fly, get them together with the input value
+    switch_time, switch_precision, input = patch.getfloats(['switch', 'switch', 'input'], ['time', 'precision', 'channel'], default=[1.0, 0.1, np.nan])
     switch_time = EEGsynth.rescale(switch_time, slope=scale_time, offset=offset_time)
-    switch_precision = patch.getfloat('switch', 'precision', default=0.1)
     switch_precision = EEGsynth.rescale(switch_precision, slope=scale_precision, offset=offset_precision)
 
     monitor.update('time', switch_time)
     monitor.update('precision', switch_precision)
 
-    # get the input value and scale between 0 and 1
-    input = patch.getfloat('input', 'channel', default=np.NaN)
+    # scale the input value between 0 and 1
     input = EEGsynth.rescale(input, slope=scale_input, offset=offset_input)
 
     if switch_precision > 0:
@@ -21,11 +21,13 @@
 
 import configparser
 import argparse
+import math
 import numpy as np
 import os
 import redis
 import sys
 import time
+from scipy.signal import lombscargle
 
 if hasattr(sys, 'frozen'):
     path = os.path.split(sys.executable)[0]
@@ -50,6 +52,102 @@ import FieldTrip
 import EEGsynth
 
 
+class BeatDetector():
+    """Detect the heart beats in an ECG or PPG signal that arrives in consecutive blocks.
+    Each block is only processed once, the filter state, the threshold and whether the
+    signal was above the threshold at the end of the previous block are carried over.
+    The threshold adapts to the range of the signal in the most recent window.
+    """
+
+    def __init__(self, fsample, window, threshold, lrate, debounce, sos=[], begsample=0):
+        self.threshold = threshold                  # between 0-1, relative to the range of the signal
+        self.lrate = lrate                          # rate at which the threshold auto-scales
+        self.debounce = debounce * fsample          # minimum number of samples between beats
+        self.filter = EEGsynth.sosfilter(sos, 1)
+        self.statistics = EEGsynth.runningstatistics(window, order=False)
+        self.curvemin = np.nan
+        self.curvemean = np.nan
+        self.curvemax = np.nan
+        self.above = True                           # this prevents a beat at the very first sample
+        self.previous = None                        # the sample of the previous beat
+        self.nsamples = begsample                   # the sample at the start of the next block
+
+    def process(self, dat):
+        # returns the sample number of every beat in this block
+        dat = self.filter.filter(dat).reshape(-1)
+        self.statistics.append(dat)
+
+        if np.isnan(self.curvemin):
+            self.curvemin = self.statistics.min()
+            self.curvemean = self.statistics.mean()
+            self.curvemax = self.statistics.max()
+        else:
+            # the learning rate determines how fast the threshold auto-scales (0=never, 1=immediate)
+            self.curvemin = (1 - self.lrate) * self.curvemin + self.lrate * self.statistics.min()
+            self.curvemean = (1 - self.lrate) * self.curvemean + self.lrate * self.statistics.mean()
+            self.curvemax = (1 - self.lrate) * self.curvemax + self.lrate * self.statistics.max()
+
+        # both are defined as positive
+        negrange = self.curvemean - self.curvemin
+        posrange = self.curvemax - self.curvemean
+
+        if negrange > posrange:
+            thresh = (self.curvemean - dat) > self.threshold * negrange
+        else:
+            thresh = (dat - self.curvemean) > self.threshold * posrange
+
+        # determine samples that are true and where the previous sample is false
+        onset = np.logical_and(thresh, np.logical_not(np.concatenate(([self.above], thresh[:-1]))))
+        self.above = thresh[-1]
+
+        beats = []
+        for sample in (np.where(onset)[0] + self.nsamples).tolist():
+            # require a minimum time between beats
+            if self.previous is None or sample - self.previous > self.debounce:
+                beats.append(sample)
+                self.previous = sample
+        self.nsamples += len(dat)
+        return beats
+
+
+class HeartRateVariability():
+    """Keep the most recent beat-to-beat intervals and compute the heart rate variability.
+    The mean and standard deviation of the intervals and of the squared successive differences
+    are updated incrementally. The ratio of the low- and high-frequency power is computed
+    with a Lomb-Scargle periodogram, which does not require the intervals to be resampled.
+    """
+
+    def __init__(self, length):
+        self.beats = EEGsynth.ringbuffer(length, 2)                             # the time of the beat and the interval, in seconds
+        self.intervals = EEGsynth.runningstatistics(length, order=False)
+        self.differences = EEGsynth.runningstatistics(length - 1, order=False)  # the squared successive differences
+        self.previous = None
+        self.frequency = np.linspace(0.04, 0.4, 91)                             # in Hz
+        self.lf = self.frequency < 0.15
+        self.hf = self.frequency >= 0.15
+
+    def append(self, time, interval):
+        self.beats.append([[time, interval]])
+        self.intervals.append(interval)
+        if self.previous is not None:
+            self.differences.append((interval - self.previous) ** 2)
+        self.previous = interval
+
+    def rmssd(self):
+        return math.sqrt(self.differences.mean()) if self.differences.count > 0 else np.nan
+
+    def sdnn(self):
+        return self.intervals.std()
+
+    def lfhf(self):
+        beats = self.beats.get()
+        if beats.shape[0] < 3 or beats[-1, 0] - beats[0, 0] < 1. / self.frequency[0]:
+            # the intervals should span at least one period of the lowest frequency
+            return np.nan
+        power = lombscargle(beats[:, 0], beats[:, 1] - np.mean(beats[:, 1]), 2 * np.pi * self.frequency)
+        return float(np.sum(power[self.lf]) / np.sum(power[self.hf]))
+
+
 def _setup():
     '''Initialize the module
     This adds a set of global variables
@@ -98,7 +196,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input, name
-    global timeout, hdr_input, start, channel, window, threshold, lrate, debounce, key_beat, key_rate, curvemin, curvemean, curvemax, prev, begsample, endsample
+    global timeout, hdr_input, start, channel, window, threshold, lrate, debounce, bandpass, key_beat, key_rate, key_interval, key_rmssd, key_sdnn, key_lfhf, sos, detector, hrv, prev, begsample, endsample
 
     # this is the timeout for the FieldTrip buffer
     timeout = patch.getfloat('fieldtrip', 'timeout', default=30)
@@ -122,18 +220,34 @@ def _start():
     threshold = patch.getfloat('processing', 'threshold')
     lrate     = patch.getfloat('processing', 'learning_rate', default=1)
     debounce  = patch.getfloat('processing', 'debounce', default=0.3)             # minimum time between beats (s)
+    bandpass  = patch.getfloat('processing', 'bandpass', multiple=True)          # optional, in Hz
     key_beat  = patch.getstring('output', 'heartbeat')
     key_rate  = patch.getstring('output', 'heartrate')
+    # the outputs for the heart rate variability are optional
+    key_interval = patch.getstring('output', 'interval')
+    key_rmssd    = patch.getstring('output', 'rmssd')
+    key_sdnn     = patch.getstring('output', 'sdnn')
+    key_lfhf     = patch.getstring('output', 'lfhf')
 
     window = round(window * hdr_input.fSample)  # in samples
 
-    curvemin  = np.nan;
-    curvemean = np.nan;
-    curvemax  = np.nan;
-    prev      = np.nan
+    # wait until there is enough data
+    while hdr_input.nSamples < window:
+        monitor.info('Waiting for data to arrive...')
+        time.sleep(patch.getfloat('general','delay'))
+        hdr_input = ft_input.getHeader()
+
+    # the first block is one window, after that only the new samples are processed
+    begsample = hdr_input.nSamples - window
+    endsample = begsample - 1
 
-    begsample = -1
-    endsample = -1
+    if len(bandpass) == 2:
+        sos = EEGsynth.butter_sos(hdr_input.fSample, bandpass[0], bandpass[1], order=2)
+    else:
+        sos = []
+    detector = BeatDetector(hdr_input.fSample, window, threshold, lrate, debounce, sos=sos, begsample=begsample)
+    hrv = HeartRateVariability(patch.getint('processing', 'hrv', default=120))  # the number of beats
+    prev = None
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -145,78 +259,58 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input
-    global timeout, hdr_input, start, channel, window, threshold, lrate, debounce, key_beat, key_rate, curvemin, curvemean, curvemax, prev, begsample, endsample
-    global dat, negrange, posrange, thresh, prevsample, sample, last, bpm, duration, duration_scale, duration_offset
+    global timeout, hdr_input, start, channel, window, threshold, lrate, debounce, bandpass, key_beat, key_rate, key_interval, key_rmssd, key_sdnn, key_lfhf, detector, hrv, prev, begsample, endsample
+    global dat, beats, sample, interval, bpm, values, duration, duration_scale, duration_offset
 
     hdr_input = ft_input.getHeader()
     if (hdr_input.nSamples-1)<endsample:
         raise RuntimeError("buffer reset detected")
-    if hdr_input.nSamples < window:
-        # there are not yet enough samples in the buffer
-        monitor.info('Waiting for data to arrive...')
-        return
 
-    # process the last window
-    begsample = hdr_input.nSamples - int(window)
+    # process the samples that are new since the previous iteration
+    begsample = endsample + 1
     endsample = hdr_input.nSamples - 1
-    dat       = ft_input.getData([begsample,endsample]).astype(np.double)
-    dat       = dat[:,channel]
-
-    if np.isnan(curvemin):
-        curvemin  = np.min(dat)
-        curvemean = np.mean(dat)
-        curvemax  = np.max(dat)
-    else:
-        # the learning rate determines how fast the threshold auto-scales (0=never, 1=immediate)
-        curvemin  = (1 - lrate) * curvemin  + lrate * np.min(dat)
-        curvemean = (1 - lrate) * curvemean + lrate * np.mean(dat)
-        curvemax  = (1 - lrate) * curvemax  + lrate * np.max(dat)
-
-    # both are defined as positive
-    negrange = curvemean - curvemin
-    posrange = curvemax - curvemean
-
-    if negrange>posrange:
-        thresh = (curvemean - dat) > threshold * negrange
-    else:
-        thresh = (dat - curvemean) > threshold * posrange
-
-    if not np.isnan(prev):
-        prevsample = int(round(prev * hdr_input.fSample)) - begsample
-        if prevsample>0 and prevsample<len(thresh):
-            thresh[0:prevsample] = False
-
-    # determine samples that are true and where the previous sample is false
-    thresh = np.logical_and(thresh[1:], np.logical_not(thresh[0:-1]))
-    sample = np.where(thresh)[0]+1
-
-    if len(sample)<1:
-        # no beat was detected
-        return
-
-    # determine the last beat in the window
-    last = sample[-1]
-    last = (last + begsample) / hdr_input.fSample
-
-    if np.isnan(prev):
-        # the first beat has not been detected yet
-        prev = last
+    if endsample < begsample:
         return
-
-    if last-prev>debounce:
-        # require a minimum time between beats
-        bpm  = 60./(last-prev)
-        prev = last
-
-        if not np.isnan(bpm):
-            # this is to schedule a timer that switches the gate off
-            duration        = patch.getfloat('general', 'duration', default=0.1)
-            duration_scale  = patch.getfloat('scale', 'duration', default=1)
-            duration_offset = patch.getfloat('offset', 'duration', default=0)
-            duration        = EEGsynth.rescale(duration, slope=duration_scale, offset=duration_offset)
-
-            patch.setvalue(key_rate, bpm)
-            patch.setvalue(key_beat, bpm, duration=duration)
+    dat       = ft_input.getData([begsample,endsample]).astype(np.double)
+    dat       = dat[:,[channel]]
+
+    beats = detector.process(dat)
+
+    for sample in beats:
+        monitor.debug('beat at sample %d' % sample)
+
+        if prev is None:
+            # this is the first beat
+            prev = sample
+            continue
+
+        interval = (sample - prev) / hdr_input.fSample
+        bpm      = 60. / interval
+        prev     = sample
+        hrv.append(sample / hdr_input.fSample, interval)
+
+        # the interval and the variability are expressed in milliseconds
+        values = {key_rate: bpm}
+        if key_interval:
+            values[key_interval] = 1000 * interval
+        if key_rmssd:
+            values[key_rmssd] = 1000 * hrv.rmssd()
+        if key_sdnn:
+            values[key_sdnn] = 1000 * hrv.sdnn()
+        if key_lfhf:
+            values[key_lfhf] = hrv.lfhf()
+        # the variability cannot be computed until there are enough beats
+        values = dict([(key, val) for key, val in values.items() if not np.isnan(val)])
+        monitor.update('heartrate', bpm)
+
+        # this is to schedule a timer that switches the gate off
+        duration        = patch.getfloat('general', 'duration', default=0.1)
+        duration_scale  = patch.getfloat('scale', 'duration', default=1)
+        duration_offset = patch.getfloat('offset', 'duration', default=0)
+        duration        = EEGsynth.rescale(duration, slope=duration_scale, offset=duration_offset)
+
+        patch.setvalues(values)
+        patch.setvalue(key_beat, bpm, duration=duration)
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -48,15 +48,6 @@ sys.path.insert(0, os.path.join(path,'../../lib'))
 import EEGsynth
 
 
-def mad(arr, axis=None):
-    # see https://en.wikipedia.org/wiki/Median_absolute_deviation
-    if axis==1:
-        val = np.apply_along_axis(mad, 1, arr)
-    else:
-        val = np.nanmedian(np.abs(arr - np.nanmedian(arr)))
-    return val
-
-
 def _setup():
     '''Initialize the module
     This adds a set of global variables
@@ -89,7 +80,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, inputlist, enable, stepsize, window, metrics_iqr, metrics_mad, metrics_max, metrics_max_att, metrics_mean, metrics_median, metrics_min, metrics_min_att, metrics_p03, metrics_p16, metrics_p84, metrics_p97, metrics_range, metrics_std, numchannel, numhistory, history, historic
+    global monitor, inputlist, enable, stepsize, window, metrics_iqr, metrics_mad, metrics_max, metrics_max_att, metrics_mean, metrics_median, metrics_min, metrics_min_att, metrics_p03, metrics_p16, metrics_p84, metrics_p97, metrics_range, metrics_std, numchannel, numhistory, history, historic, order
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general','debug'))
@@ -118,8 +109,11 @@ def _start():
     numchannel  = len(inputlist)
     numhistory  = int(round(window/stepsize))
 
-    # this will contain the full list of historic values
-    history = np.empty((numchannel, numhistory)) * np.NAN
+    # the order statistics are only needed for the robust estimators
+    order = metrics_median or metrics_mad or metrics_p03 or metrics_p16 or metrics_p84 or metrics_p97 or metrics_iqr
+
+    # this will contain the historic values and keep the statistics up to date
+    history = [EEGsynth.runningstatistics(numhistory, order=order) for channel in range(numchannel)]
 
     # this will contain the statistics of the historic values
     historic = {}
@@ -134,8 +128,8 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, inputlist, enable, stepsize, window, metrics_iqr, metrics_mad, metrics_max, metrics_max_att, metrics_mean, metrics_median, metrics_min, metrics_min_att, metrics_p03, metrics_p16, metrics_p84, metrics_p97, metrics_range, metrics_std, numchannel, numhistory, history, historic
-    global prev_enable, channel, history_att, operation, key, val
+    global monitor, inputlist, enable, stepsize, window, metrics_iqr, metrics_mad, metrics_max, metrics_max_att, metrics_mean, metrics_median, metrics_min, metrics_min_att, metrics_p03, metrics_p16, metrics_p84, metrics_p97, metrics_range, metrics_std, numchannel, numhistory, history, historic, order
+    global prev_enable, channel, history_att, operation, key, val, values
 
     # update the enable status
     prev_enable = enable
@@ -154,66 +148,67 @@ def _loop_once():
         time.sleep(0.1)
         return
 
-    # shift data to next sample
-    history[:, :-1] = history[:, 1:]
-
     # update with current data
-    for channel in range(numchannel):
-        history[channel, numhistory-1] = r.get(inputlist[channel])
+    for channel, val in enumerate(r.mget(inputlist)):
+        if val is None:
+            history[channel].append(np.nan)
+        else:
+            history[channel].append(float(val))
 
     if metrics_mean or metrics_max_att or metrics_min_att:
-        historic['mean']    = np.nanmean(history, axis=1)
+        historic['mean']    = [history[channel].mean() for channel in range(numchannel)]
     if metrics_min or metrics_range:
-        historic['min']     = np.nanmin(history, axis=1)
+        historic['min']     = [history[channel].min() for channel in range(numchannel)]
     if metrics_max or metrics_range:
-        historic['max']     = np.nanmax(history, axis=1)
+        historic['max']     = [history[channel].max() for channel in range(numchannel)]
 
     # use some robust estimators
     if metrics_median:
-        historic['median']  = np.nanmedian(history, axis=1)
+        historic['median']  = [history[channel].median() for channel in range(numchannel)]
     if metrics_mad:
         # see https://en.wikipedia.org/wiki/Median_absolute_deviation
-        historic['mad']     = mad(history, axis=1)
+        historic['mad']     = [history[channel].mad() for channel in range(numchannel)]
 
     # for a normal distribution the 16th and 84th percentile correspond to the mean plus-minus one standard deviation
     if metrics_p03:
-        historic['p03']     = np.percentile(history,  3, axis=1) # mean minus 2x standard deviation
+        historic['p03']     = [history[channel].percentile( 3) for channel in range(numchannel)] # mean minus 2x standard deviation
     if metrics_p16 or metrics_iqr:
-        historic['p16']     = np.percentile(history, 16, axis=1) # mean minus 1x standard deviation
+        historic['p16']     = [history[channel].percentile(16) for channel in range(numchannel)] # mean minus 1x standard deviation
     if metrics_p84 or metrics_iqr:
-        historic['p84']     = np.percentile(history, 84, axis=1) # mean plus 1x standard deviation
+        historic['p84']     = [history[channel].percentile(84) for channel in range(numchannel)] # mean plus 1x standard deviation
     if metrics_p97:
-        historic['p97']     = np.percentile(history, 97, axis=1) # mean plus 2x standard deviation
+        historic['p97']     = [history[channel].percentile(97) for channel in range(numchannel)] # mean plus 2x standard deviation
 
     if metrics_iqr:
         # see https://en.wikipedia.org/wiki/Interquartile_range
-        historic['iqr']     = historic['p84'] - historic['p16']
+        historic['iqr']     = [p84 - p16 for p16, p84 in zip(historic['p16'], historic['p84'])]
 
     if metrics_range:
-        historic['range']   = historic['max'] - historic['min']
+        historic['range']   = [hi - lo for lo, hi in zip(historic['min'], historic['max'])]
     if metrics_std:
-        historic['std']     = np.nanstd(history, axis=1)
+        historic['std']     = [history[channel].std() for channel in range(numchannel)]
 
     if metrics_max_att or metrics_min_att:
         # Attenuated history over time, so to diminish max/min over time
-        # NOTE: There is probably a way to do this without a for-loop:
-        history_att = history
+        historic['min_att'] = []
+        historic['max_att'] = []
         for channel in range(numchannel):
-            history_att[channel, :] = history_att[channel, :] - historic['mean'][channel]
-            history_att[channel, :] = history_att[channel, :] * np.linspace(0, 1, numhistory)
-            history_att[channel, :] = history_att[channel, :] + historic['mean'][channel]
-
-    if metrics_max_att or metrics_min_att:
-        historic['min_att'] = np.nanmin(history_att, axis=1)
-        historic['max_att'] = np.nanmax(history_att, axis=1)
+            history_att = history[channel].get()
+            history_att = (history_att - historic['mean'][channel]) * np.linspace(0, 1, numhistory)[numhistory-len(history_att):] + historic['mean'][channel]
+            historic['min_att'].append(float(np.nanmin(history_att)))
+            historic['max_att'].append(float(np.nanmax(history_att)))
 
+    values = {}
     for operation in list(historic.keys()):
         for channel in range(numchannel):
             key = inputlist[channel] + "." + operation
             val = historic[operation][channel]
-            patch.setvalue(key, val)
+            values[key] = val
             monitor.debug('%s = %g' % (key, val))
 
+    # write all values to Redis at once
+    patch.setvalues(values)
+
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
         print('LOCALS: ' + ', '.join(locals().keys()))
@@ -51,15 +51,6 @@ import EEGsynth
 import FieldTrip
 
 
-# see https://en.wikipedia.org/wiki/Median_absolute_deviation
-def mad(arr, axis=None):
-    if axis==1:
-        val = np.apply_along_axis(mad, 1, arr)
-    else:
-        val = np.nanmedian(np.abs(arr - np.nanmedian(arr)))
-    return val
-
-
 def _setup():
     '''Initialize the module
     This adds a set of global variables
@@ -108,7 +99,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input, name
-    global timeout, hdr_input, start, inputlist, prefix, enable, stepsize, window, numhistory, numchannel, history, historic, begsample, endsample
+    global timeout, hdr_input, start, inputlist, prefix, enable, robust, stepsize, window, numhistory, numchannel, history, historic, begsample, endsample
 
     # this is the timeout for the FieldTrip buffer
     timeout = patch.getfloat('fieldtrip', 'timeout', default=30)
@@ -129,6 +120,7 @@ def _start():
     inputlist   = patch.getint('input', 'channels', multiple=True)
     prefix      = patch.getstring('output', 'prefix')
     enable      = patch.getint('history', 'enable', default=1)
+    robust      = patch.getint('history', 'robust', default=0)          # compute the robust estimators
     stepsize    = patch.getfloat('history', 'stepsize')                 # in seconds
     window      = patch.getfloat('history', 'window')                   # in seconds
 
@@ -136,8 +128,8 @@ def _start():
     numhistory  = int(round(hdr_input.fSample*window))                  # in samples
     numchannel  = len(inputlist)
 
-    # this will contain the full list of historic values
-    history = np.empty((numhistory, numchannel)) * np.NAN
+    # this will contain the historic values of all channels and keep the statistics up to date
+    history = EEGsynth.runningstatistics(numhistory * numchannel, order=robust)
 
     # this will contain the statistics of the historic values
     historic = {}
@@ -160,8 +152,8 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input
-    global timeout, hdr_input, start, inputlist, prefix, enable, stepsize, window, numhistory, numchannel, history, historic, begsample, endsample
-    global prev_enable, dat_input, chanindx, operation, key, val
+    global timeout, hdr_input, start, inputlist, prefix, enable, robust, stepsize, window, numhistory, numchannel, history, historic, begsample, endsample
+    global prev_enable, block, dat_input, chanindx, operation, key, val
 
     # determine the start of the actual processing
     start = time.time()
@@ -187,49 +179,42 @@ def _loop_once():
         time.sleep(patch.getfloat('general', 'delay'))
         return
 
-    while endsample > hdr_input.nSamples-1:
-        # wait until there is enough data
-        time.sleep(patch.getfloat('general', 'delay'))
-        hdr_input = ft_input.getHeader()
-        if hdr_input.nSamples < begsample:
-            raise RuntimeError("buffer reset detected")
-        if (time.time()-start) > timeout:
-            raise RuntimeError("timeout while waiting for data")
-
     monitor.debug("reading samples " + str(begsample) + " to " + str(endsample))
 
+    # wait until there is enough data and read it, this raises a RuntimeError upon a buffer reset
+    block = ft_input.readNext(stepsize, timeout, begsample=begsample)
+    if block is None:
+        raise RuntimeError("timeout while waiting for data")
+
     # get the input data, sample vector and time vector
-    dat_input = ft_input.getData([begsample, endsample]).astype(np.double)
+    dat_input = block[0].astype(np.double)
 
-    # shift the history and insert the most recent data
-    history = np.roll(history, stepsize, axis=0)
+    # insert the most recent data, this replaces the oldest data
     chanindx = np.asarray(inputlist,np.int32)-1
-    history[-stepsize:,] = dat_input[:,chanindx]
+    history.append(dat_input[:,chanindx])
 
     # compute some statistics
-    historic['mean']    = np.nanmean(history.flatten(), axis=0)
-    historic['std']     = np.nanstd(history.flatten(), axis=0)
-    historic['min']     = np.nanmin(history.flatten(), axis=0)
-    historic['max']     = np.nanmax(history.flatten(), axis=0)
+    historic['mean']    = history.mean()
+    historic['std']     = history.std()
+    historic['min']     = history.min()
+    historic['max']     = history.max()
     historic['range']   = historic['max'] - historic['min']
 
-    if False:
+    if robust:
         # use some robust estimators
-        historic['median']  = np.nanmedian(history.flatten(), axis=0)
+        historic['median']  = history.median()
         # see https://en.wikipedia.org/wiki/Median_absolute_deviation
-        historic['mad']     = mad(history.flatten(), axis=0)
+        historic['mad']     = history.mad()
         # for a normal distribution the 16th and 84th percentile correspond to the mean plus-minus one standard deviation
-        historic['p03']     = np.percentile(history.flatten(),  3, axis=0) # mean minus 2x standard deviation
-        historic['p16']     = np.percentile(history.flatten(), 16, axis=0) # mean minus 1x standard deviation
-        historic['p84']     = np.percentile(history.flatten(), 84, axis=0) # mean plus 1x standard deviation
-        historic['p97']     = np.percentile(history.flatten(), 97, axis=0) # mean plus 2x standard deviation
+        historic['p03']     = history.percentile( 3) # mean minus 2x standard deviation
+        historic['p16']     = history.percentile(16) # mean minus 1x standard deviation
+        historic['p84']     = history.percentile(84) # mean plus 1x standard deviation
+        historic['p97']     = history.percentile(97) # mean plus 2x standard deviation
         # see https://en.wikipedia.org/wiki/Interquartile_range
         historic['iqr']     = historic['p84'] - historic['p16']
 
-    for operation in list(historic.keys()):
-        key = prefix + "." + operation
-        val = historic[operation]
-        patch.setvalue(key, val, debug > 1)
+    # write all values to Redis at once
+    patch.setvalues(dict([(prefix + "." + operation, historic[operation]) for operation in historic]))
 
     begsample += stepsize
     endsample += stepsize
@@ -131,8 +131,7 @@ class TriggerThread(threading.Thread):
                             msg = mido.Message('note_on', note=pitch, velocity=0)
                         else:
                             msg = mido.Message('note_on', note=pitch, velocity=0, channel=midichannel)
-                        t = threading.Timer(duration, SendMessage, args=[msg])
-                        t.start()
+                        EEGsynth.getscheduler().enter(duration, SendMessage, args=[msg])
 
 
 def _setup():
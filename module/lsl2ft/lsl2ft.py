@@ -83,7 +83,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, timeout, lsl_name, lsl_type, ft_host, ft_port, ft_output, start, selected, streams, stream, inlet, type, source_id, match, lsl_id, channel_count, channel_format, nominal_srate, samples, blocksize
+    global monitor, timeout, lsl_name, lsl_type, ft_host, ft_port, ft_output, ft_blocksize, ft_latency, ft_writer, start, selected, streams, stream, inlet, type, source_id, match, lsl_id, channel_count, channel_format, nominal_srate, samples, blocksize
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
@@ -149,6 +149,15 @@ def _start():
 
     ft_output.putHeader(channel_count, nominal_srate, FieldTrip.DATATYPE_FLOAT32)
 
+    # the samples can be coalesced and written to the buffer from a background thread
+    ft_blocksize = patch.getint('fieldtrip', 'blocksize')
+    ft_latency = patch.getfloat('fieldtrip', 'latency')
+    if ft_blocksize or ft_latency:
+        ft_writer = FieldTrip.Writer(ft_output, blocksize=ft_blocksize, latency=ft_latency)
+        monitor.info('Writing blocks of %s samples with a latency of %s seconds' % (ft_blocksize, ft_latency))
+    else:
+        ft_writer = ft_output
+
     # this is used for feedback
     samples = 0
     blocksize = 1
@@ -163,15 +172,17 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, timeout, lsl_name, lsl_type, ft_host, ft_port, ft_output, start, selected, streams, stream, inlet, type, source_id, match, lsl_id, channel_count, channel_format, nominal_srate, samples, blocksize
+    global monitor, timeout, lsl_name, lsl_type, ft_host, ft_port, ft_output, ft_blocksize, ft_latency, ft_writer, start, selected, streams, stream, inlet, type, source_id, match, lsl_id, channel_count, channel_format, nominal_srate, samples, blocksize
 
     chunk, timestamps = inlet.pull_chunk()
     if timestamps:
         dat = np.asarray(chunk, dtype=np.float32)
-        ft_output.putData(dat)
+        ft_writer.putData(dat)
         blocksize = dat.shape[0]
         samples += blocksize
         monitor.update('samples', samples)
+        if ft_writer is not ft_output:
+            monitor.update('queue', ft_writer.depth())
     else:
         # wait for a short time before trying again
         # this prevents the polling from clogging the CPU to 100%
@@ -190,7 +201,10 @@ def _loop_forever():
 def _stop():
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
-    global monitor, ft_output
+    global monitor, ft_output, ft_writer
+    if ft_writer is not ft_output:
+        ft_writer.close()
+        monitor.info(str(ft_writer))
     ft_output.disconnect()
     monitor.success('Disconnected from output FieldTrip buffer')
     sys.exit()
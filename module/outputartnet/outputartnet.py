@@ -21,6 +21,7 @@
 
 import configparser
 import argparse
+import numpy as np
 import os
 import redis
 import serial
@@ -82,38 +83,36 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, debug, address, artnet, dmxsize, dmxframe, prevtime
+    global monitor, debug, delay, sync, universes, addresses, address, artnet, dmxmap, i, prevtime, deadline
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general','debug'))
 
     # get the options from the configuration file
     debug = patch.getint('general','debug')
+    delay = patch.getfloat('general', 'delay')
+    sync = patch.getint('artnet', 'sync', default=0)
 
-    # prepare the data for a single universe
-    address = [0, 0, patch.getint('artnet','universe')]
+    # the 15-bit universe number is split into net, subnet and universe
+    universes = patch.getint('artnet', 'universe', multiple=True)
+    addresses = [[(universe >> 8) & 0x7F, (universe >> 4) & 0x0F, universe & 0x0F] for universe in universes]
     artnet = ArtNet.ArtNet(ip=patch.getstring('artnet','broadcast'), port=patch.getint('artnet','port'))
 
-    # determine the size of the universe
-    dmxsize = 0
-    chanlist, chanvals = list(map(list, list(zip(*config.items('input')))))
-    for chanindx in range(0, 512):
-        chanstr = "channel%03d" % (chanindx + 1)
-        if chanstr in chanlist:
-            # the last channel determines the size
-            dmxsize = chanindx + 1
-
+    # the channels are numbered continuously over the universes, each universe has 512 channels
     # FIXME the artnet code fails if the size is smaller than 512
-    dmxsize = 512
-    monitor.info("universe size = %d" % dmxsize)
+    dmxmap = EEGsynth.channelmap(patch, 'input', nuniverses=len(universes), universesize=512, scale=255, offset=0)
+    monitor.info("%d channels in %d universes" % (len(dmxmap.channels), len(universes)))
 
-    # make an empty frame
-    dmxframe = [0] * dmxsize
     # blank out
-    artnet.broadcastDMX(dmxframe, address)
+    for i, address in enumerate(addresses):
+        artnet.broadcastDMX(dmxmap.universe(i), address)
+    if sync:
+        artnet.broadcastSync()
 
     # keep a timer to send a packet every now and then
     prevtime = time.time()
+    # the frames are sent at a fixed rate
+    deadline = time.monotonic()
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -125,44 +124,29 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, debug, address, artnet, dmxsize, dmxframe, prevtime
-    global update, chanindx, chanstr, chanval, scale, offset
-
-    update = False
+    global monitor, debug, delay, sync, universes, addresses, address, artnet, dmxmap, i, prevtime, deadline
+    global changed, chanindx, maintenance, update
 
-    # loop over the control values, these are 1-offset in the ini file
-    for chanindx in range(0, dmxsize):
-        chanstr = "channel%03d" % (chanindx + 1)
-        # this returns None when the channel is not present
-        chanval = patch.getfloat('input', chanstr)
-
-        if chanval == None:
-            # the value is not present in Redis, skip it
-            continue
-
-        # the scale and offset options are channel specific
-        scale = patch.getfloat('scale', chanstr, default=255)
-        offset = patch.getfloat('offset', chanstr, default=0)
-        # apply the scale and offset
-        chanval = EEGsynth.rescale(chanval, slope=scale, offset=offset)
-        # ensure that it is within limits
-        chanval = EEGsynth.limit(chanval, lo=0, hi=255)
-        chanval = int(chanval)
-
-        # only update if the value has changed
-        if dmxframe[chanindx] != chanval:
-            monitor.info("DMX channel%03d = %g" % (chanindx, chanval))
-            dmxframe[chanindx] = chanval
-            update = True
+    # get all control values at once and apply the channel specific scale and offset
+    changed = dmxmap.update()
+    for chanindx in changed:
+        monitor.info("DMX channel%03d = %g" % (chanindx + 1, dmxmap.frame[chanindx]))
 
-    if update:
-        artnet.broadcastDMX(dmxframe, address)
+    # send a maintenance frame every 0.5 seconds
+    maintenance = (time.time() - prevtime) > 0.5
+    if maintenance:
         prevtime = time.time()
 
-    elif (time.time() - prevtime) > 0.5:
-        # send a maintenance frame every 0.5 seconds
-        artnet.broadcastDMX(dmxframe, address)
-        prevtime = time.time()
+    # only send the universes that have changed
+    update = False
+    for i, address in enumerate(addresses):
+        if maintenance or np.any(changed // dmxmap.universesize == i):
+            artnet.broadcastDMX(dmxmap.universe(i), address)
+            update = True
+
+    if update and sync:
+        # the nodes output the data of all universes at the same time
+        artnet.broadcastSync()
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -172,32 +156,31 @@ def _loop_once():
 def _loop_forever():
     '''Run the main loop forever
     '''
-    global monitor, patch
+    global monitor, patch, delay, deadline
     while True:
         monitor.loop()
         _loop_once()
-        time.sleep(patch.getfloat('general', 'delay'))
+        # sleep until the next frame, the deadline does not depend on how long the loop took
+        deadline += delay
+        if deadline < time.monotonic() - delay:
+            # the loop is running behind, do not try to catch up
+            deadline = time.monotonic()
+        time.sleep(max(0, deadline - time.monotonic()))
 
 
 def _stop():
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
-    global monitor, artnet
+    global monitor, artnet, addresses, sync, dmxmap
     monitor.success("Closing module...")
     # blank out
-    dmxframe = [0] * 512
-    artnet.broadcastDMX(dmxframe,address)
-    time.sleep(0.1) # this seems to take some time
-    artnet.broadcastDMX(dmxframe,address)
-    time.sleep(0.1) # this seems to take some time
-    artnet.broadcastDMX(dmxframe,address)
-    time.sleep(0.1) # this seems to take some time
-    artnet.broadcastDMX(dmxframe,address)
-    time.sleep(0.1) # this seems to take some time
-    artnet.broadcastDMX(dmxframe,address)
-    time.sleep(0.1) # this seems to take some time
-    artnet.broadcastDMX(dmxframe,address)
-    time.sleep(0.1) # this seems to take some time
+    dmxmap.frame[:] = 0
+    for repeat in range(6):
+        for i, address in enumerate(addresses):
+            artnet.broadcastDMX(dmxmap.universe(i), address)
+        if sync:
+            artnet.broadcastSync()
+        time.sleep(0.1) # this seems to take some time
     artnet.close()
     sys.exit()
 
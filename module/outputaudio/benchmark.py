@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Simulation of the drift correction in the outputaudio module
+#
+# This software is part of the EEGsynth project, see <https://github.com/eegsynth/eegsynth>.
+#
+# Copyright (C) 2020 EEGsynth project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import numpy as np
+import os
+import sys
+
+path = os.path.split(os.path.abspath(__file__))[0]
+
+# eegsynth/lib contains shared modules
+sys.path.insert(0, os.path.join(path, '../../lib'))
+from outputaudio import JitterBuffer
+
+
+def simulate(inputrate, outputrate, window, latency, blocksize, lrate, drift, jitter, duration):
+    # the blocks are written once per window according to the input clock, plus some random delay
+    # the audio card reads the blocks according to its own clock, which runs faster by the drift
+    window = int(window * inputrate)
+    latency = int(latency * inputrate)
+    buffer = JitterBuffer(latency + 4 * window, 1, inputrate / outputrate, max(latency, 1), lrate, blocksize)
+    dat = np.zeros((window, 1), dtype=np.float32)
+    period = blocksize / (outputrate * (1 + drift))
+    nwrite = int(duration * inputrate / window)
+    writes = np.arange(nwrite) * window / inputrate + np.random.uniform(0, jitter, nwrite)
+    writes.sort()
+    correction = np.zeros(nwrite)
+    ratio = np.zeros(nwrite)
+    fill = np.zeros(nwrite)
+    nread = 0
+    for i, t in enumerate(writes):
+        while nread * period < t:
+            buffer.read(blocksize)
+            nread += 1
+        fill[i] = buffer.fill()
+        buffer.write(dat)
+        correction[i] = buffer.correction
+        ratio[i] = buffer.ratio
+    return correction, ratio, fill / inputrate, buffer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--inputrate", type=float, default=250., help="sampling rate of the signal in Hz")
+    parser.add_argument("--outputrate", type=float, default=44100., help="sampling rate of the audio card in Hz")
+    parser.add_argument("--window", type=float, default=1., help="block length in seconds")
+    parser.add_argument("--latency", type=float, nargs='+', default=[0.25, 1., 2.], help="target latency in seconds")
+    parser.add_argument("--blocksize", type=int, default=1024, help="number of frames per audio callback")
+    parser.add_argument("--lrate", type=float, default=0.05, help="learning rate of the drift correction")
+    parser.add_argument("--drift", type=float, nargs='+', default=[0, 0.0001, 0.001, -0.001], help="relative drift of the audio clock")
+    parser.add_argument("--jitter", type=float, nargs='+', default=[0, 0.05], help="maximal delay of the writes in seconds")
+    parser.add_argument("--duration", type=float, default=1200., help="simulated time in seconds")
+    args = parser.parse_args()
+
+    # the jitter is random, but the checks should give the same outcome every time
+    np.random.seed(0)
+
+    print('%8s %8s %8s %12s %12s %12s %12s %12s %10s' % ('latency', 'drift', 'jitter', 'expected', 'ratio', 'mean', 'min', 'max', 'underruns'))
+    for latency in args.latency:
+        for drift in args.drift:
+            for jitter in args.jitter:
+                correction, ratio, fill, buffer = simulate(args.inputrate, args.outputrate, args.window, latency, args.blocksize, args.lrate, drift, jitter, args.duration)
+                # the second half of the simulation should have settled
+                settled = correction[len(correction) // 2:]
+                estimated = np.mean(ratio[len(ratio) // 2:])
+                expected = 1 / (1 + drift)
+                print('%8g %8g %8g %12.6f %12.6f %12.6f %12.6f %12.6f %10d' % (latency, drift, jitter, expected, estimated, settled.mean(), settled.min(), settled.max(), buffer.underruns))
+                if abs(estimated / expected - 1) > 1e-4 or abs(settled.mean() / expected - 1) > 1e-4:
+                    raise RuntimeError('the drift correction does not converge')
+                # the callbacks and the jitter make the measured latency fluctuate, which the correction follows a little
+                if np.max(np.abs(settled / expected - 1)) > (0.001 if jitter == 0 else 0.003):
+                    raise RuntimeError('the drift correction fluctuates too much')
+                if jitter == 0 and abs(np.mean(fill[len(fill) // 2:]) - latency) > args.blocksize / args.outputrate + 1 / args.inputrate:
+                    raise RuntimeError('the latency does not converge to the target')
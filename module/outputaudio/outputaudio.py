@@ -27,7 +27,6 @@ import redis
 import sys
 import time
 import signal
-import threading
 import pyaudio
 
 if hasattr(sys, 'frozen'):
@@ -53,60 +52,144 @@ import EEGsynth
 import FieldTrip
 
 
-def callback(in_data, frame_count, time_info, status):
-    global stack, window, firstsample, stretch, inputrate, outputrate, outputblock, prevoutput, b, a, zi
-
-    now = time.time()
-    duration = now - prevoutput
-    prevoutput = now
-    if outputblock > 5 and duration > 0:
-        old = outputrate
-        new = frame_count / duration
-        if old/new > 0.1 or old/new < 10:
-            outputrate = (1 - lrate) * old + lrate * new
-
-    # estimate the required stretch between input and output rate
-    old = stretch
-    new = outputrate / inputrate
-    stretch = (1 - lrate) * old + lrate * new
-
-    # linearly interpolate the selection of samples, i.e. stretch or compress the time axis when needed
-    begsample = firstsample
-    endsample = round(firstsample + frame_count / stretch)
-    selection = np.linspace(begsample, endsample, frame_count).astype(np.int32)
-
-    # remember where to continue the next time
-    firstsample = (endsample + 1) % window
-
-    with lock:
-        lenstack = len(stack)
-        if endsample > (window - 1) and lenstack>1:
-            # the selection passes the boundary, concatenate the first two blocks
-            dat = np.append(stack[0], stack[1], axis=0)
-        elif lenstack>0:
-            # the selection can be made in the first block
-            dat = stack[0]
-
-    # select the samples that will be written to the audio card
-    try:
-        dat = dat[selection]
-    except:
-        dat = np.zeros((frame_count,1), dtype=float)
+class JitterBuffer():
+    """Ring buffer between the loop that reads the data from the FieldTrip buffer and the
+    audio callback. There is a single writer and a single reader, each of which only updates
+    its own position, hence no lock is needed. All arrays are preallocated, so that the
+    callback does not allocate memory.
+
+    The reader resamples the signal with cubic interpolation at a fractional step. The step
+    follows from the input and output sampling rate, and is corrected for the drift between
+    the two clocks. The correction is estimated from how much data is left in the buffer just
+    before a new block is written, which should be equal to the target latency. The ratio
+    between the two clocks is estimated slowly from the accumulated deviation (the integral
+    term), and a small proportional term brings the buffer back to the target. The gains are
+    chosen such that the loop is critically damped, irrespective of the block length.
+    """
+
+    def __init__(self, capacity, nchans, step, target, lrate, frames=1024):
+        self.capacity = int(capacity)
+        self.nchans = int(nchans)
+        self.buffer = np.zeros((self.capacity, self.nchans), dtype=np.float32)
+        self.step = step            # the nominal number of input samples per output sample
+        self.target = target        # the number of input samples that should remain just before writing
+        self.lrate = lrate          # how fast the correction adapts (0=never, 1=immediate)
+        self.ratio = 1.             # the estimated ratio between the two clocks
+        self.correction = 1.
+        self.written = 0            # the number of samples that were written, only updated by the writer
+        self.position = 1.          # the fractional position of the reader, only updated by the reader
+        self.playing = False
+        self.underruns = 0
+        self.overruns = 0
+        self.callbacks = 0
+        self.elapsed = 0.           # the total time spent in the callback
+        self.maxelapsed = 0.
+        self.allocate(frames)
+
+    def allocate(self, frames):
+        self.ramp = np.arange(frames, dtype=np.double)
+        self.pos = np.zeros(frames, dtype=np.double)
+        self.floor = np.zeros(frames, dtype=np.double)
+        self.frac = np.zeros((frames, 1), dtype=np.float32)
+        self.index = np.zeros(frames, dtype=np.intp)
+        self.points = np.zeros((4, frames, self.nchans), dtype=np.float32)
+        self.work = np.zeros((2, frames, self.nchans), dtype=np.float32)
+        self.output = np.zeros((frames, self.nchans), dtype=np.float32)
+
+    def fill(self):
+        return self.written - self.position
+
+    def write(self, dat):
+        nsamples = dat.shape[0]
+        fill = self.fill()
+        if fill + nsamples > self.capacity - 2:
+            # there is no space, the data is dropped
+            self.overruns += 1
+            return
+        if self.playing:
+            # the buffer is least filled just before the new data is written
+            # the deviation is relative to the block length, which makes the dynamics independent of it
+            error = (fill - self.target) / nsamples
+            self.ratio *= 1 + self.lrate ** 2 / 4 * error
+            self.ratio = min(max(self.ratio, 0.5), 2.)
+            self.correction = self.ratio * (1 + self.lrate * error)
+            self.correction = min(max(self.correction, 0.5), 2.)
+        first = self.written % self.capacity
+        count = min(nsamples, self.capacity - first)
+        self.buffer[first:first + count] = dat[:count]
+        self.buffer[:nsamples - count] = dat[count:]
+        self.written += nsamples
+        if not self.playing and fill + nsamples >= self.target + nsamples:
+            # there is enough data to start reading
+            self.playing = True
+
+    def read(self, frames):
+        start = time.perf_counter()
+        if frames > len(self.ramp):
+            # this only happens if the audio card changes the block size
+            self.allocate(frames)
+        output = self.output[:frames]
+        step = self.step * self.correction
+
+        if not self.playing:
+            output.fill(0)
+        elif self.position + step * (frames - 1) + 2 >= self.written:
+            # there is not enough data, wait until the buffer has been filled again
+            self.underruns += 1
+            self.playing = False
+            output.fill(0)
+        else:
+            pos = self.pos[:frames]
+            floor = self.floor[:frames]
+            frac = self.frac[:frames, 0]
+            index = self.index[:frames]
+            p0, p1, p2, p3 = self.points[:, :frames]
+            a, b = self.work[:, :frames]
+
+            np.multiply(self.ramp[:frames], step, out=pos)
+            pos += self.position
+            np.floor(pos, out=floor)
+            np.subtract(pos, floor, out=frac, casting='unsafe')
+            # get the four samples around each position
+            for k, p in enumerate((p0, p1, p2, p3)):
+                np.add(floor, k - 1, out=pos)
+                np.mod(pos, self.capacity, out=pos)
+                np.copyto(index, pos, casting='unsafe')
+                np.take(self.buffer, index, axis=0, out=p)
+
+            # Catmull-Rom interpolation, y = p1 + t/2 * ((p2-p0) + t * ((2p0-5p1+4p2-p3) + t * (3(p1-p2)+p3-p0)))
+            t = self.frac[:frames]
+            np.subtract(p1, p2, out=a)
+            a *= 3
+            a += p3
+            a -= p0
+            a *= t
+            np.multiply(p0, 2, out=b)
+            a += b
+            np.multiply(p1, 5, out=b)
+            a -= b
+            np.multiply(p2, 4, out=b)
+            a += b
+            a -= p3
+            a *= t
+            np.subtract(p2, p0, out=b)
+            a += b
+            a *= t
+            a *= 0.5
+            np.add(a, p1, out=output)
+            self.position += step * frames
+
+        elapsed = time.perf_counter() - start
+        self.callbacks += 1
+        self.elapsed += elapsed
+        self.maxelapsed = max(self.maxelapsed, elapsed)
+        return output
 
-    if endsample > window:
-        # it is time to remove data from the stack
-        with lock:
-            stack = stack[1:]       # remove the first block
-
-    try:
-        # this is for Python 2
-        buf = np.getbuffer(dat)
-    except:
-        # this is for Python 3
-        buf = dat.tobytes()
-    outputblock += 1
 
-    return buf, pyaudio.paContinue
+def callback(in_data, frame_count, time_info, status):
+    global jitter
+    # this is called by PortAudio, it should only take the data from the preallocated buffer
+    return jitter.read(frame_count).tobytes(), pyaudio.paContinue
 
 
 def _setup():
@@ -157,7 +240,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input, name
-    global timeout, hdr_input, start, device, window, lrate, scaling_method, scaling, outputrate, scale_scaling, offset_scaling, nchans, inputrate, p, info, i, devinfo, lock, stack, firstsample, stretch, inputblock, outputblock, previnput, prevoutput, stream, begsample, endsample
+    global timeout, hdr_input, start, device, window, latency, blocksize, lrate, scaling_method, scaling, outputrate, scale_scaling, offset_scaling, nchans, inputrate, prefix, p, info, i, devinfo, jitter, stream, begsample, endsample
 
     # this is the timeout for the FieldTrip buffer
     timeout = patch.getfloat('fieldtrip', 'timeout', default=30)
@@ -176,11 +259,15 @@ def _start():
     monitor.debug("buffer rate = " + str(hdr_input.fSample))
 
     # get the options from the configuration file
-    device  = patch.getint('audio', 'device')
-    window  = patch.getfloat('audio', 'window', default=1)   # in seconds
-    lrate   = patch.getfloat('clock', 'learning_rate', default=0.05)
+    device    = patch.getint('audio', 'device')
+    window    = patch.getfloat('audio', 'window', default=1)            # in seconds
+    latency   = patch.getfloat('audio', 'latency', default=window)      # in seconds
+    blocksize = patch.getint('audio', 'blocksize', default=1024)        # in samples
+    lrate     = patch.getfloat('clock', 'learning_rate', default=0.05)
+    prefix    = patch.getstring('output', 'prefix')
 
     window      = int(window * hdr_input.fSample)               # in samples
+    latency     = int(latency * hdr_input.fSample)              # in samples
     nchans      = hdr_input.nChannels                           # both for input as for output
     inputrate   = hdr_input.fSample
 
@@ -211,24 +298,15 @@ def _start():
     monitor.info(devinfo)
     monitor.info('------------------------------------------------------------------')
 
-    # this is to prevent concurrency problems
-    lock = threading.Lock()
-
-    stack = []
-    firstsample = 0
-    stretch = outputrate / inputrate
-
-    inputblock = 0
-    outputblock = 0
-
-    previnput = time.time()
-    prevoutput = time.time()
+    # the buffer is large enough for the latency and a few blocks, the audio is resampled from the input to the output rate
+    jitter = JitterBuffer(latency + 4 * window, nchans, inputrate / outputrate, max(latency, 1), lrate, blocksize)
 
     stream = p.open(format=pyaudio.paFloat32,
                     channels=nchans,
                     rate=outputrate,
                     output=True,
                     output_device_index=device,
+                    frames_per_buffer=blocksize,
                     stream_callback=callback)
 
     # it should not start playing immediately
@@ -254,8 +332,8 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input
-    global timeout, hdr_input, start, device, window, lrate, scaling_method, scaling, outputrate, scale_scaling, offset_scaling, nchans, inputrate, p, info, i, devinfo, lock, stack, firstsample, stretch, inputblock, outputblock, previnput, prevoutput, stream, begsample, endsample
-    global dat, now, old, new, duration
+    global timeout, hdr_input, start, device, window, latency, blocksize, lrate, scaling_method, scaling, outputrate, scale_scaling, offset_scaling, nchans, inputrate, prefix, p, info, i, devinfo, jitter, stream, begsample, endsample
+    global dat, duration, counters
 
     # measure the time that it takes
     start = time.time()
@@ -289,35 +367,36 @@ def _loop_once():
     elif scaling_method == 'db':
         dat *= np.power(10, scaling/20)
 
-    with lock:
-        stack.append(dat)
+    jitter.write(dat)
 
-    if len(stack) > 2:
+    if jitter.playing and not stream.is_active():
         # there is enough data to start the output stream
         stream.start_stream()
 
-    now = time.time()
-    duration = now - previnput
-    previnput = now
-    if inputblock > 3 and duration > 0:
-        old = inputrate
-        new = window / duration
-        if old/new > 0.1 or old/new < 10:
-            inputrate = (1 - lrate) * old + lrate * new
-
+    duration = time.time() - start
     monitor.info("read " + str(endsample-begsample+1) + " samples from " + str(begsample) + " to " + str(endsample) + " in " + str(duration))
 
-    monitor.update("inputrate", int(inputrate))
-    monitor.update("outputrate", int(outputrate))
-    monitor.update("stretch", stretch)
-    monitor.update("len(stack)", len(stack))
+    counters = {
+        'underruns':  jitter.underruns,
+        'overruns':   jitter.overruns,
+        'correction': jitter.correction,
+        'ratio':      jitter.ratio,
+        'latency':    jitter.fill() / inputrate,                             # in seconds
+        'callback':   1000 * jitter.elapsed / max(jitter.callbacks, 1),     # average, in milliseconds
+        'maxcallback': 1000 * jitter.maxelapsed,                            # in milliseconds
+        }
+    monitor.update("underruns", jitter.underruns)
+    monitor.update("overruns", jitter.overruns)
+    monitor.update("correction", round(jitter.correction, 4))
+    monitor.debug(counters)
+    if prefix:
+        patch.setvalues(dict([("%s.%s" % (prefix, key), val) for key, val in counters.items()]))
 
     if np.min(dat)<-1 or np.max(dat)>1:
         monitor.warning('WARNING: signal exceeds [-1,+1] range, the audio will clip')
 
     begsample += window
     endsample += window
-    inputblock += 1
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -21,6 +21,7 @@
 
 import configparser
 import argparse
+import numpy as np
 import os
 import redis
 import sys
@@ -55,9 +56,16 @@ def sendframe(s, dmxframe):
     # See http://agreeabledisagreements.blogspot.nl/2012/10/a-beginners-guide-to-dmx512-in-python.html
     # See https://www.enttec.com/docs/dmx_usb_pro_api_spec.pdf
     # See https://github.com/itsb/DmxPy
-    packet = [0x7E, 0x06, ((len(dmxframe) + 1) >> 0) & 0xFF, ((len(dmxframe) + 1) >> 8) & 0xFF, 0x00] + dmxframe + [0xE7]
+    global packets
+    # the packet is constructed once for each size, only the data is copied in
+    n = len(dmxframe)
+    if n not in packets:
+        packet = bytearray([0x7E, 0x06, ((n + 1) >> 0) & 0xFF, ((n + 1) >> 8) & 0xFF, 0x00] + [0] * n + [0xE7])
+        packets[n] = (packet, memoryview(packet)[5:5 + n])
+    packet, data = packets[n]
+    data[:] = np.asarray(dmxframe, dtype=np.uint8)
     monitor.debug(packet)
-    s.write(bytearray(packet))
+    s.write(packet)
 
 
 def _setup():
@@ -92,7 +100,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, debug, serialdevice, s, dmxsize, chanlist, chanvals, chanindx, chanstr, dmxframe, prevtime, START_VAL, END_VAL, TX_DMX_PACKET, FRAME_PAD
+    global monitor, debug, serialdevice, s, dmxmap, dmxsize, packets, prevtime, delay, deadline
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
@@ -111,26 +119,22 @@ def _start():
     except:
         raise RuntimeError("cannot connect to serial port")
 
-    # determine the size of the universe
-    dmxsize = 0
-    chanlist, chanvals = list(map(list, list(zip(*config.items('input')))))
-    for chanindx in range(0, 512):
-        chanstr = "channel%03d" % (chanindx + 1)
-        if chanstr in chanlist:
-            # the last channel determines the size
-            dmxsize = chanindx + 1
+    # the channels that are specified determine the size of the universe
+    dmxmap = EEGsynth.channelmap(patch, 'input', nuniverses=1, universesize=512, scale=255, offset=0)
 
     # my fixture won't work if the frame size is too small
-    dmxsize = max(dmxsize, 16)
+    dmxsize = max(dmxmap.size, 16)
     monitor.info("universe size = %d" % dmxsize)
 
-    # make an empty frame
-    dmxframe = [0] * dmxsize
     # blank out
-    sendframe(s, dmxframe)
+    packets = {}
+    sendframe(s, dmxmap.frame[:dmxsize])
 
     # keep a timer to send a packet every now and then
     prevtime = time.time()
+    # the frames are sent at a fixed rate
+    delay = patch.getfloat('general', 'delay')
+    deadline = time.monotonic()
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -142,43 +146,21 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, debug, serialdevice, s, dmxsize, chanlist, chanvals, chanindx, chanstr, dmxframe, prevtime
-    global update, chanval, scale, offset
-
-    update = False
-
-    # loop over the control values, these are 1-offset in the ini file
-    for chanindx in range(0, dmxsize):
-        chanstr = "channel%03d" % (chanindx + 1)
-        # this returns None when the channel is not present
-        chanval = patch.getfloat('input', chanstr)
-
-        if chanval == None:
-            # the value is not present in Redis, skip it
-            continue
-
-        # the scale and offset options are channel specific
-        scale = patch.getfloat('scale', chanstr, default=255)
-        offset = patch.getfloat('offset', chanstr, default=0)
-        # apply the scale and offset
-        chanval = EEGsynth.rescale(chanval, slope=scale, offset=offset)
-        # ensure that it is within limits
-        chanval = EEGsynth.limit(chanval, lo=0, hi=255)
-        chanval = int(chanval)
-
-        # only update if the value has changed
-        if dmxframe[chanindx] != chanval:
-            monitor.info("DMX channel%03d = %g" % (chanindx, chanval))
-            dmxframe[chanindx] = chanval
-            update = True
-
-    if update:
-        sendframe(s, dmxframe)
+    global monitor, debug, serialdevice, s, dmxmap, dmxsize, packets, prevtime, delay, deadline
+    global changed, chanindx
+
+    # get all control values at once and apply the channel specific scale and offset
+    changed = dmxmap.update()
+    for chanindx in changed:
+        monitor.info("DMX channel%03d = %g" % (chanindx + 1, dmxmap.frame[chanindx]))
+
+    if len(changed):
+        sendframe(s, dmxmap.frame[:dmxsize])
         prevtime = time.time()
 
     elif (time.time() - prevtime) > 0.5:
         # send a maintenance frame every 0.5 seconds
-        sendframe(s, dmxframe)
+        sendframe(s, dmxmap.frame[:dmxsize])
         prevtime = time.time()
 
     # there should not be any local variables in this function, they should all be global
@@ -189,11 +171,16 @@ def _loop_once():
 def _loop_forever():
     '''Run the main loop forever
     '''
-    global monitor, patch
+    global monitor, patch, delay, deadline
     while True:
         monitor.loop()
         _loop_once()
-        time.sleep(patch.getfloat('general', 'delay'))
+        # sleep until the next frame, the deadline does not depend on how long the loop took
+        deadline += delay
+        if deadline < time.monotonic() - delay:
+            # the loop is running behind, do not try to catch up
+            deadline = time.monotonic()
+        time.sleep(max(0, deadline - time.monotonic()))
 
 
 def _stop():
@@ -202,8 +189,7 @@ def _stop():
     global monitor, s
     monitor.success("Closing module...")
     # blank out everything
-    dmxframe = [0] * 512
-    sendframe(s, dmxframe)
+    sendframe(s, np.zeros(512, dtype=np.uint8))
     sys.exit()
 
 
@@ -61,44 +61,22 @@ def SetGPIO(gpio, val=1):
         monitor.debug(str(gpio) + " " + str(pin[gpio]) + " " + str(val))
 
 
-class TriggerThread(threading.Thread):
-    def __init__(self, redischannel, gpio, duration):
-        threading.Thread.__init__(self)
-        self.redischannel = redischannel
-        self.gpio = gpio
-        self.duration = duration
-        self.running = True
-
-    def stop(self):
-        self.running = False
-
-    def run(self):
-        pubsub = r.pubsub()
-        # this message unblocks the Redis listen command
-        pubsub.subscribe('OUTPUTGPIO_UNBLOCK')
-        # this message triggers the event
-        pubsub.subscribe(self.redischannel)
-        while self.running:
-            for item in pubsub.listen():
-                if not self.running or not item['type'] == 'message':
-                    break
-                if item['channel'] == self.redischannel:
-                    # the scale and offset options are channel specific and can be changed on the fly
-                    scale = patch.getfloat('scale', self.gpio, default=100)
-                    offset = patch.getfloat('offset', self.gpio, default=0)
-                    # switch to the PWM value specified in the event
-                    val = float(item['data'])
-                    val = EEGsynth.rescale(val, slope=scale, offset=offset)
-                    val = int(val)
-                    SetGPIO(self.gpio, val)
-                    if self.duration != None:
-                        # schedule a timer to switch it off after the specified duration
-                        duration = patch.getfloat('duration', self.gpio)
-                        duration = EEGsynth.rescale(duration, slope=scale_duration, offset=offset_duration)
-                        # some minimal time is needed for the delay
-                        duration = EEGsynth.limit(duration, 0.05, float('Inf'))
-                        t = threading.Timer(duration, SetGPIO, args=[self.gpio, 0])
-                        t.start()
+def HandleTrigger(item, gpio, duration):
+    # the scale and offset options are channel specific and can be changed on the fly
+    scale = patch.getfloat('scale', gpio, default=100)
+    offset = patch.getfloat('offset', gpio, default=0)
+    # switch to the PWM value specified in the event
+    val = float(item['data'])
+    val = EEGsynth.rescale(val, slope=scale, offset=offset)
+    val = int(val)
+    SetGPIO(gpio, val)
+    if duration != None:
+        # schedule to switch it off after the specified duration
+        duration = patch.getfloat('duration', gpio)
+        duration = EEGsynth.rescale(duration, slope=scale_duration, offset=offset_duration)
+        # some minimal time is needed for the delay
+        duration = EEGsynth.limit(duration, 0.05, float('Inf'))
+        EEGsynth.getscheduler().enter(duration, SetGPIO, args=[gpio, 0])
 
 
 def _setup():
@@ -181,17 +159,16 @@ def _start():
         # control values are only relevant when different from the previous value
         previous_val[gpio] = None
 
-    # create the threads that deal with the triggers
-    trigger = []
+    # a single dispatcher deals with the messages for all triggers
+    trigger = EEGsynth.dispatcher(r)
     for gpio, channel in config.items('trigger'):
         wiringpi.pinMode(pin[gpio], 1)
         duration = patch.getstring('duration', gpio)
-        trigger.append(TriggerThread(channel, gpio, duration))
+        trigger.subscribe(channel, HandleTrigger, args=(gpio, duration))
         monitor.info("trigger " + channel + " " + gpio)
 
-    # start the thread for each of the triggers
-    for thread in trigger:
-        thread.start()
+    # start receiving the messages for all triggers
+    trigger.start()
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -241,11 +218,7 @@ def _stop():
     '''
     global monitor, trigger, r
     monitor.success('Closing threads')
-    for thread in trigger:
-        thread.stop()
-    r.publish('OUTPUTGPIO_UNBLOCK', 1)
-    for thread in trigger:
-        thread.join()
+    trigger.stop()
     sys.exit()
 
 
@@ -63,7 +63,7 @@ def UpdateParameters():
 
 
 def SetNoteOn(note, velocity):
-    global previous_note
+    global previous_note, noteoff
     if monophonic and previous_note != None:
         SetNoteOff(previous_note, 0)
     # construct the MIDI message
@@ -74,14 +74,21 @@ def SetNoteOn(note, velocity):
     # send the MIDI message
     previous_note = note
     outputport.send(msg)
-    # schedule a timer to switch it off after the specified duration
+    # a note that is played again should not be switched off by the previous one
+    event = noteoff.pop(note, None)
+    if event:
+        scheduler.cancel(event)
+    # schedule it to be switched off after the specified duration
     if duration_note != None:
-        t = threading.Timer(duration_note, SetNoteOff, args=[note, 0])
-        t.start()
+        noteoff[note] = scheduler.enter(duration_note, SetNoteOff, args=[note, 0])
 
 
 def SetNoteOff(note, velocity):
-    global previous_note
+    global previous_note, noteoff
+    # the note does not have to be switched off again
+    event = noteoff.pop(note, None)
+    if event:
+        scheduler.cancel(event)
     if monophonic and previous_note != note:
         # do not switch off notes other than the previous one
         return
@@ -152,33 +159,16 @@ def sendMidi(name, code, val):
     outputport.send(msg)
 
 
-class TriggerThread(threading.Thread):
-    def __init__(self, redischannel, name, code):
-        threading.Thread.__init__(self)
-        self.redischannel = redischannel
-        self.name = name
-        self.code = code
-        self.running = True
-    def stop(self):
-        self.running = False
-    def run(self):
-        pubsub = r.pubsub()
-        pubsub.subscribe('OUTPUTMIDI_UNBLOCK')  # this message unblocks the redis listen command
-        pubsub.subscribe(self.redischannel)     # this message contains the value of interest
-        while self.running:
-            for item in pubsub.listen():
-                if not self.running or not item['type'] == 'message':
-                    break
-                if item['channel']==self.redischannel:
-                    monitor.trace(item)
-                    # map the Redis values to MIDI values
-                    val = float(item['data'])
-                    # the scale and offset options are channel specific and can be changed on the fly
-                    scale = patch.getfloat('scale', self.name, default=127)
-                    offset = patch.getfloat('offset', self.name, default=0)
-                    val = EEGsynth.rescale(val, slope=scale, offset=offset)
-                    with lock:
-                        sendMidi(self.name, self.code, val)
+def HandleTrigger(item, name, code):
+    monitor.trace(item)
+    # map the Redis values to MIDI values
+    val = float(item['data'])
+    # the scale and offset options are channel specific and can be changed on the fly
+    scale = patch.getfloat('scale', name, default=127)
+    offset = patch.getfloat('offset', name, default=0)
+    val = EEGsynth.rescale(val, slope=scale, offset=offset)
+    with lock:
+        sendMidi(name, code, val)
 
 
 def _setup():
@@ -213,7 +203,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global debug, mididevice, port, previous_note, trigger_name, trigger_code, code, trigger, this, thread, control_name, control_code, previous_val, duration_note, lock, midichannel, monitor, monophonic, offset_duration, offset_velocity, outputport, scale_duration, scale_velocity, velocity_note
+    global debug, mididevice, port, previous_note, trigger_name, trigger_code, code, trigger, control_name, control_code, previous_val, duration_note, lock, scheduler, noteoff, midichannel, monitor, monophonic, offset_duration, offset_velocity, outputport, scale_duration, scale_velocity, velocity_note
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general','debug'))
@@ -251,6 +241,10 @@ def _start():
     # this is to prevent two messages from being sent at the same time
     lock = threading.Lock()
 
+    # the notes are switched off from a single thread, the pending ones are kept for each note
+    scheduler = EEGsynth.getscheduler()
+    noteoff = {}
+
     previous_note = None
     velocity_note = None
     duration_note = None
@@ -272,17 +266,14 @@ def _start():
         trigger_code.append(None)
 
     # each of the Redis messages is mapped onto a different MIDI message
-    trigger = []
+    trigger = EEGsynth.dispatcher(r)
     for name, code in zip(trigger_name, trigger_code):
         if config.has_option('trigger', name):
-            # start the background thread that deals with this note
-            this = TriggerThread(patch.getstring('trigger', name), name, code)
-            trigger.append(this)
+            trigger.subscribe(patch.getstring('trigger', name), HandleTrigger, args=(name, code))
             monitor.debug(name + ' trigger configured')
 
-    # start the thread for each of the triggers
-    for thread in trigger:
-        thread.start()
+    # start receiving the messages for all triggers
+    trigger.start()
 
     control_name = []
     control_code = []
@@ -312,13 +303,16 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global debug, mididevice, port, previous_note, trigger_name, trigger_code, code, trigger, this, thread, control_name, control_code, previous_val, duration_note, lock, midichannel, monitor, monophonic, offset_duration, offset_velocity, outputport, scale_duration, scale_velocity, velocity_note
+    global debug, mididevice, port, previous_note, trigger_name, trigger_code, code, trigger, control_name, control_code, previous_val, duration_note, lock, scheduler, noteoff, midichannel, monitor, monophonic, offset_duration, offset_velocity, outputport, scale_duration, scale_velocity, velocity_note
 
     UpdateParameters()
 
-    for name, code in zip(control_name, control_code):
+    # get all control values at once, together with the channel specific scale and offset
+    n = len(control_name)
+    control_val = patch.getfloats(['control'] * n + ['scale'] * n + ['offset'] * n, list(control_name) * 3, default=[None] * n + [127] * n + [0] * n)
+
+    for name, code, val, scale, offset in zip(control_name, control_code, control_val[0:n], control_val[n:2*n], control_val[2*n:3*n]):
         # loop over the control values
-        val = patch.getfloat('control', name)
         if val is None:
             continue # it should be skipped when not present in the ini or Redis
         if val==previous_val[name]:
@@ -326,8 +320,6 @@ def _loop_once():
         previous_val[name] = val
 
         # the scale and offset options are channel specific and can be changed on the fly
-        scale = patch.getfloat('scale', name, default=127)
-        offset = patch.getfloat('offset', name, default=0)
         val = EEGsynth.rescale(val, slope=scale, offset=offset)
         with lock:
             sendMidi(name, code, val)
@@ -346,14 +338,11 @@ def _loop_forever():
 def _stop():
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
-    global monitor, trigger, r
+    global monitor, scheduler, trigger, r
 
     monitor.success('Closing threads')
-    for thread in trigger:
-        thread.stop()
-    r.publish('OUTPUTMIDI_UNBLOCK', 1)
-    for thread in trigger:
-        thread.join()
+    trigger.stop()
+    scheduler.stop()
 
 
 if __name__ == '__main__':
@@ -51,37 +51,18 @@ sys.path.insert(0, os.path.join(path, '../../lib'))
 import EEGsynth
 
 
-class TriggerThread(threading.Thread):
-    def __init__(self, redischannel, name, mqtttopic):
-        threading.Thread.__init__(self)
-        self.redischannel = redischannel
-        self.name = name
-        self.mqtttopic = mqtttopic
-        self.running = True
-
-    def stop(self):
-        self.running = False
-
-    def run(self):
-        pubsub = r.pubsub()
-        pubsub.subscribe('OUTPUTMQTT_UNBLOCK')  # this message unblocks the redis listen command
-        pubsub.subscribe(self.redischannel)     # this message contains the value of interest
-        while self.running:
-            for item in pubsub.listen():
-                if not self.running or not item['type'] == 'message':
-                    break
-                if item['channel'] == self.redischannel:
-                    # map the Redis values to MQTT values
-                    val = float(item['data'])
-                    # the scale and offset options are channel specific
-                    scale = patch.getfloat('scale', self.name, default=1)
-                    offset = patch.getfloat('offset', self.name, default=0)
-                    # apply the scale and offset
-                    val = EEGsynth.rescale(val, slope=scale, offset=offset)
-
-                    monitor.update(self.mqtttopic, val)
-                    with lock:
-                        client.publish(self.mqtttopic, payload=val, qos=0, retain=False)
+def HandleTrigger(item, name, mqtttopic):
+    # map the Redis values to MQTT values
+    val = float(item['data'])
+    # the scale and offset options are channel specific
+    scale = patch.getfloat('scale', name, default=1)
+    offset = patch.getfloat('offset', name, default=0)
+    # apply the scale and offset
+    val = EEGsynth.rescale(val, slope=scale, offset=offset)
+
+    monitor.update(mqtttopic, val)
+    with lock:
+        client.publish(mqtttopic, payload=val, qos=0, retain=False)
 
 
 # The callback for when the client receives a CONNACK response from the broker.
@@ -136,7 +117,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, debug, list_input, list_output, list1, list2, list3, i, j, lock, trigger, key1, key2, key3, this, thread, client
+    global monitor, debug, list_input, list_output, list1, list2, list3, i, j, lock, trigger, key1, key2, key3, client
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
@@ -162,15 +143,13 @@ def _start():
     lock = threading.Lock()
 
     # each of the Redis messages is mapped onto a different MQTT topic
-    trigger = []
+    trigger = EEGsynth.dispatcher(r)
     for key1, key2, key3 in zip(list1, list2, list3):
-        this = TriggerThread(key2, key1, key3)
-        trigger.append(this)
+        trigger.subscribe(key2, HandleTrigger, args=(key1, key3))
         monitor.debug(key1 + " trigger configured")
 
-    # start the thread for each of the triggers
-    for thread in trigger:
-        thread.start()
+    # start receiving the messages for all triggers
+    trigger.start()
 
     # make the connection with the MQTT broker
     try:
@@ -208,11 +187,7 @@ def _stop():
     '''
     global monitor, trigger, r
     monitor.success('Closing threads')
-    for thread in trigger:
-        thread.stop()
-    r.publish('OUTPUTMQTT_UNBLOCK', 1)
-    for thread in trigger:
-        thread.join()
+    trigger.stop()
     sys.exit()
 
 
@@ -82,7 +82,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, debug, filename, f, chanindx, channels, channelz, fSample, nSamples, replace, i, s, z, blocksize, begsample, endsample, block
+    global monitor, debug, filename, f, chanindx, channels, channelz, fSample, nSamples, replace, i, s, z, data, sample, anchor, first, rate
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
@@ -121,11 +121,15 @@ def _start():
     for s, z in zip(channels, channelz):
         monitor.info("Writing channel " + s + " as control value " + z)
 
-    # this should write data in one-sample blocks
-    blocksize = 1
-    begsample = 0
-    endsample = blocksize - 1
-    block = 0
+    # read all samples at once, this is a samples x channels array
+    data = f.readChannels(0, nSamples - 1).astype(np.double)
+    monitor.info("Loaded " + str(data.shape[0]) + " samples of " + str(data.shape[1]) + " channels")
+
+    # the time of each sample follows from the monotonic clock at the first sample that was played at the current speed
+    sample = 0
+    anchor = None
+    first = 0
+    rate = None
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -137,42 +141,54 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, debug, filename, f, chanindx, channels, channelz, fSample, nSamples, replace, i, s, z, blocksize, begsample, endsample, block
-    global indx, val, stepsize, elapsed, naptime
+    global monitor, debug, filename, f, chanindx, channels, channelz, fSample, nSamples, replace, i, s, z, data, sample, anchor, first, rate
+    global rewind, play, pause, speed, deadline, naptime
+
+    # get all control values in a single round trip
+    rewind, play, pause, speed = patch.getfloats('playback', ['rewind', 'play', 'pause', 'speed'], default=[0, 1, 0, 1])
 
-    if endsample > nSamples - 1:
+    if sample > nSamples - 1:
         monitor.info("End of file reached, jumping back to start")
-        begsample = 0
-        endsample = blocksize - 1
-        block = 0
+        if anchor is not None:
+            # continue seamlessly with the first sample
+            anchor, first = anchor + (sample - first) / (fSample * rate), 0
+        sample = 0
 
-    if patch.getint('playback', 'rewind', default=0):
+    if rewind:
         monitor.info("Rewind pressed, jumping back to start of file")
-        begsample = 0
-        endsample = blocksize - 1
-        block = 0
+        sample = 0
+        anchor = None
 
-    if not patch.getint('playback', 'play', default=1):
+    if not play:
         monitor.info("Stopped")
+        anchor = None
         time.sleep(0.1)
         return
 
-    if patch.getint('playback', 'pause', default=0):
+    if pause or not speed > 0:
         monitor.info("Paused")
+        anchor = None
         time.sleep(0.1)
         return
 
-    monitor.debug("Playing control value", block, 'from', begsample, 'to', endsample)
+    if anchor is None:
+        # start the timing from the current sample
+        anchor, first, rate = time.monotonic(), sample, speed
+    elif speed != rate:
+        # the speed only applies from the current sample onward
+        anchor, first, rate = anchor + (sample - first) / (fSample * rate), sample, speed
+
+    # wait until it is time for the current sample, the deadline does not depend on how long the previous samples took
+    deadline = anchor + (sample - first) / (fSample * rate)
+    naptime = deadline - time.monotonic()
+    if naptime > 0:
+        time.sleep(naptime)
 
-    for indx in range(len(channelz)):
-        # read one sample for a single channel
-        val = float(f.readSamples(indx, begsample, endsample))
-        patch.setvalue(channelz[indx], val)
+    monitor.debug("Playing control value", sample)
 
-    stepsize = blocksize / (fSample * patch.getfloat('playback', 'speed'))
-    begsample += blocksize
-    endsample += blocksize
-    block += 1
+    # write all channels in a single pipeline
+    patch.setvalues(dict(zip(channelz, data[sample].tolist())))
+    sample += 1
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -182,20 +198,11 @@ def _loop_once():
 def _loop_forever():
     '''Run the main loop forever
     '''
-    global monitor, stepsize
+    global monitor
     while True:
-        # measure the time to correct for the slip
-        start = time.time()
-
         monitor.loop()
         _loop_once()
 
-        elapsed = time.time() - start
-        naptime = stepsize - elapsed
-        if naptime > 0:
-            # this approximates the real time streaming speed
-            time.sleep(naptime)
-
 
 def _stop():
     '''Stop and clean up on SystemExit, KeyboardInterrupt
@@ -120,7 +120,7 @@ def _start():
     MININT32 = -np.power(2., 31)
     MAXINT32 = np.power(2., 31) - 1
 
-    if fileformat == 'edf':
+    if fileformat in ('edf', 'bdf'):
         f = EDF.EDFReader()
         f.open(filename)
         for chanindx in range(f.getNSignals()):
@@ -136,10 +136,8 @@ def _start():
         # the channel labels will be written to the buffer
         labels = f.getSignalTextLabels()
         # read all the data from the file
-        A = np.ndarray(shape=(H.nSamples, H.nChannels), dtype=np.float32)
-        for chanindx in range(H.nChannels):
-            monitor.info('reading channel ' + str(chanindx))
-            A[:, chanindx] = f.readSignal(chanindx)
+        monitor.info('reading ' + str(H.nChannels) + ' channels')
+        A = f.readChannels(0, H.nSamples - 1)
         f.close()
 
     elif fileformat == 'wav':
@@ -161,8 +161,7 @@ def _loop_once():
 
     # update with current data
     counter = 0
-    for name in input_name:
-        values = patch.getfloat('input', name, multiple=True, default=np.nan)
+    for values in patch.getfloats('input', input_name, multiple=True, default=np.nan):
         for value in values:
             inputhistory[counter, historysize-1] = value
             inputcurve[counter].setData(timeaxis, inputhistory[counter, :])
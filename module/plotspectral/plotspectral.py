@@ -30,7 +30,6 @@ import pyqtgraph as pg
 import sys
 import time
 import signal
-from scipy.fftpack import fft, fftfreq
 from scipy.signal import detrend
 
 if hasattr(sys, 'frozen'):
@@ -56,6 +55,20 @@ import EEGsynth
 import FieldTrip
 
 
+def decimate_peaks(x, y, npoints):
+    # reduce the number of points along the last dimension to approximately npoints
+    # the minimum and maximum of each group of points are kept, so that the peaks remain visible
+    if len(x) <= npoints:
+        return x, y
+    # each group is represented by two points
+    edges = np.linspace(0, len(x), npoints // 2 + 1).astype(int)[:-1]
+    ymin = np.minimum.reduceat(y, edges, axis=-1)
+    ymax = np.maximum.reduceat(y, edges, axis=-1)
+    x = np.repeat(x[edges], 2)
+    y = np.stack((ymin, ymax), axis=-1).reshape(y.shape[:-1] + (-1,))
+    return x, y
+
+
 def _setup():
     '''Initialize the module
     This adds a set of global variables
@@ -97,7 +110,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, ft_host, ft_port, ft_input, name
-    global timeout, hdr_input, start, channels, window, clipsize, stepsize, historysize, lrate, scale_red, scale_blue, offset_red, offset_blue, winx, winy, winwidth, winheight, prefix, numhistory, freqaxis, history, showred, showblue, filtorder, filter, freqrange, notch, app, win, text_redleft_curr, text_redright_curr, text_blueleft_curr, text_blueright_curr, text_redleft_hist, text_redright_hist, text_blueleft_hist, text_blueright_hist, freqplot_curr, freqplot_hist, spect_curr, spect_hist, redleft_curr, redright_curr, blueleft_curr, blueright_curr, redleft_hist, redright_hist, blueleft_hist, blueright_hist, fft_curr, fft_hist, specmax_curr, specmin_curr, specmax_hist, specmin_hist, plotnr, channr, timer, begsample, endsample, taper
+    global timeout, hdr_input, start, channels, window, clipsize, stepsize, historysize, lrate, scale_red, scale_blue, offset_red, offset_blue, winx, winy, winwidth, winheight, prefix, numhistory, freqaxis, history, histsum, showred, showblue, filtorder, filter, freqrange, notch, streamfilter, segment, decimate, maxpoints, app, win, text_redleft_curr, text_redright_curr, text_blueleft_curr, text_blueright_curr, text_redleft_hist, text_redright_hist, text_blueleft_hist, text_blueright_hist, freqplot_curr, freqplot_hist, spect_curr, spect_hist, redleft_curr, redright_curr, blueleft_curr, blueright_curr, redleft_hist, redright_hist, blueleft_hist, blueright_hist, fft_curr, fft_hist, specmax_curr, specmin_curr, specmax_hist, specmin_hist, plotnr, channr, timer, begsample, endsample, taper
 
     # this is the timeout for the FieldTrip buffer
     timeout = patch.getfloat('fieldtrip', 'timeout', default=30)
@@ -135,11 +148,21 @@ def _start():
     window      = int(round(window * hdr_input.fSample))       # in samples
     clipsize    = int(round(clipsize * hdr_input.fSample))     # in samples
     numhistory  = int(historysize / stepsize)                  # number of observations in the history
-    freqaxis    = fftfreq((window-2*clipsize), 1. / hdr_input.fSample)
-    history     = np.zeros((len(channels), freqaxis.shape[0], numhistory))
+    freqaxis    = np.fft.rfftfreq((window-2*clipsize), 1. / hdr_input.fSample)
+
+    # the spectra in the history are kept together with their running sum
+    history     = EEGsynth.ringbuffer(numhistory, len(channels) * freqaxis.shape[0])
+    histsum     = np.zeros((len(channels), freqaxis.shape[0]))
+
+    # the filtered data of the selected channels is kept for the spectral analysis
+    segment     = EEGsynth.ringbuffer(window-2*clipsize, len(channels))
 
     # this is used to taper the data prior to Fourier transforming
-    taper = np.hanning(window)
+    taper = np.hanning(window-2*clipsize)
+
+    # the number of plotted points can be limited to the horizontal resolution of the panels
+    decimate    = patch.getint('display', 'decimate', default=0)
+    maxpoints   = max(int(winwidth / 2), 2)
 
     # ideally it should be possible to change these on the fly
     showred     = patch.getint('input', 'showred', default=1)
@@ -161,6 +184,9 @@ def _start():
     # notch filtering is optional
     notch = patch.getfloat('arguments', 'notch', default=np.nan)
 
+    # the filter is designed once, its state is carried over from one block of data to the next
+    streamfilter = EEGsynth.sosfilter(EEGsynth.butter_sos(hdr_input.fSample, filter[0], filter[1], filtorder, notch), len(channels))
+
     # wait until there is enough data
     begsample = -1
     while begsample < 0:
@@ -168,7 +194,7 @@ def _start():
         hdr_input = ft_input.getHeader()
         if hdr_input != None:
             begsample = hdr_input.nSamples - window
-            endsample = hdr_input.nSamples - 1
+            endsample = begsample - 1  # the first block includes the clipsize for the filter to settle
 
     # initialize graphical window
     app = QtGui.QApplication([])
@@ -202,12 +228,12 @@ def _start():
     redright_hist   = []
     blueleft_hist   = []
     blueright_hist  = []
-    fft_curr        = []
-    fft_hist        = []
-    specmax_curr    = []
-    specmin_curr    = []
-    specmax_hist    = []
-    specmin_hist    = []
+    fft_curr        = None
+    fft_hist        = None
+    specmax_curr    = None
+    specmin_curr    = None
+    specmax_hist    = None
+    specmin_hist    = None
 
     # Create panels for each channel
     for plotnr, channr in enumerate(channels):
@@ -243,14 +269,6 @@ def _start():
         blueright_hist.append(freqplot_hist[plotnr].plot(pen='b'))
         win.nextRow()
 
-        # initialize as lists
-        specmin_curr.append(None)
-        specmax_curr.append(None)
-        specmin_hist.append(None)
-        specmax_hist.append(None)
-        fft_curr.append(None)
-        fft_hist.append(None)
-
     # print frequency at lines
     freqplot_curr[0].addItem(text_redleft_curr)
     freqplot_curr[0].addItem(text_redright_curr)
@@ -275,8 +293,8 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, ft_host, ft_port, ft_input
-    global timeout, hdr_input, start, channels, window, clipsize, stepsize, historysize, lrate, scale_red, scale_blue, offset_red, offset_blue, winx, winy, winwidth, winheight, prefix, numhistory, freqaxis, history, showred, showblue, filtorder, filter, notch, app, win, text_redleft_curr, text_redright_curr, text_blueleft_curr, text_blueright_curr, text_redleft_hist, text_redright_hist, text_blueleft_hist, text_blueright_hist, freqplot_curr, freqplot_hist, spect_curr, spect_hist, redleft_curr, redright_curr, blueleft_curr, blueright_curr, redleft_hist, redright_hist, blueleft_hist, blueright_hist, fft_curr, fft_hist, specmax_curr, specmin_curr, specmax_hist, specmin_hist, plotnr, channr, timer, begsample, endsample, taper
-    global dat, arguments_freqrange, freqrange, redfreq, redwidth, bluefreq, bluewidth
+    global timeout, hdr_input, start, channels, window, clipsize, stepsize, historysize, lrate, scale_red, scale_blue, offset_red, offset_blue, winx, winy, winwidth, winheight, prefix, numhistory, freqaxis, history, histsum, showred, showblue, filtorder, filter, notch, streamfilter, segment, decimate, maxpoints, app, win, text_redleft_curr, text_redright_curr, text_blueleft_curr, text_blueright_curr, text_redleft_hist, text_redright_hist, text_blueleft_hist, text_blueright_hist, freqplot_curr, freqplot_hist, spect_curr, spect_hist, redleft_curr, redright_curr, blueleft_curr, blueright_curr, redleft_hist, redright_hist, blueleft_hist, blueright_hist, fft_curr, fft_hist, specmax_curr, specmin_curr, specmax_hist, specmin_hist, plotnr, channr, timer, begsample, endsample, taper
+    global dat, arguments_freqrange, freqrange, freqplot, spect_currplot, spect_histplot, redfreq, redwidth, bluefreq, bluewidth
 
     monitor.loop()
 
@@ -287,15 +305,27 @@ def _loop_once():
         while begsample < 0:
             hdr_input = ft_input.getHeader()
             begsample = hdr_input.nSamples - window
-            endsample = hdr_input.nSamples - 1
+        endsample = begsample - 1
+        # start again with the filter and the data segment
+        streamfilter.reset()
+        segment.clear()
 
-    # get the last available data
-    begsample = (hdr_input.nSamples - window)  # the clipsize will be removed from both sides after filtering
+    # only read the data that is new since the previous iteration, at most one window
+    begsample = max(endsample + 1, hdr_input.nSamples - window)
     endsample = (hdr_input.nSamples - 1)
+    if endsample < begsample:
+        return
 
     monitor.info("reading from sample %d to %d" % (begsample, endsample))
 
     dat = ft_input.getData([begsample, endsample]).astype(np.double)
+    dat = dat[:, np.array(channels) - 1]
+
+    # apply the user-defined filtering, this continues where the previous block ended
+    segment.append(streamfilter.filter(dat))
+    if segment.count < segment.length:
+        return
+    dat = segment.get()
 
     # demean the data to prevent spectral leakage
     if patch.getint('arguments', 'demean', default=1):
@@ -306,50 +336,59 @@ def _loop_once():
     if patch.getint('arguments', 'detrend', default=0):
         dat = detrend(dat, axis=0, type='linear')
 
-    # apply the user-defined filtering
-    if not np.isnan(filter[0]) and not np.isnan(filter[1]):
-        dat = EEGsynth.butter_bandpass_filter(dat.T, filter[0], filter[1], int(hdr_input.fSample), filtorder).T
-    elif not np.isnan(filter[1]):
-        dat = EEGsynth.butter_lowpass_filter(dat.T, filter[1], int(hdr_input.fSample), filtorder).T
-    elif not np.isnan(filter[0]):
-        dat = EEGsynth.butter_highpass_filter(dat.T, filter[0], int(hdr_input.fSample), filtorder).T
-    if not np.isnan(notch):
-        dat = EEGsynth.notch_filter(dat.T, notch, hdr_input.fSample).T
-
-    # remove the filter padding
-    if clipsize > 0:
-        dat = dat[clipsize:-clipsize,:]
-
     # taper the data
     dat = dat * taper[:, np.newaxis]
 
-    # shift the FFT history by one step
-    history = np.roll(history, 1, axis=2)
+    # estimate the absolute FFT amplitude at the current moment for all channels at once
+    fft_curr = np.abs(np.fft.rfft(dat, axis=0)).T
 
-    for plotnr, channr in enumerate(channels):
+    # update the FFT history and its running sum with the current estimate
+    if history.count == history.length:
+        histsum -= history.get()[0].reshape(histsum.shape)
+    history.append(fft_curr.reshape(1, -1))
+    if history.pointer == 0:
+        # prevent the accumulation of rounding errors
+        histsum = history.get().sum(axis=0).reshape(histsum.shape)
+    else:
+        histsum += fft_curr
+    fft_hist = histsum / history.count
+
+    # user-selected frequency band
+    arguments_freqrange = patch.getfloat('arguments', 'freqrange', multiple=True)
+    freqrange = np.greater(freqaxis, arguments_freqrange[0]) & np.less_equal(freqaxis, arguments_freqrange[1])
+
+    # adapt the vertical scale to the running mean of the min/max
+    if specmax_curr is None:
+        specmax_curr = np.max(fft_curr[:, freqrange], axis=1)
+        specmin_curr = np.min(fft_curr[:, freqrange], axis=1)
+        specmax_hist = np.max(fft_hist[:, freqrange], axis=1)
+        specmin_hist = np.min(fft_hist[:, freqrange], axis=1)
+    else:
+        specmax_curr = (1 - lrate) * specmax_curr + lrate * np.max(fft_curr[:, freqrange], axis=1)
+        specmin_curr = (1 - lrate) * specmin_curr + lrate * np.min(fft_curr[:, freqrange], axis=1)
+        specmax_hist = (1 - lrate) * specmax_hist + lrate * np.max(fft_hist[:, freqrange], axis=1)
+        specmin_hist = (1 - lrate) * specmin_hist + lrate * np.min(fft_hist[:, freqrange], axis=1)
+
+    # the spectra that are plotted
+    if decimate:
+        freqplot, spect_currplot = decimate_peaks(freqaxis[freqrange], fft_curr[:, freqrange], maxpoints)
+        freqplot, spect_histplot = decimate_peaks(freqaxis[freqrange], fft_hist[:, freqrange], maxpoints)
+    else:
+        freqplot, spect_currplot, spect_histplot = freqaxis[freqrange], fft_curr[:, freqrange], fft_hist[:, freqrange]
+
+    # the position of the vertical lines is the same for all channels
+    if showred:
+        redfreq  = patch.getfloat('input', 'redfreq', default=10. / arguments_freqrange[1])
+        redfreq  = EEGsynth.rescale(redfreq, slope=scale_red, offset=offset_red) * arguments_freqrange[1]
+        redwidth = patch.getfloat('input', 'redwidth', default=1. / arguments_freqrange[1])
+        redwidth = EEGsynth.rescale(redwidth, slope=scale_red, offset=offset_red) * arguments_freqrange[1]
+    if showblue:
+        bluefreq  = patch.getfloat('input', 'bluefreq', default=20. / arguments_freqrange[1])
+        bluefreq  = EEGsynth.rescale(bluefreq, slope=scale_blue, offset=offset_blue) * arguments_freqrange[1]
+        bluewidth = patch.getfloat('input', 'bluewidth', default=4. / arguments_freqrange[1])
+        bluewidth = EEGsynth.rescale(bluewidth, slope=scale_blue, offset=offset_blue) * arguments_freqrange[1]
 
-        # estimate the absolute FFT amplitude at the current moment
-        fft_curr[plotnr] = abs(fft(dat[:, channr-1]))
-
-        # update the FFT history with the current estimate
-        history[plotnr, :, numhistory - 1] = fft_curr[plotnr]
-        fft_hist = np.mean(history, axis=2)
-
-        # user-selected frequency band
-        arguments_freqrange = patch.getfloat('arguments', 'freqrange', multiple=True)
-        freqrange = np.greater(freqaxis, arguments_freqrange[0]) & np.less_equal(freqaxis, arguments_freqrange[1])
-
-        # adapt the vertical scale to the running mean of the min/max
-        if specmax_curr[plotnr]==None:
-            specmax_curr[plotnr] = max(fft_curr[plotnr][freqrange])
-            specmin_curr[plotnr] = min(fft_curr[plotnr][freqrange])
-            specmax_hist[plotnr] = max(fft_hist[plotnr][freqrange])
-            specmin_hist[plotnr] = min(fft_hist[plotnr][freqrange])
-        else:
-            specmax_curr[plotnr] = (1 - lrate) * float(specmax_curr[plotnr]) + lrate * max(fft_curr[plotnr][freqrange])
-            specmin_curr[plotnr] = (1 - lrate) * float(specmin_curr[plotnr]) + lrate * min(fft_curr[plotnr][freqrange])
-            specmax_hist[plotnr] = (1 - lrate) * float(specmax_hist[plotnr]) + lrate * max(fft_hist[plotnr][freqrange])
-            specmin_hist[plotnr] = (1 - lrate) * float(specmin_hist[plotnr]) + lrate * min(fft_hist[plotnr][freqrange])
+    for plotnr, channr in enumerate(channels):
 
         # update the axes
         freqplot_curr[plotnr].setXRange(arguments_freqrange[0], arguments_freqrange[1])
@@ -358,57 +397,49 @@ def _loop_once():
         freqplot_hist[plotnr].setYRange(specmin_hist[plotnr], specmax_hist[plotnr])
 
         # update the spectra
-        spect_curr[plotnr].setData(freqaxis[freqrange], fft_curr[plotnr][freqrange])
-        spect_hist[plotnr].setData(freqaxis[freqrange], fft_hist[plotnr][freqrange])
+        spect_curr[plotnr].setData(freqplot, spect_currplot[plotnr])
+        spect_hist[plotnr].setData(freqplot, spect_histplot[plotnr])
 
         # update the vertical plotted lines
         if showred:
-            redfreq  = patch.getfloat('input', 'redfreq', default=10. / arguments_freqrange[1])
-            redfreq  = EEGsynth.rescale(redfreq, slope=scale_red, offset=offset_red) * arguments_freqrange[1]
-            redwidth = patch.getfloat('input', 'redwidth', default=1. / arguments_freqrange[1])
-            redwidth = EEGsynth.rescale(redwidth, slope=scale_red, offset=offset_red) * arguments_freqrange[1]
             redleft_curr[plotnr].setData(x=[redfreq - redwidth, redfreq - redwidth], y=[specmin_curr[plotnr], specmax_curr[plotnr]])
             redright_curr[plotnr].setData(x=[redfreq + redwidth, redfreq + redwidth], y=[specmin_curr[plotnr], specmax_curr[plotnr]])
             redleft_hist[plotnr].setData(x=[redfreq - redwidth, redfreq - redwidth], y=[specmin_hist[plotnr], specmax_hist[plotnr]])
             redright_hist[plotnr].setData(x=[redfreq + redwidth, redfreq + redwidth], y=[specmin_hist[plotnr], specmax_hist[plotnr]])
-            # update labels at the vertical lines
-            text_redleft_curr.setText('%0.1f' % (redfreq - redwidth))
-            text_redleft_curr.setPos(redfreq - redwidth, specmax_curr[0])
-            text_redright_curr.setText('%0.1f' % (redfreq + redwidth))
-            text_redright_curr.setPos(redfreq + redwidth, specmax_curr[0])
-            text_redleft_hist.setText('%0.1f' % (redfreq - redwidth))
-            text_redleft_hist.setPos(redfreq - redwidth, specmax_hist[0])
-            text_redright_hist.setText('%0.1f' % (redfreq + redwidth))
-            text_redright_hist.setPos(redfreq + redwidth, specmax_hist[0])
-            # write the positions of the lines to Redis
-            key = "%s.%s.%s" % (prefix, 'redband', 'low')
-            patch.setvalue(key, redfreq - redwidth)
-            key = "%s.%s.%s" % (prefix, 'redband', 'high')
-            patch.setvalue(key, redfreq + redwidth)
 
         if showblue:
-            bluefreq  = patch.getfloat('input', 'bluefreq', default=20. / arguments_freqrange[1])
-            bluefreq  = EEGsynth.rescale(bluefreq, slope=scale_blue, offset=offset_blue) * arguments_freqrange[1]
-            bluewidth = patch.getfloat('input', 'bluewidth', default=4. / arguments_freqrange[1])
-            bluewidth = EEGsynth.rescale(bluewidth, slope=scale_blue, offset=offset_blue) * arguments_freqrange[1]
             blueleft_curr[plotnr].setData(x=[bluefreq - bluewidth, bluefreq - bluewidth], y=[specmin_curr[plotnr], specmax_curr[plotnr]])
             blueright_curr[plotnr].setData(x=[bluefreq + bluewidth, bluefreq + bluewidth], y=[specmin_curr[plotnr], specmax_curr[plotnr]])
             blueleft_hist[plotnr].setData(x=[bluefreq - bluewidth, bluefreq - bluewidth], y=[specmin_hist[plotnr], specmax_hist[plotnr]])
             blueright_hist[plotnr].setData(x=[bluefreq + bluewidth, bluefreq + bluewidth], y=[specmin_hist[plotnr], specmax_hist[plotnr]])
-            # update labels at the vertical lines
-            text_blueleft_curr.setText('%0.1f' % (bluefreq - bluewidth))
-            text_blueleft_curr.setPos(bluefreq - bluewidth, specmax_curr[0])
-            text_blueright_curr.setText('%0.1f' % (bluefreq + bluewidth))
-            text_blueright_curr.setPos(bluefreq + bluewidth, specmax_curr[0])
-            text_blueleft_hist.setText('%0.1f' % (bluefreq - bluewidth))
-            text_blueleft_hist.setPos(bluefreq - bluewidth, specmax_hist[0])
-            text_blueright_hist.setText('%0.1f' % (bluefreq + bluewidth))
-            text_blueright_hist.setPos(bluefreq + bluewidth, specmax_hist[0])
-            # write the positions of the lines to Redis
-            key = "%s.%s.%s" % (prefix, 'blueband', 'low')
-            patch.setvalue(key, bluefreq - bluewidth)
-            key = "%s.%s.%s" % (prefix, 'blueband', 'high')
-            patch.setvalue(key, bluefreq + bluewidth)
+
+    if showred:
+        # update labels at the vertical lines
+        text_redleft_curr.setText('%0.1f' % (redfreq - redwidth))
+        text_redleft_curr.setPos(redfreq - redwidth, specmax_curr[0])
+        text_redright_curr.setText('%0.1f' % (redfreq + redwidth))
+        text_redright_curr.setPos(redfreq + redwidth, specmax_curr[0])
+        text_redleft_hist.setText('%0.1f' % (redfreq - redwidth))
+        text_redleft_hist.setPos(redfreq - redwidth, specmax_hist[0])
+        text_redright_hist.setText('%0.1f' % (redfreq + redwidth))
+        text_redright_hist.setPos(redfreq + redwidth, specmax_hist[0])
+        # write the positions of the lines to Redis
+        patch.setvalues({"%s.%s.%s" % (prefix, 'redband', 'low'): redfreq - redwidth,
+                         "%s.%s.%s" % (prefix, 'redband', 'high'): redfreq + redwidth}, changed=True)
+
+    if showblue:
+        # update labels at the vertical lines
+        text_blueleft_curr.setText('%0.1f' % (bluefreq - bluewidth))
+        text_blueleft_curr.setPos(bluefreq - bluewidth, specmax_curr[0])
+        text_blueright_curr.setText('%0.1f' % (bluefreq + bluewidth))
+        text_blueright_curr.setPos(bluefreq + bluewidth, specmax_curr[0])
+        text_blueleft_hist.setText('%0.1f' % (bluefreq - bluewidth))
+        text_blueleft_hist.setPos(bluefreq - bluewidth, specmax_hist[0])
+        text_blueright_hist.setText('%0.1f' % (bluefreq + bluewidth))
+        text_blueright_hist.setPos(bluefreq + bluewidth, specmax_hist[0])
+        # write the positions of the lines to Redis
+        patch.setvalues({"%s.%s.%s" % (prefix, 'blueband', 'low'): bluefreq - bluewidth,
+                         "%s.%s.%s" % (prefix, 'blueband', 'high'): bluefreq + bluewidth}, changed=True)
 
 
 def _loop_forever():
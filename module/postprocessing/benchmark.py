@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Benchmark for the evaluation of the equations in the postprocessing module
+#
+# This software is part of the EEGsynth project, see <https://github.com/eegsynth/eegsynth>.
+#
+# Copyright (C) 2020 EEGsynth project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import numpy as np
+import time
+
+from postprocessing import *
+
+
+def sanitize(equation):
+    # this is how the equations used to be prepared
+    equation = equation.replace('(', '( ')
+    equation = equation.replace(')', ' )')
+    equation = equation.replace('+', ' + ')
+    equation = equation.replace('-', ' - ')
+    equation = equation.replace('*', ' * ')
+    equation = equation.replace('/', ' / ')
+    equation = equation.replace(',', ' , ')
+    equation = equation.replace('>', ' > ')
+    equation = equation.replace('<', ' < ')
+    equation = ' '.join(equation.split())
+    return equation
+
+
+def loop_evaluate(output_equation, input_name, input_value):
+    # this is how the equations used to be evaluated, it serves as reference
+    output_value = []
+    for equation in output_equation:
+        for name, value in zip(input_name, input_value):
+            equation = equation.replace(name, str(value))
+        output_value.append(float(eval(equation)))
+    return output_value
+
+
+def compiled_evaluate(equations, input_value):
+    namespace = dict(functions)
+    namespace.update(input_value)
+    return [equation.evaluate(namespace) for equation in equations]
+
+
+def vectorized_evaluate(groups, input_value):
+    output_value = {}
+    for group in groups:
+        for equation, val in zip(group, evaluate(group, input_value)):
+            output_value[equation.key] = val
+    return output_value
+
+
+def timeit(fun, repeat):
+    start = time.time()
+    for i in range(repeat):
+        fun()
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--equations", type=int, nargs='+', default=[10, 100, 500, 1000], help="number of equations")
+    parser.add_argument("--repeat", type=int, default=20, help="number of repetitions")
+    args = parser.parse_args()
+
+    # these are the forms of the equations, each of them is used with different input variables
+    forms = ['(%s+%s)/2', '%s/%s', 'log10(%s)+%s', 'sqrt(%s*%s)']
+
+    # equations with reducing functions must not be evaluated together
+    input_name = ['x1', 'x2', 'x10']
+    value = {'x1': 1., 'x2': 3., 'x10': 5.}
+    for form in ['std(%s)', 'median(%s)', 'mean(%s)', 'var(%s)', 'max(%s, 2)', 'min(%s, 2)']:
+        equations = [Equation('out%d' % i, form % name, input_name) for i, name in enumerate(input_name)]
+        if any([equation.elementwise for equation in equations]):
+            raise RuntimeError('the equation %s is marked as elementwise' % equations[0].equation)
+        try:
+            evaluate(equations, value)
+            raise RuntimeError('the equations %s are evaluated together' % equations[0].equation)
+        except (TypeError, ValueError):
+            pass
+        if not np.allclose(compiled_evaluate(equations, value), [eval(form % name, dict(functions), value) for name in input_name]):
+            raise RuntimeError('the equations %s are not evaluated correctly' % equations[0].equation)
+
+    print('%10s %12s %14s %14s %10s' % ('equations', 'loop (ms)', 'compiled (ms)', 'vectorized (ms)', 'speedup'))
+    for nequation in args.equations:
+        # the variables are numbered such that the names of the first ones are sub-strings of the later ones
+        input_name = ['x%d' % (i + 1) for i in range(nequation + 1)]
+        input_value = list(np.random.uniform(1, 10, len(input_name)))
+        output_name = ['out%d' % i for i in range(nequation)]
+        output_equation = [forms[i % len(forms)] % (input_name[i], input_name[i + 1]) for i in range(nequation)]
+
+        equations = [Equation(key, equation, input_name) for key, equation in zip(output_name, output_equation)]
+        groups = {}
+        for equation in equations:
+            if equation.elementwise:
+                groups.setdefault(equation.form, []).append(equation)
+            else:
+                groups[equation.key] = [equation]
+        groups = list(groups.values())
+
+        value = dict(zip(input_name, input_value))
+        compiled = compiled_evaluate(equations, value)
+        vectorized = vectorized_evaluate(groups, value)
+        if not np.allclose(compiled, [vectorized[key] for key in output_name]):
+            raise RuntimeError('the vectorized evaluation does not match the compiled evaluation')
+
+        # the original approach does not work with more than 9 variables
+        if nequation < 9:
+            if not np.allclose(compiled, loop_evaluate([sanitize(equation) for equation in output_equation], input_name, input_value)):
+                raise RuntimeError('the compiled evaluation does not match the reference')
+
+        t_loop = timeit(lambda: loop_evaluate([sanitize(equation) for equation in output_equation], input_name, input_value), args.repeat)
+        t_compiled = timeit(lambda: compiled_evaluate(equations, value), args.repeat)
+        t_vectorized = timeit(lambda: vectorized_evaluate(groups, value), args.repeat)
+        print('%10d %12.3f %14.3f %14.3f %10.1f' % (nequation, t_loop * 1000, t_compiled * 1000, t_vectorized * 1000, t_loop / t_vectorized))
@@ -22,6 +22,7 @@
 from numpy import log, log2, log10, exp, power, sqrt, mean, median, var, std, mod, random
 import configparser
 import argparse
+import ast
 import numpy as np
 import os
 import redis
@@ -55,27 +56,92 @@ from EEGsynth import compress, limit, rescale, normalizerange, normalizestandard
 
 def rand(x):
     # the input variable is ignored
-    return np.asscalar(random.rand(1))
+    return float(random.rand())
 
 
 def randn(x):
     # the input variable is ignored
-    return np.asscalar(random.randn(1))
+    return float(random.randn())
+
+
+# these are the only functions that can be used in the equations
+functions = dict([(fun.__name__, fun) for fun in [log, log2, log10, exp, power, sqrt, mean, median, var, std, mod, compress, limit, rescale, normalizerange, normalizestandard, rand, randn, abs, float, int, round, min, max]])
+functions['__builtins__'] = {}
+
+# these functions operate on each element of an array, the others reduce it or cannot deal with it
+elementwise = ['log', 'log2', 'log10', 'exp', 'power', 'sqrt', 'mod', 'compress', 'limit', 'rescale', 'abs', 'round']
+
+# these are the only elements that can be used in the equations
+syntax = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call, ast.keyword, ast.Name, ast.Load, ast.operator, ast.unaryop, ast.boolop, ast.cmpop)
+if hasattr(ast, 'Constant'):
+    syntax += (ast.Constant, )
+if hasattr(ast, 'Num'):
+    syntax += (ast.Num, )
+
+
+class Placeholders(ast.NodeTransformer):
+    # replaces the input variables by _0, _1, etc. in the order in which they appear
+    def __init__(self, variables):
+        self.variables = variables
+        self.names = []
+
+    def visit_Name(self, node):
+        if not node.id in self.variables:
+            return node
+        if not node.id in self.names:
+            self.names.append(node.id)
+        return ast.copy_location(ast.Name(id='_%d' % self.names.index(node.id), ctx=node.ctx), node)
+
+
+class Equation():
+    """The equation is parsed, validated and compiled only once. The input variables are bound
+    by name when it is evaluated, rather than being replaced by their values in the text.
+    Equations that only differ in their input variables have the same form, which allows
+    them to be evaluated together with arrays for the input variables, provided that they
+    only call elementwise functions.
+    """
+    def __init__(self, key, equation, variables):
+        self.key = key
+        self.equation = equation
+        tree = ast.parse(equation.strip(), mode='eval')
+        for node in ast.walk(tree):
+            if not isinstance(node, syntax):
+                raise ValueError('unsupported syntax: ' + type(node).__name__)
+            if isinstance(node, ast.Name) and not node.id in variables and not node.id in functions:
+                raise ValueError('unknown name: ' + node.id)
+            if isinstance(node, ast.Call) and not isinstance(node.func, ast.Name):
+                raise ValueError('unsupported function call')
+        self.code = compile(tree, key, 'eval')
+        placeholders = Placeholders(variables)
+        tree = ast.fix_missing_locations(placeholders.visit(tree))
+        self.names = placeholders.names
+        self.form = ast.dump(tree)
+        self.formcode = compile(tree, key, 'eval')
+        # the random functions give a new value on every evaluation
+        self.random = any([isinstance(node, ast.Name) and node.id in ('rand', 'randn') for node in ast.walk(tree)])
+        # functions like mean, std and max would reduce over all equations that are evaluated together
+        self.elementwise = all([node.func.id in elementwise for node in ast.walk(tree) if isinstance(node, ast.Call)])
+
+    def evaluate(self, namespace):
+        # the namespace contains the functions and the values of the input variables
+        try:
+            return float(eval(self.code, namespace)) # deal with True/False
+        except ZeroDivisionError:
+            # division by zero is not a serious error
+            return np.nan
 
 
-def sanitize(equation):
-    equation.replace(' ', '')
-    equation = equation.replace('(', '( ')
-    equation = equation.replace(')', ' )')
-    equation = equation.replace('+', ' + ')
-    equation = equation.replace('-', ' - ')
-    equation = equation.replace('*', ' * ')
-    equation = equation.replace('/', ' / ')
-    equation = equation.replace(',', ' , ')
-    equation = equation.replace('>', ' > ')
-    equation = equation.replace('<', ' < ')
-    equation = ' '.join(equation.split())
-    return equation
+def evaluate(equations, value):
+    # evaluate a list of equations with the same form at once, the variables are bound to arrays
+    namespace = dict(functions)
+    for i in range(len(equations[0].names)):
+        namespace['_%d' % i] = np.array([value[equation.names[i]] for equation in equations], dtype=np.double)
+    with np.errstate(divide='raise', invalid='ignore'):
+        val = eval(equations[0].formcode, namespace)
+    val = np.asarray(val, dtype=np.double)
+    if val.shape != (len(equations), ):
+        raise ValueError('the equations cannot be evaluated together')
+    return val.tolist()
 
 
 def _setup():
@@ -110,11 +176,14 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, input_name, input_variable, output_name, output_equation, variable, equation
+    global monitor, vectorized, input_name, input_variable, output_name, output_equation, variable, equation, key, equations, groups, previous
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
 
+    # evaluate the equations with the same form together
+    vectorized = patch.getint('general', 'vectorized', default=0)
+
     if 'initial' in config.sections():
         # assign the initial values
         for item in config.items('initial'):
@@ -132,17 +201,34 @@ def _start():
     else:
         output_name, output_equation = ([], [])
 
-    # make the equations robust against sub-string replacements
-    output_equation = [sanitize(equation) for equation in output_equation]
-
     monitor.info('===== input variables =====')
-    for name,variable in zip(input_name, input_variable):
-        monitor.info(name + ' = ' + variable)
+    for key,variable in zip(input_name, input_variable):
+        monitor.info(key + ' = ' + variable)
     monitor.info('===== output equations =====')
-    for name,equation in zip(output_name, output_equation):
-        monitor.info(name + ' = ' + equation)
+    for key,equation in zip(output_name, output_equation):
+        monitor.info(key + ' = ' + equation)
     monitor.info('============================')
 
+    # parse and compile the equations
+    equations = []
+    for key,equation in zip(output_name, output_equation):
+        try:
+            equations.append(Equation(key, equation, input_name))
+        except (SyntaxError, ValueError) as error:
+            monitor.error('Error in equation: %s = %s, %s' % (key, equation, error))
+
+    # each group contains equations that are evaluated together
+    groups = {}
+    for equation in equations:
+        if vectorized and equation.elementwise and not equation.random:
+            groups.setdefault(equation.form, []).append(equation)
+        else:
+            groups[equation.key] = [equation]
+    groups = list(groups.values())
+
+    # the equations only need to be evaluated when their input values change
+    previous = None
+
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
         print('LOCALS: ' + ', '.join(locals().keys()))
@@ -153,34 +239,51 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, input_name, input_variable, output_name, output_equation, variable, equation
+    global monitor, vectorized, input_name, input_variable, output_name, output_equation, variable, equation, key, equations, groups, previous
 
     monitor.debug('============================')
 
-    input_value = []
-    for name in input_name:
-        val = patch.getfloat('input', name)
-        input_value.append(val)
-
-    for key, equation in zip(output_name, output_equation):
-        # replace the variable names in the equation by the values
-        for name, value in zip(input_name, input_value):
-            if value is None and equation.count(name)>0:
-                monitor.error('Undefined value: %s' % (name))
-            else:
-                equation = equation.replace(name, str(value))
-
-        # try to evaluate the equation
-        try:
-            val = eval(equation)
-            val = float(val) # deal with True/False
-            monitor.debug('%s = %s = %g' % (key, equation, val))
-            patch.setvalue(key, val)
-        except ZeroDivisionError:
-            # division by zero is not a serious error
-            patch.setvalue(equation[0], np.NaN)
-        except:
-            monitor.error('Error in evaluation: %s = %s' % (key, equation))
+    # get all input values at once
+    input_value = dict(zip(input_name, patch.getfloats('input', input_name)))
+    if previous is None:
+        changed = set(input_name)
+    else:
+        changed = set([name for name in input_name if input_value[name] != previous[name]])
+    previous = input_value
+
+    namespace = dict(functions)
+    namespace.update(input_value)
+    output_value = {}
+
+    for group in groups:
+        # only evaluate the equations for which the input values have changed, constant equations are always written
+        group = [equation for equation in group if equation.random or not equation.names or len(changed.intersection(equation.names))]
+
+        # the equations cannot be evaluated if one of their input values is missing
+        for equation in group:
+            for name in equation.names:
+                if input_value[name] is None:
+                    monitor.error('Undefined value: %s' % (name))
+        group = [equation for equation in group if not None in [input_value[name] for name in equation.names]]
+
+        if len(group) > 1:
+            try:
+                for equation, val in zip(group, evaluate(group, input_value)):
+                    output_value[equation.key] = val
+                continue
+            except (ArithmeticError, TypeError, ValueError):
+                # evaluate them one by one
+                pass
+
+        for equation in group:
+            try:
+                output_value[equation.key] = equation.evaluate(namespace)
+                monitor.debug('%s = %s = %g' % (equation.key, equation.equation, output_value[equation.key]))
+            except:
+                monitor.error('Error in evaluation: %s = %s' % (equation.key, equation.equation))
+
+    # write all output values at once
+    patch.setvalues(output_value)
 
 
 def _loop_forever():
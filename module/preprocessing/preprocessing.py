@@ -185,26 +185,19 @@ def _loop_once():
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input, ft_output
     global timeout, hdr_input, start, window, downsample, differentiate, integrate, rectify, smoothing, reference, default_scale, scale_lowpass, scale_highpass, scale_notchfilter, offset_lowpass, offset_highpass, offset_notchfilter, scale_filterorder, scale_notchquality, offset_filterorder, offset_notchquality, previous, differentiate_zi, integrate_zi, begsample, endsample
-    global dat_input, dat_output, highpassfilter, lowpassfilter, filterorder, change, b, a, zi, notchfilter, notchquality, nb, na, nzi, window_new, t
+    global block, dat_input, dat_output, highpassfilter, lowpassfilter, filterorder, change, b, a, zi, notchfilter, notchquality, nb, na, nzi, window_new, t
 
     monitor.loop()
 
-    # determine when we start polling for available data
-    start = time.time()
-
-    while endsample>hdr_input.nSamples-1:
-        # wait until there is enough data
-        time.sleep(patch.getfloat('general', 'delay'))
-        hdr_input = ft_input.getHeader()
-        if (hdr_input.nSamples-1)<(endsample-window):
-            raise RuntimeError("buffer reset detected")
-        if (time.time()-start)>timeout:
-            raise RuntimeError("timeout while waiting for data")
+    # wait until there is enough data and read it, this raises a RuntimeError upon a buffer reset
+    block = ft_input.readNext(window, timeout, begsample=begsample)
+    if block is None:
+        raise RuntimeError("timeout while waiting for data")
 
     # determine the start of the actual processing
     start = time.time()
 
-    dat_input  = ft_input.getData([begsample, endsample]).astype(np.float32)
+    dat_input  = block[0].astype(np.float32)
     dat_output = dat_input
 
     monitor.trace("------------------------------------------------------------")
@@ -52,6 +52,65 @@ import EEGsynth
 import EDF
 
 
+def scankeys(pattern):
+    # incrementally iterate over the matching keys, this does not block the Redis server like KEYS
+    global r
+    return sorted(set(r.scan_iter(match=pattern, count=1000)))
+
+
+def tofloat(values, default=0.):
+    # convert the values from Redis to an array, missing or invalid values are replaced by the default
+    if None not in values:
+        try:
+            # this is the common case, in which all values are present and valid
+            return np.array(values, dtype=float)
+        except (TypeError, ValueError):
+            pass
+    result = np.full(len(values), default)
+    for i, val in enumerate(values):
+        try:
+            result[i] = float(val)
+        except (TypeError, ValueError):
+            pass
+    return result
+
+
+def flush():
+    # write the samples that have been accumulated since the previous flush
+    global monitor, MININT32, MAXINT32, fileformat, f, blocksize, nchans, sample, physical_min, physical_max, block, extra, extrablock, sidecar, schema
+    nsamples = (sample - 1) % blocksize + 1
+    if fileformat == 'edf':
+        if nsamples < blocksize:
+            # an EDF record is always complete, repeat the last value of each control
+            block[nsamples:] = block[nsamples - 1]
+        f.writeBlock(block.T)
+    elif fileformat == 'wav':
+        # scale the floating point values between -1 and 1, and then between MININT32 and MAXINT32
+        dat = block[:nsamples] / ((physical_max - physical_min) / 2.) * ((float(MAXINT32) - float(MININT32)) / 2.)
+        f.writeframesraw(np.clip(dat, MININT32, MAXINT32).astype('<i4').tobytes())
+    if len(extra):
+        if schema:
+            # a new header line is written whenever controls have been added
+            sidecar.write('sample\t' + '\t'.join(extra) + '\n')
+            schema = False
+        np.savetxt(sidecar, np.column_stack((np.arange(sample - nsamples, sample), extrablock[:nsamples])), fmt='%.8g', delimiter='\t')
+        sidecar.flush()
+        extrablock[:] = np.nan
+    monitor.debug("Writing " + str(nsamples) + " samples up to " + str(sample))
+
+
+def close():
+    # flush the remaining samples and close the files
+    global monitor, fname, f, blocksize, sample, extra, sidecar, recording
+    if sample % blocksize:
+        flush()
+    monitor.info("Closing " + fname)
+    f.close()
+    if sidecar is not None:
+        sidecar.close()
+    recording = False
+
+
 def _setup():
     '''Initialize the module
     This adds a set of global variables
@@ -120,15 +179,14 @@ def _loop_once():
     '''
     global parser, args, config, r, response, patch
     global monitor, MININT16, MAXINT16, MININT32, MAXINT32, debug, delay, filename, fileformat, filenumber, recording, adjust
-    global start, fname, f, ext, blocksize, synchronize, channels, channelz, nchans, sample, replace, i, s, z, physical_min, physical_max, meas_info, chan_info, recstart, D, chan, xval, elapsed
+    global start, fname, f, ext, blocksize, synchronize, pattern, rescan, lastscan, channels, channelz, nchans, sample, extra, extrablock, sidecar, schema, added, key, replace, i, s, z, physical_min, physical_max, meas_info, chan_info, recstart, block, D, elapsed
 
     # measure the time to correct for the slip
     start = time.time()
 
     if recording and not patch.getint('recording', 'record'):
-        monitor.info("Recording disabled - closing " + fname)
-        f.close()
-        recording = False
+        monitor.info("Recording disabled")
+        close()
         return
 
     if not recording and not patch.getint('recording', 'record'):
@@ -142,17 +200,26 @@ def _loop_once():
         if len(ext) == 0:
             ext = '.' + fileformat
         fname = name + '_' + datetime.datetime.now().strftime("%Y.%m.%d_%H.%M.%S") + ext
-        # the blocksize is always 1
-        blocksize = 1
+        # the samples are accumulated and written to file in blocks
+        blocksize = patch.getint('recording', 'blocksize', default=1)
         synchronize = int(patch.getfloat('recording', 'synchronize') / delay)
         assert (synchronize % blocksize) == 0, "synchronize should be multiple of blocksize"
 
         # get the details from Redis
-        channels = sorted(r.keys('*'))
-        channelz = sorted(r.keys('*'))
+        pattern = patch.getstring('recording', 'pattern', default='*')
+        rescan = patch.getfloat('recording', 'rescan', default=10)
+        channels = scankeys(pattern)
+        channelz = list(channels)
         nchans = len(channels)
         # this is to keep track of the number of samples written so far
         sample = 0
+        lastscan = time.time()
+
+        # controls that appear during the recording are written to a sidecar file
+        extra = []
+        extrablock = np.zeros((blocksize, 0))
+        sidecar = None
+        schema = False
 
         # search-and-replace to reduce the length of the channel labels
         for replace in config.items('replace'):
@@ -172,7 +239,7 @@ def _loop_once():
             # construct the header
             meas_info = {}
             chan_info = {}
-            meas_info['record_length'] = delay
+            meas_info['record_length'] = blocksize * delay
             meas_info['nchan'] = nchans
             recstart = datetime.datetime.now()
             meas_info['year'] = recstart.year
@@ -186,7 +253,7 @@ def _loop_once():
             chan_info['digital_min'] = nchans * [MININT16]
             chan_info['digital_max'] = nchans * [MAXINT16]
             chan_info['ch_names'] = channelz
-            chan_info['n_samps'] = nchans * [1]
+            chan_info['n_samps'] = nchans * [blocksize]
             f = EDF.EDFWriter(fname)
             f.writeHeader((meas_info, chan_info))
         elif fileformat == 'wav':
@@ -197,38 +264,40 @@ def _loop_once():
             f.setframerate(1. / delay)
         else:
             raise NotImplementedError('unsupported file format')
+        block = np.zeros((blocksize, nchans))
+
+    if recording and (time.time() - lastscan) > rescan:
+        # look for controls that have been added since the start of the recording
+        lastscan = time.time()
+        added = sorted(set(scankeys(pattern)) - set(channels) - set(extra))
+        if len(added):
+            if sidecar is None:
+                sidecar = open(os.path.splitext(fname)[0] + '.tsv', 'w')
+                monitor.info("Opening " + sidecar.name)
+            for key in added:
+                monitor.info("Writing control value " + key + " to " + sidecar.name)
+            extra += added
+            extrablock = np.hstack((extrablock, np.full((blocksize, len(added)), np.nan)))
+            schema = True
 
     if recording:
-        D = []
-        for chan in channels:
-            xval = r.get(chan)
-            try:
-                xval = float(xval)
-            except ValueError:
-                xval = 0.
-            xval = EEGsynth.limit(xval, physical_min, physical_max)
-            D.append([xval])
+        # get all values in a single round trip, MGET requires at least one key
+        if len(channels) + len(extra):
+            D = tofloat(r.mget(channels + extra))
+        else:
+            D = np.zeros(0)
+        D = np.clip(D, physical_min, physical_max)
+        block[sample % blocksize] = D[:nchans]
+        extrablock[sample % blocksize] = D[nchans:]
         sample += 1
 
+        if (sample % blocksize) == 0:
+            flush()
+
         if (sample % synchronize) == 0:
             key = "{}.synchronize".format(patch.getstring('prefix', 'synchronize'))
             patch.setvalue(key, sample)
 
-        monitor.info("Writing sample " + str(sample) + " as " + str(np.shape(D)))
-
-        if fileformat == 'edf':
-            f.writeBlock(D)
-        elif fileformat == 'wav':
-            D = np.asarray(D)
-            for x in D:
-                # scale the floating point values between -1 and 1
-                y = x / ((physical_max - physical_min) / 2.)
-                # scale the floating point values between MININT32 and MAXINT32
-                y = y * ((float(MAXINT32) - float(MININT32)) / 2.)
-                # convert them to packed binary data
-                z = "".join((wave.struct.pack('i', item) for item in y))
-                f.writeframesraw(z)
-
         time.sleep(adjust * delay)
 
         elapsed = time.time() - start
@@ -253,6 +322,9 @@ def _loop_forever():
 def _stop(*args):
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
+    global recording
+    if recording:
+        close()
     sys.exit()
 
 
@@ -86,13 +86,15 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, MININT16, MAXINT16, MININT32, MAXINT32, debug, timeout, filename, fileformat, ft_host, ft_port, ft_input, hdr_input, start, recording
+    global monitor, MININT16, MAXINT16, MININT24, MAXINT24, MININT32, MAXINT32, debug, timeout, filename, fileformat, ft_host, ft_port, ft_input, hdr_input, start, recording
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
 
     MININT16 = -0xffff / 2 - 1
     MAXINT16 = 0xffff / 2 - 1
+    MININT24 = -0x800000
+    MAXINT24 = 0x7fffff
     MININT32 = -0xffffffff / 2 - 1
     MAXINT32 = 0xffffffff / 2 - 1
 
@@ -142,8 +144,8 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, MININT16, MAXINT16, MININT32, MAXINT32, debug, timeout, filename, fileformat, ft_host, ft_port, ft_input, hdr_input, start, recording
-    global fname, f, ext, blocksize, synchronize, physical_min, physical_max, meas_info, chan_info, now, begsample, endsample, startsample, dat, key
+    global monitor, MININT16, MAXINT16, MININT24, MAXINT24, MININT32, MAXINT32, debug, timeout, filename, fileformat, ft_host, ft_port, ft_input, hdr_input, start, recording
+    global fname, f, ext, blocksize, synchronize, physical_min, physical_max, meas_info, chan_info, now, begsample, endsample, startsample, block, dat, key
 
     hdr_input = ft_input.getHeader()
 
@@ -175,18 +177,19 @@ def _loop_once():
         synchronize = int(patch.getfloat('recording', 'synchronize') * hdr_input.fSample)
         assert (synchronize % blocksize) == 0, "synchronize should be multiple of blocksize"
 
-        # these are required for mapping floating point values onto 16 bit integers
+        # these are required for mapping floating point values onto 16 or 24 bit integers
         physical_min = patch.getfloat('recording', 'physical_min')
         physical_max = patch.getfloat('recording', 'physical_max')
 
         # write the header to file
         monitor.info("Opening " + fname)
-        if fileformat == 'edf':
+        if fileformat in ('edf', 'bdf'):
             # construct the header
             meas_info = {}
             chan_info = {}
             meas_info['record_length'] = blocksize / hdr_input.fSample
             meas_info['nchan'] = hdr_input.nChannels
+            meas_info['subtype'] = fileformat
             now = datetime.datetime.now()
             meas_info['year'] = now.year
             meas_info['month'] = now.month
@@ -196,8 +199,12 @@ def _loop_once():
             meas_info['second'] = now.second
             chan_info['physical_min'] = hdr_input.nChannels * [physical_min]
             chan_info['physical_max'] = hdr_input.nChannels * [physical_max]
-            chan_info['digital_min'] = hdr_input.nChannels * [MININT16]
-            chan_info['digital_max'] = hdr_input.nChannels * [MAXINT16]
+            if fileformat == 'bdf':
+                chan_info['digital_min'] = hdr_input.nChannels * [MININT24]
+                chan_info['digital_max'] = hdr_input.nChannels * [MAXINT24]
+            else:
+                chan_info['digital_min'] = hdr_input.nChannels * [MININT16]
+                chan_info['digital_max'] = hdr_input.nChannels * [MAXINT16]
             chan_info['ch_names'] = hdr_input.labels
             chan_info['n_samps'] = hdr_input.nChannels * [blocksize]
             monitor.info(chan_info)
@@ -222,26 +229,27 @@ def _loop_once():
         # remember the sample from the data stream at which the recording started
         startsample = begsample
 
-    if recording and hdr_input.nSamples < begsample - 1:
-        monitor.info("Header was reset - closing " + fname)
-        f.close()
-        recording = False
-        return
-
-    if recording and endsample > hdr_input.nSamples - 1:
-        # the data is not yet available
-        monitor.debug("Waiting for data", endsample, hdr_input.nSamples)
-        time.sleep((endsample - hdr_input.nSamples) / hdr_input.fSample)
-        return
-
     if recording:
-        # the data is available, send a synchronization trigger prior to reading the data
+        # wait for at most one block until the data is available and read it
+        monitor.debug("Waiting for data", endsample, hdr_input.nSamples)
+        try:
+            block = ft_input.readNext(blocksize, blocksize / hdr_input.fSample, begsample=begsample)
+        except RuntimeError:
+            monitor.info("Header was reset - closing " + fname)
+            f.close()
+            recording = False
+            return
+        if block is None:
+            # the data is not yet available
+            return
+
+        # the data is available, send a synchronization trigger prior to writing the data
         if ((endsample - startsample + 1) % synchronize) == 0:
             key = "{}.synchronize".format(patch.getstring('prefix', 'synchronize'))
             patch.setvalue(key, endsample - startsample + 1)
-        dat = ft_input.getData([begsample, endsample]).astype(np.float64)
+        dat = block[0].astype(np.float64)
         monitor.info("Writing sample " + str(begsample) + " to " + str(endsample) + " as " + str(np.shape(dat)))
-        if fileformat == 'edf':
+        if fileformat in ('edf', 'bdf'):
             # the scaling is done in the EDF writer
             f.writeBlock(np.transpose(dat))
         elif fileformat == 'wav':
@@ -21,7 +21,6 @@
 
 import configparser
 import argparse
-import math
 import numpy as np
 import os
 import redis
@@ -99,7 +98,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input, name
-    global timeout, hdr_input, start, channel_items, channame, chanindx, item, prefix, window, begsample, endsample
+    global timeout, hdr_input, start, channel_items, channame, chanindx, item, prefix, measure, keys, window, reducer, begsample, endsample
 
     # this is the timeout for the FieldTrip buffer
     timeout = patch.getfloat('fieldtrip', 'timeout', default=30)
@@ -126,9 +125,16 @@ def _start():
         chanindx.append(patch.getint('input', item[0]) - 1)  # the channel number
 
     prefix = patch.getstring('output', 'prefix')
+    measure = patch.getstring('processing', 'measure', default='rms')  # rms, meanabs or peak
     window = patch.getfloat('processing', 'window')     # in seconds
     window = int(window * hdr_input.fSample)            # in samples
 
+    # send it as control value: prefix.channelX=val
+    keys = ["%s.%s" % (prefix, name) for name in channame]
+
+    # the sliding window is updated with the new samples only
+    reducer = EEGsynth.channelreducer(window, len(chanindx))
+
     begsample = -1
     endsample = -1
 
@@ -142,7 +148,7 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input
-    global timeout, hdr_input, start, channel_items, channame, chanindx, item, prefix, window, begsample, endsample
+    global timeout, hdr_input, start, channel_items, channame, chanindx, item, prefix, measure, keys, window, reducer, begsample, endsample
     global dat, rms, i, chanvec, chanval, name, val, key
 
     hdr_input = ft_input.getHeader()
@@ -153,26 +159,27 @@ def _loop_once():
         monitor.info('Waiting for data to arrive...')
         return
 
-    # get the most recent data segment
-    begsample = hdr_input.nSamples - window
+    # get the data that is new since the previous iteration, at most one window
+    begsample = max(endsample + 1, hdr_input.nSamples - window)
     endsample = hdr_input.nSamples - 1
+    if endsample < begsample:
+        return
     dat = ft_input.getData([begsample, endsample]).astype(np.double)
     dat = dat[:, chanindx]
 
-    rms = [0.] * len(chanindx)
-    for i, chanvec in enumerate(dat.transpose()):
-        for chanval in chanvec:
-            rms[i] += chanval * chanval
-        if rms[i]>0:
-            # this avoids an occasional "ValueError: math domain error"
-            rms[i] = math.sqrt(rms[i] / window)
+    reducer.append(dat)
+    if measure == 'meanabs':
+        val = reducer.meanabs()
+    elif measure == 'peak':
+        val = reducer.peak()
+    else:
+        val = reducer.rms()
+    val = val.tolist()
 
-    monitor.update("rms", rms)
+    monitor.update(measure, val)
 
-    for name, val in zip(channame, rms):
-        # send it as control value: prefix.channelX=val
-        key = "%s.%s" % (prefix, name)
-        patch.setvalue(key, val)
+    # send all values at once
+    patch.setvalues(dict(zip(keys, val)))
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# Benchmark for the latency between a trigger and the sound in the sampler module
+#
+# This software is part of the EEGsynth project, see <https://github.com/eegsynth/eegsynth>.
+#
+# Copyright (C) 2020 EEGsynth project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import numpy as np
+import os
+import sys
+import tempfile
+import threading
+import time
+from scipy.io import wavfile
+
+path = os.path.split(os.path.abspath(__file__))[0]
+
+# eegsynth/lib contains shared modules
+sys.path.insert(0, os.path.join(path, '../../lib'))
+from sampler import VoiceMixer, pcm2float, prepare
+
+
+def legacy_prepare(filename, channels, gain, speed, onset, offset, taper):
+    # this is how each trigger used to be handled, it serves as reference
+    rate, dat = wavfile.read(filename)
+    dat = np.reshape(dat, (dat.shape[0], channels))
+    begsample = round(dat.shape[0] * onset)
+    endsample = max(begsample, round(dat.shape[0] * offset))
+    count = round((endsample - begsample) / speed)
+    selection = np.linspace(begsample, endsample - 1, count).astype(np.int32)
+    dat = dat[selection].astype(np.float32) / 32767.
+    if taper > 0:
+        n = np.floor(dat.shape[0] * taper / 2).astype(int)
+        tap = np.concatenate((np.linspace(0, 1, n), np.ones(dat.shape[0] - 2 * n), np.linspace(1, 0, n))).astype(dat.dtype)
+        for i in range(channels):
+            dat[:, i] = np.multiply(dat[:, i], tap)
+    dat *= gain
+    return dat
+
+
+def timeit(fun, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fun()
+    return (time.perf_counter() - start) / repeat
+
+
+def percentile(x, p):
+    return 1000 * np.percentile(x, p) if len(x) else np.nan
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=int, default=44100, help="sampling rate in Hz")
+    parser.add_argument("--channels", type=int, default=2, help="number of audio channels")
+    parser.add_argument("--duration", type=float, default=2., help="duration of each sample in seconds")
+    parser.add_argument("--files", type=int, default=8, help="number of sample files")
+    parser.add_argument("--voices", type=int, nargs='+', default=[1, 8, 32], help="number of voices")
+    parser.add_argument("--blocksize", type=int, default=256, help="number of frames per audio callback")
+    parser.add_argument("--triggers", type=int, default=200, help="number of triggers")
+    parser.add_argument("--interval", type=float, default=0.02, help="average time between triggers in seconds")
+    args = parser.parse_args()
+
+    # create the sample files, these are removed once they have been read
+    with tempfile.TemporaryDirectory() as tempdir:
+        filenames = [os.path.join(tempdir, '%02d.wav' % (i + 1)) for i in range(args.files)]
+        for filename in filenames:
+            dat = np.random.randn(int(args.duration * args.rate), args.channels) * 3000
+            wavfile.write(filename, args.rate, dat.astype(np.int16))
+        bank = dict([(filename, pcm2float(wavfile.read(filename)[1].reshape(-1, args.channels))) for filename in filenames])
+
+        parameters = (0.5, 1.2, 0.1, 0.9, 0.1)
+        t_legacy = timeit(lambda: legacy_prepare(filenames[0], args.channels, *parameters), 20)
+        t_bank = timeit(lambda: prepare(bank[filenames[0]], *parameters), 20)
+    print('handling a trigger takes %.2f ms when reading the file and %.2f ms from the preloaded bank' % (1000 * t_legacy, 1000 * t_bank))
+    print('')
+
+    period = args.blocksize / float(args.rate)
+    print('%6s %12s %12s %12s %12s %12s %8s' % ('voices', 'p50 (ms)', 'p99 (ms)', 'max (ms)', 'mix (ms)', 'maxmix (ms)', 'stolen'))
+    for nvoices in args.voices:
+        mixer = VoiceMixer(nvoices, args.channels, args.blocksize)
+        running = True
+
+        def audio():
+            # this stands in for the audio callback, which is called once per block by the audio card
+            deadline = time.perf_counter()
+            while running:
+                deadline += period
+                mixer.read(args.blocksize)
+                naptime = deadline - time.perf_counter()
+                if naptime > 0:
+                    time.sleep(naptime)
+
+        thread = threading.Thread(target=audio)
+        thread.start()
+        for i in range(args.triggers):
+            time.sleep(np.random.exponential(args.interval))
+            triggered = time.perf_counter()
+            mixer.play(prepare(bank[filenames[i % args.files]], *parameters), 'trigger', i + 1, triggered)
+        running = False
+        thread.join()
+
+        # the sound starts at the latest one block after the callback, plus the output latency of the audio card
+        latency = []
+        while len(mixer.notifications):
+            kind, owner, value, elapsed = mixer.notifications.popleft()
+            if kind == 'started':
+                latency.append(elapsed + period)
+        print('%6d %12.2f %12.2f %12.2f %12.3f %12.3f %8d' % (nvoices, percentile(latency, 50), percentile(latency, 99), percentile(latency, 100), 1000 * mixer.elapsed / mixer.callbacks, 1000 * mixer.maxelapsed, mixer.stolen))
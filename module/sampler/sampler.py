@@ -30,6 +30,7 @@ import sys
 import time
 import pyaudio
 import threading
+import collections
 
 if hasattr(sys, 'frozen'):
     path = os.path.split(sys.executable)[0]
@@ -53,33 +54,147 @@ sys.path.insert(0, os.path.join(path, '../../lib'))
 import EEGsynth
 
 
-def callback(in_data, frame_count, time_info, status):
-    global lock, debug, stack, channels, prefix, current_channel, current_value
-
-    with lock:
-        begsample = 0
-        endsample = min(frame_count, stack.shape[0])
-        dat = stack[begsample:endsample]
-        # add zero-padding if required
-        pad = np.zeros((frame_count - endsample, channels), dtype=np.float32)
-        dat = np.concatenate((dat, pad), axis=0)
-        # remove the current samples from the stack
-        stack = stack[endsample:]
-
-    if stack.shape[0] == 0 and current_channel != None:
-        # send a trigger to indicate that the sample finished playing
-        patch.setvalue("%s.%s" % (finished, current_channel), current_value)
-        current_channel = None
-        current_value = 0
+def pcm2float(dat):
+    # scale 8, 16 and 32 bit PCM to float, with values between -1.0 and +1.0
+    if dat.dtype == np.uint8:
+        return (dat.astype(np.float32) - 128.) / 128.
+    elif dat.dtype == np.int16:
+        return dat.astype(np.float32) / 32768.
+    elif dat.dtype == np.int32:
+        return dat.astype(np.float32) / 2147483648.
+    else:
+        return dat.astype(np.float32)
+
+
+def prepare(dat, gain, speed, onset, offset, taper):
+    # trim to the onset/offset, adjust the speed, apply the scaling and taper the rising and falling flank
+    # the samples in the bank are not modified, this returns a new array
+    begsample = int(round(dat.shape[0] * onset))
+    endsample = max(begsample, int(round(dat.shape[0] * offset)))
+    dat = dat[begsample:endsample]
+    count = int(round(dat.shape[0] / speed)) if speed > 0 else 0
+    if count != dat.shape[0] and dat.shape[0] > 1 and count > 0:
+        # resample with linear interpolation
+        position = np.linspace(0, dat.shape[0] - 1, count)
+        floor = np.minimum(position.astype(int), dat.shape[0] - 2)
+        frac = (position - floor).astype(np.float32)[:, np.newaxis]
+        after = np.take(dat, floor + 1, axis=0)
+        after *= frac * np.float32(gain)
+        dat = np.take(dat, floor, axis=0)
+        dat *= (1 - frac) * np.float32(gain)
+        dat += after
+    elif count == 0:
+        dat = dat[0:0] * np.float32(gain)
+    else:
+        dat = dat * np.float32(gain)
+    n = int(dat.shape[0] * taper / 2)
+    if n > 0:
+        ramp = np.linspace(0, 1, n, dtype=np.float32)[:, np.newaxis]
+        dat[:n] *= ramp
+        dat[-n:] *= ramp[::-1]
+    return dat
+
+
+class VoiceMixer():
+    """Mix the samples that are playing into the audio output. Each trigger is assigned to
+    one of a fixed number of voices. If all voices are playing, the one that started first is
+    replaced. The triggers are passed to the audio callback through a queue that does not
+    require locking, and the callback mixes the voices in a preallocated buffer. The callback
+    does not communicate with Redis, the notifications that a sample started or finished are
+    passed on to the main thread through another queue that does not require locking. A sample
+    that is replaced or stopped also counts as finished.
+    """
+
+    def __init__(self, nvoices, channels, frames=1024):
+        self.nvoices = int(nvoices)
+        self.channels = int(channels)
+        self.commands = collections.deque()     # appending and popping is thread-safe
+        self.notifications = collections.deque()
+        self.data = [None] * self.nvoices
+        self.position = [0] * self.nvoices
+        self.owner = [None] * self.nvoices
+        self.value = [0] * self.nvoices
+        self.started = [0] * self.nvoices
+        self.count = 0
+        self.stolen = 0
+        self.callbacks = 0
+        self.elapsed = 0.           # the total time spent in the callback
+        self.maxelapsed = 0.
+        self.allocate(frames)
+
+    def allocate(self, frames):
+        self.output = np.zeros((frames, self.channels), dtype=np.float32)
+
+    def play(self, dat, owner, value, triggered=None):
+        # this is called by the trigger threads
+        if triggered is None:
+            triggered = time.perf_counter()
+        self.commands.append((dat, owner, value, triggered))
+
+    def stop(self, owner):
+        # this is called by the trigger threads
+        self.commands.append((None, owner, 0, None))
+
+    def finish(self, voice):
+        # this is called by the audio callback
+        self.notifications.append(('finished', self.owner[voice], self.value[voice], None))
+        self.data[voice] = None
+        self.owner[voice] = None
+
+    def read(self, frames):
+        # this is called by the audio callback
+        start = time.perf_counter()
+        while len(self.commands):
+            dat, owner, value, triggered = self.commands.popleft()
+            if dat is None:
+                # stop all samples that were started by this trigger
+                for voice in range(self.nvoices):
+                    if self.owner[voice] == owner:
+                        self.finish(voice)
+                continue
+            free = [voice for voice in range(self.nvoices) if self.data[voice] is None]
+            if len(free):
+                voice = free[0]
+            else:
+                voice = self.started.index(min(self.started))
+                self.stolen += 1
+                self.finish(voice)
+            self.count += 1
+            self.data[voice] = dat
+            self.position[voice] = 0
+            self.owner[voice] = owner
+            self.value[voice] = value
+            self.started[voice] = self.count
+            self.notifications.append(('started', owner, value, start - triggered))
+
+        if frames > self.output.shape[0]:
+            # this only happens if the audio card changes the block size
+            self.allocate(frames)
+        output = self.output[:frames]
+        output.fill(0)
+        for voice in range(self.nvoices):
+            dat = self.data[voice]
+            if dat is None:
+                continue
+            begsample = self.position[voice]
+            endsample = min(begsample + frames, dat.shape[0])
+            output[:endsample - begsample] += dat[begsample:endsample]
+            self.position[voice] = endsample
+            if endsample == dat.shape[0]:
+                self.finish(voice)
+        np.clip(output, -1, 1, out=output)
+
+        elapsed = time.perf_counter() - start
+        self.callbacks += 1
+        self.elapsed += elapsed
+        self.maxelapsed = max(self.maxelapsed, elapsed)
+        return output
 
-    try:
-        # this is for Python 2
-        buf = np.getbuffer(dat)
-    except:
-        # this is for Python 3
-        buf = dat.tobytes()
 
-    return buf, pyaudio.paContinue
+def callback(in_data, frame_count, time_info, status):
+    global mixer
+    # this is called by PortAudio, it should only mix the voices in the preallocated buffer
+    return mixer.read(frame_count).tobytes(), pyaudio.paContinue
 
 
 class TriggerThread(threading.Thread):
@@ -93,7 +208,7 @@ class TriggerThread(threading.Thread):
         self.running = False
 
     def run(self):
-        global r, monitor, patch, stack, current_channel, current_value
+        global r, monitor, patch, mixer, bank, rate, scaling_method, scale_scaling, scale_speed, scale_onset, scale_offset, scale_taper, offset_scaling, offset_speed, offset_onset, offset_offset, offset_taper
         pubsub = r.pubsub()
         pubsub.subscribe('SAMPLER_UNBLOCK')  # this message unblocks the Redis listen command
         pubsub.subscribe(self.redischannel)  # this message triggers the event
@@ -102,6 +217,7 @@ class TriggerThread(threading.Thread):
                 if not self.running or not item['type'] == 'message':
                     break
                 if item['channel'] == self.redischannel:
+                    triggered = time.perf_counter()
                     # if value=0, the previous sample is stopped
                     # if value=N, the Nth sample is played
                     val = float(item['data'])
@@ -111,90 +227,46 @@ class TriggerThread(threading.Thread):
                     val = int(val)
 
                     if val == 0:
-                        if current_channel == self.redischannel:
-                            with lock:
-                                stack = np.zeros((0, channels), dtype=np.float32)
-                                current_channel = None
-                                current_value = val
+                        mixer.stop(self.redischannel)
 
                     elif len(self.sample) >= val:
-                        # update the parameters
-                        scaling = patch.getfloat('audio', 'scaling', default=1)
+                        # update the parameters, all of them are retrieved in a single round trip
+                        scaling, speed, onset, offset, taper = patch.getfloats('audio', ['scaling', 'speed', 'onset', 'offset', 'taper'], default=[1, 1, 0, 1, 0])
                         scaling = EEGsynth.rescale(scaling, slope=scale_scaling, offset=offset_scaling)
-                        monitor.update("scaling", scaling)
-
-                        speed = patch.getfloat('audio', 'speed', default=1)
                         speed = EEGsynth.rescale(speed, slope=scale_speed, offset=offset_speed)
-                        monitor.update("speed", speed)
-
-                        onset = patch.getfloat('audio', 'onset', default=0)
                         onset = EEGsynth.rescale(onset, slope=scale_onset, offset=offset_onset)
-                        monitor.update("onset", onset)
-
-                        offset = patch.getfloat('audio', 'offset', default=1)
                         offset = EEGsynth.rescale(offset, slope=scale_offset, offset=offset_offset)
-                        monitor.update("offset", offset)
-
-                        taper = patch.getfloat('audio', 'taper', default=0)
                         taper = EEGsynth.rescale(taper, slope=scale_taper, offset=offset_taper)
+                        monitor.update("scaling", scaling)
+                        monitor.update("speed", speed)
+                        monitor.update("onset", onset)
+                        monitor.update("offset", offset)
                         monitor.update("taper", taper)
 
-                        # read the audio file
+                        # the audio file has already been read
                         filename = self.sample[val - 1]
-                        try:
-                            rate, dat = wavfile.read(filename)
-                            # ensure it is a two-dimensional array with samples*channels
-                            dat = np.reshape(dat, (dat.shape[0], channels))
-                            # trim to the onset/offset and adjust the speed
-                            begsample = round(dat.shape[0] * onset)
-                            endsample = round(dat.shape[0] * offset)
-                            endsample = max(begsample, endsample)
-                            count = round((endsample - begsample) / speed)
-                            selection = np.linspace(begsample, endsample - 1, count).astype(np.int32)
-                            dat = dat[selection]
-                            monitor.info("playing %s for up to %d ms" % (filename, 1000 * dat.shape[0] / rate))
-                        except:
-                            module.warning("cannot load %s" % filename)
+                        if bank.get(filename) is None:
+                            monitor.warning("cannot play %s" % filename)
                             continue
 
-                        # deal with empty files or selections
-                        if dat.shape[0] == 0:
-                            dat = np.zeros((1, channels))
-
-                        # scale 8, 16 and 32 bit PCM to float, with values between -1.0 and +1.0
-                        if dat.dtype == np.uint8:
-                            dat = (dat.astype(np.float32) - 127.) / 255.
-                        elif dat.dtype == np.int16:
-                            dat = dat.astype(np.float32) / 32767.
-                        elif dat.dtype == np.int32:
-                            dat = dat.astype(np.float32) / 2147483647.
-
-                        # taper the rising and falling flank
-                        if taper > 0:
-                            n = np.floor(dat.shape[0] * taper / 2).astype(int)
-                            tap = np.concatenate((np.linspace(0, 1, n), np.ones(
-                                dat.shape[0] - 2 * n), np.linspace(1, 0, n))).astype(dat.dtype)
-                            for i in range(channels):
-                                dat[:, i] = np.multiply(dat[:, i], tap)
-
-                        # apply the user-specified scaling
                         if scaling_method == 'multiply':
-                            dat *= scaling
+                            gain = scaling
                         elif scaling_method == 'divide':
-                            dat /= scaling
+                            gain = 1. / scaling
                         elif scaling_method == 'db':
-                            dat *= np.power(10., scaling / 20.)
+                            gain = np.power(10., scaling / 20.)
+
+                        dat = prepare(bank[filename], gain, speed, onset, offset, taper)
+
+                        # deal with empty files or selections
+                        if dat.shape[0] == 0:
+                            dat = np.zeros((1, mixer.channels), dtype=np.float32)
 
                         if np.min(dat) < -1 or np.max(dat) > 1:
                             monitor.warning('WARNING: signal exceeds [-1,+1] range, the audio will clip')
 
-                        with lock:
-                            # replace the current playback stack
-                            stack = dat
-                            current_channel = self.redischannel
-                            current_value = val
-                            # send a trigger to indicate that the sample started playing
-                            patch.setvalue("%s.%s" % (started, current_channel), current_value)
+                        monitor.info("playing %s for up to %d ms" % (filename, 1000 * dat.shape[0] / rate))
+                        mixer.play(dat, self.redischannel, val, triggered)
 
 
 def _setup():
@@ -229,7 +301,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, debug, device, scaling_method, scaling, speed, onset, offset, taper, scale_scaling, scale_speed, scale_onset, scale_offset, scale_taper, offset_scaling, offset_speed, offset_onset, offset_offset, offset_taper, started, finished, p, info, i, devinfo, lock, input_channel, input_sample, rate, dat, channels, stack, current_channel, current_value, trigger, channel, sample, thread, stream
+    global monitor, debug, device, scaling_method, scaling, speed, onset, offset, taper, scale_scaling, scale_speed, scale_onset, scale_offset, scale_taper, offset_scaling, offset_speed, offset_onset, offset_offset, offset_taper, started, finished, voices, blocksize, p, info, i, devinfo, input_channel, input_sample, rate, channels, bank, filename, filerate, dat, mixer, trigger, channel, sample, thread, stream
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
@@ -255,6 +327,8 @@ def _start():
     offset_taper = patch.getfloat('offset', 'taper', default=0)
     started = patch.getstring('prefix', 'started', default='started')
     finished = patch.getstring('prefix', 'finished', default='finished')
+    voices = patch.getint('audio', 'voices', default=8)
+    blocksize = patch.getint('audio', 'blocksize', default=256)
 
     p = pyaudio.PyAudio()
 
@@ -273,25 +347,33 @@ def _start():
     monitor.info(devinfo)
     monitor.info('------------------------------------------------------------------')
 
-    # this is to prevent concurrency problems
-    lock = threading.Lock()
-
     input_channel, input_sample = list(zip(*config.items('input')))
     input_sample = [x.split(',') for x in input_sample]
 
-    # open first file to determine the format
-    rate, dat = wavfile.read(input_sample[0][0])
-
-    if len(dat.shape) == 1:
-        channels = 1
-    else:
-        channels = dat.shape[1]
-
-    stack = np.zeros((0, channels), dtype=np.float32)
-
-    # these serve to remember the channel that triggered the sample
-    current_channel = None
-    current_value = 0
+    # read all audio files and convert them to float, the first file determines the format
+    rate = None
+    channels = None
+    bank = {}
+    for filename in sorted(set(sum(input_sample, []))):
+        try:
+            filerate, dat = wavfile.read(filename)
+        except:
+            monitor.warning("cannot load %s" % filename)
+            continue
+        # ensure it is a two-dimensional array with samples*channels
+        dat = pcm2float(dat.reshape(dat.shape[0], -1))
+        if rate is None:
+            rate, channels = filerate, dat.shape[1]
+        if filerate != rate or dat.shape[1] != channels:
+            monitor.warning("%s does not have the same sampling rate and number of channels as the other files" % filename)
+            continue
+        bank[filename] = dat
+    if rate is None:
+        raise RuntimeError("cannot load any of the audio files")
+    monitor.info("loaded %d audio files with %d channels at %d Hz" % (len(bank), channels, rate))
+
+    # the voices are mixed in the audio callback
+    mixer = VoiceMixer(voices, channels, blocksize)
 
     # create the background threads that deal with the triggers
     trigger = []
@@ -308,6 +390,7 @@ def _start():
                     rate=rate,
                     output=True,
                     output_device_index=device,
+                    frames_per_buffer=blocksize,
                     stream_callback=callback)
 
     # start the output stream
@@ -320,8 +403,27 @@ def _start():
 
 def _loop_once():
     '''Run the main loop once
+    This uses the global variables from setup and start, and adds a set of global variables
     '''
-    pass
+    global parser, args, config, r, response, patch
+    global monitor, mixer, started, finished
+    global kind, owner, value, latency
+
+    # send the notifications from the audio callback, this is not done in the callback itself
+    if not len(mixer.notifications):
+        time.sleep(0.01)
+        return
+    kind, owner, value, latency = mixer.notifications.popleft()
+
+    if kind == 'started':
+        monitor.debug("%s started after %.1f ms" % (owner, latency * 1000))
+        patch.setvalue("%s.%s" % (started, owner), value)
+    elif kind == 'finished':
+        patch.setvalue("%s.%s" % (finished, owner), value)
+
+    # there should not be any local variables in this function, they should all be global
+    if len(locals()):
+        print('LOCALS: ' + ', '.join(locals().keys()))
 
 
 def _loop_forever():
@@ -336,7 +438,8 @@ def _loop_forever():
 def _stop(*args):
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
-    global monitor, stream, p, trigger
+    global monitor, stream, p, trigger, mixer
+    monitor.info("mixed %d callbacks in %.3f ms on average and %.3f ms at most, %d voices were replaced" % (mixer.callbacks, 1000 * mixer.elapsed / max(mixer.callbacks, 1), 1000 * mixer.maxelapsed, mixer.stolen))
     monitor.success("Closing stream")
     stream.stop_stream()
     stream.close()
@@ -51,9 +51,8 @@ sys.path.insert(0, os.path.join(path, '../../lib'))
 import EEGsynth
 
 
-class SequenceThread(threading.Thread):
+class SequenceHandler():
     def __init__(self, redischannel, key):
-        threading.Thread.__init__(self)
         self.redischannel = redischannel
         self.key = key
         self.sequence = []
@@ -62,7 +61,6 @@ class SequenceThread(threading.Thread):
         self.steptime = 0.
         self.prevtime = None
         self.step = 0
-        self.running = True
 
     def setSequence(self, sequence):
         with lock:
@@ -76,51 +74,40 @@ class SequenceThread(threading.Thread):
         with lock:
             self.duration = duration
 
-    def stop(self):
-        self.running = False
-
-    def run(self):
+    def process(self, item):
         global r, monitor, patch
-        pubsub = r.pubsub()
-        pubsub.subscribe('SEQUENCER_UNBLOCK')  # this message unblocks the redis listen command
-        pubsub.subscribe(self.redischannel)    # this message contains the note
-        while self.running:
-            for item in pubsub.listen():
-                if not self.running or not item['type'] == 'message':
-                    break
-                if item['channel'] == self.redischannel:
-                    now = time.time()
-                    if self.prevtime != None:
-                        self.steptime = now - self.prevtime
-                    self.prevtime = now
-                    if len(self.sequence) > 0:
-                        # the sequence can consist of a list of values or a list of Redis channels
-                        val = self.sequence[self.step % len(self.sequence)]
-
-                        try:
-                            # convert the string from the ini to floating point
-                            val = float(val)
-                        except:
-                            # get the value from Redis
-                            val = r.get(val)
-                            if val == None:
-                                val = 0.
-                            else:
-                                # convert the string from Redis to floating point
-                                val = float(val)
-
-                        # apply the scaling, offset and transpose the note
-                        val = EEGsynth.rescale(val, slope=scale_note, offset=offset_note)
-                        val += self.transpose
-                        # send it as sequencer.note with the note as value
-                        patch.setvalue(self.key, val, duration=self.duration * self.steptime)
-                        if val >= 1.:
-                            # send it also as sequencer.noteXXX with value 1.0
-                            key = '%s%03d' % (self.key, val)
-                            patch.setvalue(key, 1., duration=self.duration * self.steptime)
-                        monitor.info("step %2d : %s = %g" % (self.step + 1, self.key, val))
-                        # increment to the next step
-                        self.step = (self.step + 1) % len(self.sequence)
+        now = time.time()
+        if self.prevtime != None:
+            self.steptime = now - self.prevtime
+        self.prevtime = now
+        if len(self.sequence) > 0:
+            # the sequence can consist of a list of values or a list of Redis channels
+            val = self.sequence[self.step % len(self.sequence)]
+
+            try:
+                # convert the string from the ini to floating point
+                val = float(val)
+            except:
+                # get the value from Redis
+                val = r.get(val)
+                if val == None:
+                    val = 0.
+                else:
+                    # convert the string from Redis to floating point
+                    val = float(val)
+
+            # apply the scaling, offset and transpose the note
+            val = EEGsynth.rescale(val, slope=scale_note, offset=offset_note)
+            val += self.transpose
+            # send it as sequencer.note with the note as value
+            patch.setvalue(self.key, val, duration=self.duration * self.steptime)
+            if val >= 1.:
+                # send it also as sequencer.noteXXX with value 1.0
+                key = '%s%03d' % (self.key, val)
+                patch.setvalue(key, 1., duration=self.duration * self.steptime)
+            monitor.info("step %2d : %s = %g" % (self.step + 1, self.key, val))
+            # increment to the next step
+            self.step = (self.step + 1) % len(self.sequence)
 
 
 def _setup():
@@ -156,7 +143,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, stepsize, clock, prefix, scale_active, scale_transpose, scale_note, scale_duration, offset_active, offset_transpose, offset_note, offset_duration, lock, key, sequencethread
+    global monitor, stepsize, clock, prefix, scale_active, scale_transpose, scale_note, scale_duration, offset_active, offset_transpose, offset_note, offset_duration, lock, key, sequencehandler, trigger
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
@@ -182,9 +169,11 @@ def _start():
     # the notes will be sent to Redis using this key
     key = "{}.note".format(prefix)
 
-    # create and start the thread for the output
-    sequencethread = SequenceThread(clock, key)
-    sequencethread.start()
+    # the clock triggers the next step in the sequence
+    sequencehandler = SequenceHandler(clock, key)
+    trigger = EEGsynth.dispatcher(r, workers=1)
+    trigger.subscribe(clock, sequencehandler.process)
+    trigger.start()
 
     monitor.update('scale_active',     scale_active)
     monitor.update('scale_transpose',  scale_transpose)
@@ -205,7 +194,7 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, stepsize, clock, prefix, scale_active, scale_transpose, scale_note, scale_duration, offset_active, offset_transpose, offset_note, offset_duration, lock, key, sequencethread
+    global monitor, stepsize, clock, prefix, scale_active, scale_transpose, scale_note, scale_duration, offset_active, offset_transpose, offset_note, offset_duration, lock, key, sequencehandler, trigger
     global active, sequence, transpose, duration, elapsed, naptime
 
     # the active sequence is specified as an integer between 0 and 127
@@ -233,9 +222,9 @@ def _loop_once():
     monitor.update("transpose", transpose)
     monitor.update("duration",  duration)
 
-    sequencethread.setSequence(sequence)
-    sequencethread.setTranspose(transpose)
-    sequencethread.setDuration(duration)
+    sequencehandler.setSequence(sequence)
+    sequencehandler.setTranspose(transpose)
+    sequencehandler.setDuration(duration)
 
     # there should not be any local variables in this function, they should all be global
     if len(locals()):
@@ -264,16 +253,14 @@ def _loop_forever():
 def _stop(*args):
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
-    global monitor, patch, sequencethread, r
+    global monitor, patch, sequencehandler, trigger, r
     try:
         monitor.success("Disabling last note")
         patch.setvalue(key, 0.)
     except:
         pass
     monitor.success('Closing threads')
-    sequencethread.stop()
-    r.publish('SEQUENCER_UNBLOCK', 1)
-    sequencethread.join()
+    trigger.stop()
     sys.exit()
 
 
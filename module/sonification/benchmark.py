@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Benchmark for the modulation and mixing in the sonification module
+#
+# This software is part of the EEGsynth project, see <https://github.com/eegsynth/eegsynth>.
+#
+# Copyright (C) 2020 EEGsynth project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import numpy as np
+import os
+import sys
+import time
+
+path = os.path.split(os.path.abspath(__file__))[0]
+
+# eegsynth/lib contains shared modules
+sys.path.insert(0, os.path.join(path, '../../lib'))
+import EEGsynth
+from sonification import Sonifier
+
+
+def loop_sonification(dat_input, fsample, sample_rate, freqs, b, a, zi):
+    # this is how each block used to be sonified, it serves as reference
+    nInput = dat_input.shape[0]
+    nOutput = int(round(nInput * sample_rate / fsample))
+    dat_output = np.zeros(nOutput)
+    tim_input = np.linspace(0, nInput / fsample, nInput, endpoint=False)
+    tim_output = np.linspace(0, nInput / fsample, nOutput, endpoint=False)
+    for i in range(dat_input.shape[1]):
+        vec_output = np.interp(tim_output, tim_input, dat_input[:, i])
+        vec_output *= np.cos(tim_output * freqs[i] * 2 * np.pi)
+        vec_output, zi[i] = EEGsynth.online_filter(b[i], a[i], vec_output, zi=zi[i])
+        dat_output += vec_output
+    return dat_output
+
+
+def timeit(fun, repeat):
+    start = time.time()
+    for i in range(repeat):
+        fun()
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fsample", type=float, default=250., help="input sampling frequency in Hz")
+    parser.add_argument("--sample_rate", type=float, default=44100., help="output sampling frequency in Hz")
+    parser.add_argument("--window", type=float, default=1., help="block length in seconds")
+    parser.add_argument("--channels", type=int, nargs='+', default=[1, 8, 32, 64], help="number of channels")
+    parser.add_argument("--order", type=int, default=501, help="order of the sideband filter")
+    parser.add_argument("--repeat", type=int, default=5, help="number of repetitions")
+    parser.add_argument("--reference", action='store_true', help="also time the original loop, this is slow")
+    args = parser.parse_args()
+
+    nInput = int(round(args.window * args.fsample))
+    nOutput = int(round(args.window * args.sample_rate))
+
+    print('%8s %14s %14s %14s %10s' % ('channels', 'linear (ms)', 'polyphase (ms)', 'loop (ms)', 'realtime'))
+    for nchan in args.channels:
+        dat = np.random.randn(nInput, nchan)
+        freqs = 220. * 2**(np.arange(nchan) % 6)
+        mixing = np.ones((nchan, 1))
+
+        linear = Sonifier(nInput, nOutput, args.fsample, range(nchan), freqs, mixing, 'usb', args.order, 'linear')
+        polyphase = Sonifier(nInput, nOutput, args.fsample, range(nchan), freqs, mixing, 'usb', args.order, 'polyphase')
+        t_linear = timeit(lambda: linear.process(dat), args.repeat)
+        t_polyphase = timeit(lambda: polyphase.process(dat), args.repeat)
+
+        if args.reference:
+            b, a, zi = [None] * nchan, [None] * nchan, [None] * nchan
+            for i in range(nchan):
+                b[i], a[i], zi[i] = EEGsynth.initialize_online_filter(args.sample_rate, freqs[i], None, args.order, np.zeros(nOutput))
+            t_loop = timeit(lambda: loop_sonification(dat, args.fsample, args.sample_rate, freqs, b, a, zi), 1)
+            print('%8d %14.1f %14.1f %14.1f %10s' % (nchan, t_linear * 1000, t_polyphase * 1000, t_loop * 1000, max(t_linear, t_polyphase) < args.window))
+        else:
+            print('%8d %14.1f %14.1f %14s %10s' % (nchan, t_linear * 1000, t_polyphase * 1000, '-', max(t_linear, t_polyphase) < args.window))
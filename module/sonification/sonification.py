@@ -26,6 +26,8 @@ import os
 import redis
 import sys
 import time
+from scipy.signal import lfilter
+from scipy.sparse import csr_matrix
 
 if hasattr(sys, 'frozen'):
     path = os.path.split(sys.executable)[0]
@@ -50,6 +52,106 @@ import EEGsynth
 import FieldTrip
 
 
+def hilbert_transformer(order):
+    # windowed FIR approximation of the Hilbert transform, the order should be odd
+    # the group delay of the filter is (order-1)/2 samples
+    n = np.arange(order) - (order - 1) // 2
+    b = np.zeros(order)
+    b[n % 2 == 1] = 2 / (np.pi * n[n % 2 == 1])
+    return b * np.hamming(order)
+
+
+def interpolation_matrix(nInput, nOutput, quality):
+    # sparse matrix that maps the input samples, preceded by the last samples of the previous block, onto the output samples
+    # linear interpolation uses 2 samples, polyphase interpolation uses a windowed sinc over 16 samples
+    if quality == 'linear':
+        half = 1
+        kernel = lambda x: np.maximum(0, 1 - np.abs(x))
+    elif quality == 'polyphase':
+        half = 8
+        kernel = lambda x: np.sinc(x) * np.i0(8 * np.sqrt(np.maximum(0, 1 - (x / half)**2))) / np.i0(8)
+    else:
+        raise RuntimeError("unsupported quality '%s'" % quality)
+    # the position of each output sample, delayed by half the kernel to keep it causal
+    position = np.arange(nOutput) * float(nInput) / nOutput
+    floor = np.floor(position).astype(int)
+    taps = np.arange(-half + 1, half + 1)
+    weights = kernel((position - floor)[:, np.newaxis] - taps)
+    weights /= weights.sum(axis=1, keepdims=True)
+    columns = floor[:, np.newaxis] + taps + half - 1
+    rows = np.repeat(np.arange(nOutput), len(taps))
+    return csr_matrix((weights.ravel(), (rows, columns.ravel())), shape=(nOutput, nInput + 2 * half - 1)), 2 * half - 1
+
+
+class Sonifier():
+    """Modulate each selected EEG channel onto an audio carrier and mix them into the
+    audio channels. All channels are processed at once: the input channels are upsampled
+    with a single sparse matrix multiplication, the carriers are computed from precomputed
+    phase tables and the modulated signals are mixed with a matrix multiplication.
+
+    For a single sideband the Hilbert transform of the input is computed at the input
+    sampling rate with one multichannel filter. The filter state, the last input samples
+    and the phase of each carrier are carried over from one block to the next.
+    """
+
+    def __init__(self, nInput, nOutput, fsample, chans, freqs, mixing, sideband, order, quality, begsample=0):
+        self.chans = np.asarray(chans, dtype=int)       # the input channel for each carrier, zero-offset
+        self.nvoices = len(self.chans)
+        self.nInput = nInput
+        self.nOutput = nOutput
+
+        # the phase increment of each carrier per output sample
+        freqs = np.asarray(freqs, dtype=np.double)
+        increment = 2 * np.pi * freqs * nInput / (nOutput * fsample)
+        ramp = np.outer(np.arange(nOutput), increment)
+        self.costable = np.cos(ramp)
+        self.sintable = np.sin(ramp)
+        self.step = (nOutput * increment) % (2 * np.pi)
+        self.phase = (2 * np.pi * freqs * begsample / fsample) % (2 * np.pi)
+
+        if sideband in ['usb', 'lsb']:
+            order = int(order) + (int(order) % 2 == 0)  # ensure it is odd
+            self.b = hilbert_transformer(order)
+            self.zi = np.zeros((order - 1, self.nvoices))
+            self.delay = np.zeros(((order - 1) // 2, self.nvoices))
+            # x*cos(w*t) -/+ hilbert(x)*sin(w*t) results in the upper/lower sideband, scale it like a filtered double sideband
+            sign = -1 if sideband == 'usb' else 1
+            self.mixing = np.vstack((0.5 * mixing, sign * 0.5 * mixing))
+        else:
+            self.b = None
+            self.mixing = np.asarray(mixing, dtype=np.double)
+
+        self.interpolation, nhistory = interpolation_matrix(nInput, nOutput, quality)
+        self.history = np.zeros((nhistory, self.mixing.shape[0]))
+
+    def process(self, dat):
+        # returns the audio for a block of nInput samples, nOutput x audio channels
+        dat = dat[:, self.chans]
+        if self.b is not None:
+            hilbert, self.zi = lfilter(self.b, 1, dat, axis=0, zi=self.zi)
+            # delay the signal itself by the same amount as the Hilbert filter
+            dat = np.vstack((self.delay, dat))
+            dat, self.delay = dat[:self.nInput], dat[self.nInput:]
+            dat = np.hstack((dat, hilbert))
+
+        # upsample all channels, the last samples of the previous block ensure a continuous output
+        dat = np.vstack((self.history, dat))
+        self.history = dat[self.nInput:]
+        dat = self.interpolation.dot(dat)
+
+        # cos(ramp+phase) and sin(ramp+phase) follow from the precomputed tables
+        cosphase = np.cos(self.phase)
+        sinphase = np.sin(self.phase)
+        carrier = self.costable * cosphase - self.sintable * sinphase
+        if self.b is not None:
+            carrier = np.hstack((carrier, self.sintable * cosphase + self.costable * sinphase))
+        self.phase = (self.phase + self.step) % (2 * np.pi)
+
+        # modulate and mix all channels
+        dat *= carrier
+        return dat.dot(self.mixing)
+
+
 def _setup():
     '''Initialize the module
     This adds a set of global variables
@@ -108,7 +210,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input, ft_output, name
-    global timeout, hdr_input, start, sample_rate, f_shift, f_offset, f_order, window, sideband, left, right, scaling, scaling_method, scale_scaling, offset_scaling, default_scale, scale_lowpass, scale_highpass, offset_lowpass, offset_highpass, scale_filterorder, offset_filterorder, hdr_output, nInput, nOutput, begsample, endsample, dat_output, left_f, left_b, left_a, left_zi, right_f, right_b, right_a, right_zi, i, highpass, lowpass
+    global timeout, hdr_input, start, sample_rate, f_shift, f_offset, f_order, window, sideband, left, right, quality, scaling, scaling_method, scale_scaling, offset_scaling, default_scale, scale_lowpass, scale_highpass, offset_lowpass, offset_highpass, scale_filterorder, offset_filterorder, hdr_output, nInput, nOutput, begsample, endsample, left_f, right_f, mixing, sonifier
 
     # this is the timeout for the FieldTrip buffer
     timeout     = patch.getfloat('input_fieldtrip', 'timeout', default=30)
@@ -135,6 +237,7 @@ def _start():
     sideband    = patch.getstring('sonification', 'sideband')
     left        = patch.getint('sonification', 'left', multiple=True)
     right       = patch.getint('sonification', 'right', multiple=True)
+    quality     = patch.getstring('sonification', 'quality', default='linear')
 
     # these are for multiplying/attenuating the output signal
     scaling        = patch.getfloat('sonification', 'scaling')
@@ -184,52 +287,20 @@ def _start():
         begsample = hdr_input.nSamples-nInput
         endsample = hdr_input.nSamples-1
 
-    # this is for a single channel
-    dat_output = np.zeros(nOutput)
-
-    left_f = [None] * len(left)
-    left_b = [None] * len(left)
-    left_a = [None] * len(left)
-    left_zi = [None] * len(left)
-
-    right_f = [None] * len(right)
-    right_b = [None] * len(right)
-    right_a = [None] * len(right)
-    right_zi = [None] * len(right)
+    # the carrier frequency for each channel
+    if f_shift == 'linear':
+        left_f = [f_offset * (i + 1) for i in range(len(left))]
+        right_f = [f_offset * (i + 1) for i in range(len(right))]
+    else:
+        left_f = [f_offset * 2**i for i in range(len(left))]
+        right_f = [f_offset * 2**i for i in range(len(right))]
 
-    for i in range(0,len(left)):
-        if f_shift == 'linear':
-            left_f[i] = f_offset * (i + 1)
-        else:
-            left_f[i] = f_offset * 2**i
-
-        if sideband == 'usb':
-            highpass = left_f[i]
-            lowpass = None
-        elif sideband == 'lsb':
-            highpass = None
-            lowpass = left_f[i]
-        else:
-            highpass = None
-            lowpass = None
-        left_b[i], left_a[i], left_zi[i] = EEGsynth.initialize_online_filter(hdr_output.fSample, highpass, lowpass, f_order, dat_output)
+    # each modulated channel is added to the left or the right audio channel
+    mixing = np.zeros((len(left) + len(right), hdr_output.nChannels))
+    mixing[:len(left), 0] = 1
+    mixing[len(left):, -1] = 1
 
-    for i in range(0,len(right)):
-        if f_shift == 'linear':
-            right_f[i] = f_offset * (i + 1)
-        else:
-            right_f[i] = f_offset * 2**i
-
-        if sideband == 'usb':
-            highpass = right_f[i]
-            lowpass = None
-        elif sideband == 'lsb':
-            highpass = None
-            lowpass = right_f[i]
-        else:
-            highpass = None
-            lowpass = None
-        right_b[i], right_a[i], right_zi[i] = EEGsynth.initialize_online_filter(hdr_output.fSample, highpass, lowpass, f_order, dat_output)
+    sonifier = Sonifier(nInput, nOutput, hdr_input.fSample, [chan - 1 for chan in left + right], left_f + right_f, mixing, sideband, f_order, quality, begsample)
 
     monitor.info("left audio channels = " + str(left))
     monitor.info("left audio frequencies = " + str(left_f))
@@ -246,8 +317,8 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input, ft_output
-    global timeout, hdr_input, start, sample_rate, f_shift, f_offset, f_order, window, sideband, left, right, scaling, scaling_method, scale_scaling, offset_scaling, default_scale, scale_lowpass, scale_highpass, offset_lowpass, offset_highpass, scale_filterorder, offset_filterorder, hdr_output, nInput, nOutput, begsample, endsample, dat_output, left_f, left_b, left_a, left_zi, right_f, right_b, right_a, right_zi, i, highpass, lowpass
-    global dat_input, begtime, endtime, tim_input, tim_output, chan, vec_output, highpassfilter, lowpassfilter, filterorder, change, b, a, zi, duration, desired
+    global timeout, hdr_input, start, sample_rate, f_shift, f_offset, f_order, window, sideband, left, right, quality, scaling, scaling_method, scale_scaling, offset_scaling, default_scale, scale_lowpass, scale_highpass, offset_lowpass, offset_highpass, scale_filterorder, offset_filterorder, hdr_output, nInput, nOutput, begsample, endsample, left_f, right_f, mixing, sonifier
+    global dat_input, dat_output, highpassfilter, lowpassfilter, filterorder, change, b, a, zi, duration, desired
 
     # determine when we start polling for available data
     start = time.time()
@@ -263,35 +334,9 @@ def _loop_once():
 
     # get the input data
     dat_input = ft_input.getData([begsample, endsample]).astype(np.double)
-    dat_output = np.zeros((nOutput,hdr_output.nChannels))
-
-    # construct a time vector for input and output
-    begtime = float(begsample  ) / hdr_input.fSample
-    endtime = float(endsample+1) / hdr_input.fSample
-    tim_input = np.linspace(begtime, endtime, nInput, endpoint=False)
-    tim_output = np.linspace(begtime, endtime, nOutput, endpoint=False)
-
-    for chan, i in zip(left, list(range(len(left)))):
-        # interpolate each channel onto the output sampling rate
-        vec_output = np.interp(tim_output, tim_input, dat_input[:, chan-1])
-        # multiply with the modulating signal
-        vec_output *= np.cos(tim_output * left_f[i] * 2 * np.pi)
-        if highpass != None or lowpass != None:
-            # apply the filter to remove one sideband
-            vec_output, left_zi[i] = EEGsynth.online_filter(left_b[i], left_a[i], vec_output, zi=left_zi[i])
-        # add it to the left-channel output
-        dat_output[:,0] += vec_output
-
-    for chan, i in zip(right, list(range(len(right)))):
-        # interpolate each channel onto the output sampling rate
-        vec_output = np.interp(tim_output, tim_input, dat_input[:, chan-1])
-        # multiply with the modulating signal
-        vec_output *= np.cos(tim_output * right_f[i] * 2 * np.pi)
-        if highpass != None or lowpass != None:
-            # apply the filter to remove one sideband
-            vec_output, right_zi[i] = EEGsynth.online_filter(right_b[i], right_a[i], vec_output, zi=right_zi[i])
-        # add it to the right-channel output
-        dat_output[:,1] += vec_output
+
+    # modulate each channel and mix them into the audio channels
+    dat_output = sonifier.process(dat_input)
 
     # Online filtering
     highpassfilter = patch.getfloat('processing', 'highpassfilter', default=None)
@@ -312,7 +357,7 @@ def _loop_once():
         # update the filter parameters
         filterorder = int(filterorder)                     # ensure it is an integer
         filterorder = filterorder + (filterorder%2 ==0)    # ensure it is odd
-        b, a, zi = EEGsynth.initialize_online_filter(hdr_input.fSample, highpassfilter, lowpassfilter, filterorder, dat_output, axis=0)
+        b, a, zi = EEGsynth.initialize_online_filter(hdr_output.fSample, highpassfilter, lowpassfilter, filterorder, dat_output, axis=0)
 
     if not(highpassfilter is None) or not(lowpassfilter is None):
         # apply the filter to the data
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# Benchmark for the computation of the band power in the spectral module
+#
+# This software is part of the EEGsynth project, see <https://github.com/eegsynth/eegsynth>.
+#
+# Copyright (C) 2020 EEGsynth project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import numpy as np
+import os
+import sys
+import time
+
+path = os.path.split(os.path.abspath(__file__))[0]
+
+# eegsynth/lib contains shared modules
+sys.path.insert(0, os.path.join(path, '../../lib'))
+import EEGsynth
+
+
+def loop_power(F, frequency, bandlo, bandhi):
+    # this is how the band power used to be computed, it serves as reference
+    power = [0] * F.shape[1] * len(bandlo)
+    i = 0
+    for chan in range(F.shape[1]):
+        for lo,hi in zip(bandlo,bandhi):
+            power[i] = 0
+            count = 0
+            for sample in range(len(frequency)):
+                if frequency[sample]>=lo and frequency[sample]<=hi:
+                    power[i] += abs(F[sample, chan]*F[sample, chan])
+                    count    += 1
+            if count>0:
+                power[i] /= count
+            i+=1
+    return power
+
+
+def matrix_power(F, weights):
+    return np.dot(np.abs(F.T)**2, weights).flatten().tolist()
+
+
+def timeit(fun, repeat):
+    start = time.time()
+    for i in range(repeat):
+        fun()
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fsample", type=float, default=1000., help="sampling frequency in Hz")
+    parser.add_argument("--window", type=float, default=2., help="window length in seconds")
+    parser.add_argument("--channels", type=int, nargs='+', default=[1, 8, 32, 64], help="number of channels")
+    parser.add_argument("--bands", type=int, nargs='+', default=[5, 10, 20], help="number of frequency bands")
+    parser.add_argument("--repeat", type=int, default=20, help="number of repetitions for the vectorized computation")
+    parser.add_argument("--reference", action='store_true', help="also time the original loop, this is slow")
+    args = parser.parse_args()
+
+    window = int(round(args.window * args.fsample))
+    frequency = np.fft.rfftfreq(window, 1.0 / args.fsample)
+
+    print('%8s %6s %12s %12s %12s' % ('channels', 'bands', 'weights (ms)', 'matrix (ms)', 'loop (ms)'))
+    for nchan in args.channels:
+        dat = np.random.randn(window, nchan)
+        F = np.fft.rfft(dat * np.hanning(window)[:, np.newaxis], axis=0)
+        for nband in args.bands:
+            edges = np.linspace(1, args.fsample / 4, nband + 1)
+            bandlo, bandhi = list(edges[:-1]), list(edges[1:])
+
+            weights = EEGsynth.bandpower_weights(frequency, bandlo, bandhi)
+            t_weights = timeit(lambda: EEGsynth.bandpower_weights(frequency, bandlo, bandhi), args.repeat)
+            t_matrix = timeit(lambda: matrix_power(F, weights), args.repeat)
+
+            if args.reference:
+                t_loop = timeit(lambda: loop_power(F, frequency, bandlo, bandhi), 1)
+                if not np.allclose(loop_power(F, frequency, bandlo, bandhi), matrix_power(F, weights)):
+                    raise RuntimeError('the vectorized band power does not match the reference')
+                print('%8d %6d %12.3f %12.3f %12.3f' % (nchan, nband, t_weights * 1000, t_matrix * 1000, t_loop * 1000))
+            else:
+                print('%8d %6d %12.3f %12.3f %12s' % (nchan, nband, t_weights * 1000, t_matrix * 1000, '-'))
@@ -92,7 +92,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, ft_host, ft_port, ft_input, name
-    global timeout, hdr_input, start, channel_items, channame, chanindx, item, prefix, begsample, endsample
+    global timeout, hdr_input, start, channel_items, channame, chanindx, item, prefix, begsample, endsample, bandcache
 
     # this is the timeout for the FieldTrip buffer
     timeout = patch.getfloat('fieldtrip', 'timeout', default=30)
@@ -125,14 +125,33 @@ def _start():
     begsample = -1
     endsample = -1
 
+    # the taper and the band weights are only recomputed when the settings change
+    bandcache = None
+
+
+def _spectrum(dat, taper):
+    '''Compute the power spectrum of one or multiple segments
+    The data is segments x samples x channels, the output is segments x frequencies x channels
+    '''
+    # demean the data to prevent spectral leakage
+    dat = detrend(dat, axis=1, type='constant')
+
+    # taper the data
+    dat = dat * taper[np.newaxis, :, np.newaxis]
+
+    # compute the FFT over the sample direction
+    F = np.fft.rfft(dat, axis=1)
+    return np.abs(F)**2
+
 
 def _loop_once():
     '''Run the main loop once
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, ft_host, ft_port, ft_input
-    global timeout, hdr_input, start, channel_items, channame, chanindx, item, prefix, begsample, endsample
-    global scale_window, offset_window, window, taper, frequency, band_items, bandname, bandlo, bandhi, lohi, dat, power, chan, band, meandat, sample, F, i, lo, hi, count, key
+    global timeout, hdr_input, start, channel_items, channame, chanindx, item, prefix, begsample, endsample, bandcache
+    global scale_window, offset_window, window, segment, hop, nsegment, streaming, taper, frequency, weights, band_items, bandname, bandlo, bandhi, lohi
+    global ringlength, samples, spectra, lastsegment, block, segend, segindx, dat, psd, power, keys
 
     scale_window = patch.getfloat('scale', 'window', default=1.)
     offset_window = patch.getfloat('offset', 'window', default=0.)
@@ -142,8 +161,25 @@ def _loop_once():
     monitor.update('window', window)
 
     window = int(round(window * hdr_input.fSample))  # in samples
-    taper = np.hanning(window)
-    frequency = np.fft.rfftfreq(window, 1.0 / hdr_input.fSample)
+
+    # the spectrum can be estimated by averaging over overlapping segments, i.e. using Welch's method
+    segment = patch.getfloat('processing', 'segment', default=None)
+    if segment is None:
+        segment = window
+    else:
+        segment = min(int(round(segment * hdr_input.fSample)), window)
+    hop = patch.getfloat('processing', 'hop', default=None)
+    if hop is not None:
+        hop = max(int(round(hop * hdr_input.fSample)), 1)
+    elif segment < window:
+        hop = max(segment // 2, 1)
+    else:
+        # update the spectrum at the same rate as the loop
+        hop = max(int(round(patch.getfloat('general', 'delay') * hdr_input.fSample)), 1)
+    nsegment = (window - segment) // hop + 1
+
+    # in streaming mode only the new samples are read and only the new segments are Fourier transformed
+    streaming = patch.getint('processing', 'streaming', default=0)
 
     band_items = config.items('band')
     bandname = []
@@ -156,63 +192,105 @@ def _loop_once():
         bandlo.append(lohi[0])
         bandhi.append(lohi[1])
 
-    monitor.debug(bandname, bandlo, bandhi)
-
-    hdr_input = ft_input.getHeader()
-    if (hdr_input.nSamples - 1) < endsample:
-        raise RuntimeError("buffer reset detected")
-    if hdr_input.nSamples < window:
-        # there are not yet enough samples in the buffer
-        monitor.info("Waiting for data...")
-        return
-
-    # get the most recent data segment
-    begsample = hdr_input.nSamples - window
-    endsample = hdr_input.nSamples - 1
-    dat = ft_input.getData([begsample, endsample]).astype(np.double)
-    dat = dat[:, chanindx]
-
-    # demean the data to prevent spectral leakage
-    dat = detrend(dat, axis=0, type='constant')
+    if bandcache != (window, segment, hop, streaming, hdr_input.fSample, bandname, bandlo, bandhi):
+        # the settings have changed, recompute the taper and the weights for each frequency band
+        taper = np.hanning(segment)
+        frequency = np.fft.rfftfreq(segment, 1.0 / hdr_input.fSample)
+        weights = EEGsynth.bandpower_weights(frequency, bandlo, bandhi)
+        bandcache = (window, segment, hop, streaming, hdr_input.fSample, bandname, bandlo, bandhi)
+        # this keeps the most recent samples and the power spectra of the most recent segments
+        ringlength = window + hop - 1
+        samples = EEGsynth.ringbuffer(ringlength, len(chanindx))
+        spectra = EEGsynth.ringbuffer(nsegment, len(frequency) * len(chanindx))
+        lastsegment = None
 
-    # taper the data
-    dat = dat * taper[:, np.newaxis]
+    monitor.debug(bandname, bandlo, bandhi)
 
-    # compute the FFT over the sample direction
-    F = np.fft.rfft(dat, axis=0)
-
-    power = [0] * len(channame) * len(bandname)
-    i = 0
-    for chan in range(F.shape[1]):
-        for lo,hi in zip(bandlo,bandhi):
-            power[i] = 0
-            count = 0
-            for sample in range(len(frequency)):
-                if frequency[sample]>=lo and frequency[sample]<=hi:
-                    power[i] += abs(F[sample, chan]*F[sample, chan])
-                    count    += 1
-            if count>0:
-                power[i] /= count
-            i+=1
+    if streaming and lastsegment is not None:
+        # wait for the samples that complete the next segment and read them in a single round trip
+        # this raises a RuntimeError upon a buffer reset
+        block = ft_input.readNext(lastsegment + hop - endsample, timeout, begsample=endsample + 1)
+        if block is None:
+            raise RuntimeError("timeout while waiting for data")
+        (dat, begsample, endsample) = block
+        samples.append(dat[:, chanindx])
+        if ft_input.availableSamples - 1 > endsample:
+            # catch up with the samples that arrived in the mean time, only the most recent ones fit in the ring buffer
+            begsample = max(endsample + 1, ft_input.availableSamples - ringlength)
+            if begsample > endsample + 1:
+                monitor.info("Skipping %d samples to catch up" % (begsample - endsample - 1))
+            endsample = ft_input.availableSamples - 1
+            dat = ft_input.getData([begsample, endsample])
+            samples.append(dat[:, chanindx])
+
+    else:
+        hdr_input = ft_input.getHeader()
+        if (hdr_input.nSamples - 1) < endsample:
+            raise RuntimeError("buffer reset detected")
+        if hdr_input.nSamples < window:
+            # there are not yet enough samples in the buffer
+            monitor.info("Waiting for data...")
+            return
+
+    if streaming:
+        if lastsegment is None:
+            # fill the ring buffer with the most recent samples
+            begsample = max(hdr_input.nSamples - ringlength, 0)
+            endsample = hdr_input.nSamples - 1
+            dat = ft_input.getData([begsample, endsample]).astype(np.double)
+            samples.append(dat[:, chanindx])
+
+        # determine the last sample of each new segment, there is no need to compute more than fit in the average
+        if lastsegment is None:
+            segend = endsample - hop * np.arange(nsegment - 1, -1, -1)
+        else:
+            segend = lastsegment + hop * np.arange(1, (endsample - lastsegment) // hop + 1)
+            segend = segend[-nsegment:]
+        if len(segend) == 0:
+            # not enough new samples for the next segment
+            return
+        lastsegment = segend[-1]
+
+        # the last sample in the ring buffer corresponds to endsample
+        dat = samples.get()
+        segindx = (segend - endsample + dat.shape[0] - 1)[:, np.newaxis] + np.arange(1 - segment, 1)[np.newaxis, :]
+        psd = _spectrum(dat[segindx], taper)
+        spectra.append(psd.reshape(psd.shape[0], -1))
+        psd = np.mean(spectra.get(), axis=0).reshape(len(frequency), len(chanindx))
+
+    else:
+        # get the most recent data segment
+        begsample = hdr_input.nSamples - window
+        endsample = hdr_input.nSamples - 1
+        dat = ft_input.getData([begsample, endsample]).astype(np.double)
+        dat = dat[:, chanindx]
+
+        # the segments are aligned to the most recent sample
+        segend = window - 1 - hop * np.arange(nsegment - 1, -1, -1)
+        segindx = segend[:, np.newaxis] + np.arange(1 - segment, 1)[np.newaxis, :]
+        psd = np.mean(_spectrum(dat[segindx], taper), axis=0)
+
+    # average the power over the frequency bins in each band, this results in a channels x bands matrix
+    power = np.dot(psd.T, weights)
+    power = power.flatten().tolist()
 
     monitor.debug(power)
 
-    i = 0
-    for chan in channame:
-        for band in bandname:
-            key = "%s.%s.%s" % (prefix, chan, band)
-            patch.setvalue(key, power[i])
-            i+=1
+    # write all values to Redis at once
+    keys = ["%s.%s.%s" % (prefix, chan, band) for chan in channame for band in bandname]
+    patch.setvalues(dict(zip(keys, power)))
 
 
 def _loop_forever():
     '''Run the main loop forever
     '''
-    global monitor, patch
+    global monitor, patch, streaming
     while True:
         monitor.loop()
         _loop_once()
-        time.sleep(patch.getfloat('general', 'delay'))
+        if not streaming:
+            # in streaming mode the loop waits for the data to arrive
+            time.sleep(patch.getfloat('general', 'delay'))
 
 
 def _stop():
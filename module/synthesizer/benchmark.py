@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Benchmark for the block renderer of the synthesizer module
+#
+# This software is part of the EEGsynth project, see <https://github.com/eegsynth/eegsynth>.
+#
+# Copyright (C) 2020 EEGsynth project
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import math
+import numpy as np
+import time
+
+from synthesizer import BlockRenderer
+
+
+def loop_render(t, blocksize, rate, last, vco_pitch, vco_sin, vco_tri, vco_saw, vco_sqr, lfo_depth, lfo_frequency, adsr_attack, adsr_decay, adsr_sustain, adsr_release, vca_envelope):
+    # this is how the samples used to be computed, it serves as reference
+    BUFFER = []
+    for t in range(t, t + blocksize):
+        if vco_pitch > 0:
+            frequency = math.pow(2, (vco_pitch / 12 - 4)) * 261.63
+            period = rate / frequency
+            wave_sin = vco_sin * (math.sin(math.pi * frequency * t / rate) + 1) / 2
+            wave_tri = vco_tri * float(abs(t % period - period / 2)) / period * 2
+            wave_saw = vco_saw * float(t % period) / period
+            wave_sqr = vco_sqr * float((t % period) > period / 2)
+            waveform = (wave_sin + wave_tri + wave_saw + wave_sqr)
+        else:
+            waveform = 0
+        lfo_envelope = (math.sin(math.pi * lfo_frequency * t / rate) + 1) / 2
+        lfo_envelope = lfo_depth + (1 - lfo_depth) * lfo_envelope
+        waveform = lfo_envelope * waveform
+        if adsr_attack > 0 and (t - last) < adsr_attack:
+            adsr_envelope = (t - last) / adsr_attack
+        elif adsr_decay > 0 and (t - last - adsr_attack) < adsr_decay:
+            adsr_envelope = 1.0 - 0.5 * (t - last - adsr_attack) / adsr_decay
+        elif adsr_sustain > 0 and (t - last - adsr_attack - adsr_decay) < adsr_sustain:
+            adsr_envelope = 0.5
+        elif adsr_release > 0 and (t - last - adsr_attack - adsr_decay - adsr_sustain) < adsr_release:
+            adsr_envelope = 0.5 - 0.5 * (t - last - adsr_attack - adsr_decay - adsr_sustain) / adsr_release
+        else:
+            adsr_envelope = 0
+        waveform = adsr_envelope * waveform
+        waveform = vca_envelope * waveform
+        BUFFER.append(waveform)
+    return BUFFER
+
+
+def timeit(fun, repeat):
+    start = time.time()
+    for i in range(repeat):
+        fun()
+    return (time.time() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=int, default=48000, help="sampling rate in Hz")
+    parser.add_argument("--blocksize", type=int, nargs='+', default=[64, 128, 256, 480, 1024, 4096], help="number of samples per block")
+    parser.add_argument("--duration", type=float, default=2., help="duration of the rendered audio in seconds")
+    parser.add_argument("--reference", action='store_true', help="also time the original loop over samples, this is slow")
+    args = parser.parse_args()
+
+    # the ADSR durations are expressed in samples
+    controls = dict(last=0, vco_pitch=60, vco_sin=0.4, vco_tri=0.2, vco_saw=0.2, vco_sqr=0.2, lfo_depth=0.5, lfo_frequency=2,
+                    adsr_attack=0.25 * args.rate, adsr_decay=0.25 * args.rate, adsr_sustain=0.5 * args.rate, adsr_release=0.25 * args.rate, vca_envelope=0.5)
+
+    print('%10s %12s %14s %14s' % ('blocksize', 'block (ms)', 'realtime', 'loop realtime'))
+    for blocksize in args.blocksize:
+        nblocks = max(int(args.duration * args.rate / blocksize), 1)
+
+        def render():
+            renderer = BlockRenderer(args.rate)
+            for block in range(nblocks):
+                renderer.render(block * blocksize, blocksize, **controls)
+
+        # the real-time factor is the duration of the audio divided by the time it takes to compute it
+        t_block = timeit(render, 1) / nblocks
+        realtime = (float(blocksize) / args.rate) / t_block
+
+        if args.reference:
+            renderer = BlockRenderer(args.rate)
+            for block in range(min(nblocks, 8)):
+                if not np.allclose(renderer.render(block * blocksize, blocksize, **controls), loop_render(block * blocksize, blocksize, args.rate, **controls)):
+                    raise RuntimeError('the block renderer does not match the reference')
+            t_loop = timeit(lambda: loop_render(0, blocksize, args.rate, **controls), 1)
+            print('%10d %12.3f %14.1f %14.1f' % (blocksize, t_block * 1000, realtime, (float(blocksize) / args.rate) / t_loop))
+        else:
+            print('%10d %12.3f %14.1f %14s' % (blocksize, t_block * 1000, realtime, '-'))
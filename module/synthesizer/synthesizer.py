@@ -23,6 +23,7 @@ import configparser
 import argparse
 import math
 import multiprocessing
+import numpy as np
 import os
 import pyaudio
 import redis
@@ -52,28 +53,73 @@ sys.path.insert(0, os.path.join(path, '../../lib'))
 import EEGsynth
 
 
-class TriggerThread(threading.Thread):
+class BlockRenderer():
+    """Renders the output of the VCO, LFO, ADSR and VCA for a block of samples at once.
+    The phase of the oscillators is kept from one block to the next, so that the output
+    remains continuous when the pitch or the LFO frequency changes.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.vco_phase = 0.
+        self.lfo_phase = 0.
+
+    def render(self, t, blocksize, last, vco_pitch, vco_sin, vco_tri, vco_saw, vco_sqr, lfo_depth, lfo_frequency, adsr_attack, adsr_decay, adsr_sustain, adsr_release, vca_envelope):
+        # t is the number of the first sample, the output is between 0 and 1
+        n = np.arange(blocksize, dtype=np.double)
+
+        # compose the VCO waveform, the phase is expressed in cycles
+        if vco_pitch > 0:
+            # note 60 on the keyboard is the C4, which is 261.63 Hz
+            # note 72 on the keyboard is the C5, which is 523.25 Hz
+            frequency = math.pow(2, (vco_pitch / 12 - 4)) * 261.63
+            phase = self.vco_phase + n * frequency / self.rate
+            cycle = phase % 1
+            waveform = vco_sin * (np.sin(np.pi * phase) + 1) / 2
+            waveform += vco_tri * np.abs(cycle - 0.5) * 2
+            waveform += vco_saw * cycle
+            waveform += vco_sqr * (cycle > 0.5)
+            # the sine completes its period in two cycles
+            self.vco_phase = (self.vco_phase + blocksize * frequency / self.rate) % 2
+        else:
+            waveform = np.zeros(blocksize)
+
+        # compose and apply the LFO
+        phase = self.lfo_phase + n * lfo_frequency / self.rate
+        lfo_envelope = (np.sin(np.pi * phase) + 1) / 2
+        lfo_envelope = lfo_depth + (1 - lfo_depth) * lfo_envelope
+        waveform *= lfo_envelope
+        self.lfo_phase = (self.lfo_phase + blocksize * lfo_frequency / self.rate) % 2
+
+        # compose and apply the ADSR
+        elapsed = t + n - last
+        adsr_envelope = np.select([
+            (adsr_attack > 0) & (elapsed < adsr_attack),
+            (adsr_decay > 0) & ((elapsed - adsr_attack) < adsr_decay),
+            (adsr_sustain > 0) & ((elapsed - adsr_attack - adsr_decay) < adsr_sustain),
+            (adsr_release > 0) & ((elapsed - adsr_attack - adsr_decay - adsr_sustain) < adsr_release),
+        ], [
+            elapsed / max(adsr_attack, 1),
+            1.0 - 0.5 * (elapsed - adsr_attack) / max(adsr_decay, 1),
+            0.5,
+            0.5 - 0.5 * (elapsed - adsr_attack - adsr_decay - adsr_sustain) / max(adsr_release, 1),
+        ], default=0)
+        waveform *= adsr_envelope
+
+        # apply the VCA
+        waveform *= vca_envelope
+        return waveform
+
+
+class TriggerHandler():
     def __init__(self):
-        threading.Thread.__init__(self)
-        self.running = True
         with lock:
             self.time = 0
             self.last = 0
 
-    def stop(self):
-        self.running = False
-
-    def run(self):
-        pubsub = r.pubsub()
-        pubsub.subscribe('SYNTHESIZER_UNBLOCK')  # this message unblocks the redis listen command
-        pubsub.subscribe(patch.getstring('control', 'adsr_gate'))
-        while self.running:
-            for item in pubsub.listen():
-                if not self.running or not item['type'] == 'message':
-                    break
-                monitor.trace(item)
-                with lock:
-                    self.last = self.time
+    def process(self, item):
+        monitor.trace(item)
+        with lock:
+            self.last = self.time
 
 
 class ControlThread(threading.Thread):
@@ -217,7 +263,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, debug, p, device, rate, blocksize, nchans, format, info, stream, lock, control, trigger, devinfo, block, offset, autoscale
+    global monitor, debug, p, device, rate, blocksize, nchans, format, sampletype, info, stream, lock, control, trigger, dispatcher, renderer, devinfo, block, offset, autoscale
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
@@ -231,7 +277,15 @@ def _start():
     rate = patch.getint('audio', 'rate')
     blocksize = patch.getint('audio', 'blocksize')
     nchans = 1
-    format = p.get_format_from_width(2)  # the desired sample width in bytes (1, 2, 3, or 4)
+
+    # the samples can be written as 16-bit integers or as 32-bit floating point values
+    sampletype = patch.getstring('audio', 'format', default='int16')
+    if sampletype == 'int16':
+        format = pyaudio.paInt16
+    elif sampletype == 'float32':
+        format = pyaudio.paFloat32
+    else:
+        raise RuntimeError("unsupported sample format: " + sampletype)
 
     monitor.info('------------------------------------------------------------------')
     info = p.get_host_api_info_by_index(0)
@@ -262,9 +316,14 @@ def _start():
     control = ControlThread()
     control.start()
 
-    # start the background thread that deals with triggers
-    trigger = TriggerThread()
-    trigger.start()
+    # the gate triggers the envelope, the messages are handled in a background thread
+    trigger = TriggerHandler()
+    dispatcher = EEGsynth.dispatcher(r, workers=1)
+    dispatcher.subscribe(patch.getstring('control', 'adsr_gate'), trigger.process)
+    dispatcher.start()
+
+    # the output is computed in blocks
+    renderer = BlockRenderer(rate)
 
     block = 0
     offset = 0
@@ -279,70 +338,37 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, debug, p, device, rate, blocksize, nchans, format, info, stream, lock, control, trigger, devinfo, block, offset, autoscale
-    global BUFFER, t, last, vco_pitch, vco_sin, vco_tri, vco_saw, vco_sqr, lfo_depth, lfo_frequency, adsr_attack, adsr_decay, adsr_sustain, adsr_release, vca_envelope, frequency, period, wave_sin, wave_tri, wave_saw, wave_sqr, waveform, lfo_envelope, adsr_envelope
+    global monitor, debug, p, device, rate, blocksize, nchans, format, sampletype, info, stream, lock, control, trigger, dispatcher, renderer, devinfo, block, offset, autoscale
+    global BUFFER, last, vco_pitch, vco_sin, vco_tri, vco_saw, vco_sqr, lfo_depth, lfo_frequency, adsr_attack, adsr_decay, adsr_sustain, adsr_release, vca_envelope, waveform
 
     ################################################################################
     # this is constantly generating the output signal
     ################################################################################
-    BUFFER = ''
-
-    for t in range(offset, offset + blocksize):
-        # update the time for the trigger detection
-
-        with lock:
-            trigger.time = t
-            last = trigger.last
-            vco_pitch = control.vco_pitch
-            vco_sin = control.vco_sin
-            vco_tri = control.vco_tri
-            vco_saw = control.vco_saw
-            vco_sqr = control.vco_sqr
-            lfo_depth = control.lfo_depth
-            lfo_frequency = control.lfo_frequency
-            adsr_attack = control.adsr_attack
-            adsr_decay = control.adsr_decay
-            adsr_sustain = control.adsr_sustain
-            adsr_release = control.adsr_release
-            vca_envelope = control.vca_envelope
-
-        # compose the VCO waveform
-        if vco_pitch > 0:
-            # note 60 on the keyboard is the C4, which is 261.63 Hz
-            # note 72 on the keyboard is the C5, which is 523.25 Hz
-            frequency = math.pow(2, (vco_pitch / 12 - 4)) * 261.63
-            period = rate / frequency
-            wave_sin = vco_sin * (math.sin(math.pi * frequency * t / rate) + 1) / 2
-            wave_tri = vco_tri * float(abs(t % period - period / 2)) / period * 2
-            wave_saw = vco_saw * float(t % period) / period
-            wave_sqr = vco_sqr * float((t % period) > period / 2)
-            waveform = (wave_sin + wave_tri + wave_saw + wave_sqr) * 127
-        else:
-            waveform = 0
-
-        # compose and apply the LFO
-        lfo_envelope = (math.sin(math.pi * lfo_frequency * t / rate) + 1) / 2
-        lfo_envelope = lfo_depth + (1 - lfo_depth) * lfo_envelope
-        waveform = lfo_envelope * waveform
-
-        # compose and apply the ADSR
-        if adsr_attack > 0 and (t - last) < adsr_attack:
-            adsr_envelope = (t - last) / adsr_attack
-        elif adsr_decay > 0 and (t - last - adsr_attack) < adsr_decay:
-            adsr_envelope = 1.0 - 0.5 * (t - last - adsr_attack) / adsr_decay
-        elif adsr_sustain > 0 and (t - last - adsr_attack - adsr_decay) < adsr_sustain:
-            adsr_envelope = 0.5
-        elif adsr_release > 0 and (t - last - adsr_attack - adsr_decay - adsr_sustain) < adsr_release:
-            adsr_envelope = 0.5 - 0.5 * (t - last - adsr_attack - adsr_decay - adsr_sustain) / adsr_release
-        else:
-            adsr_envelope = 0
-        waveform = adsr_envelope * waveform
-
-        # apply the VCA
-        waveform = vca_envelope * waveform
 
-        # add the current waveform sample to the buffer
-        BUFFER = BUFFER + chr(int(waveform))
+    # take a snapshot of the control values and update the time for the trigger detection
+    with lock:
+        trigger.time = offset
+        last = trigger.last
+        vco_pitch = control.vco_pitch
+        vco_sin = control.vco_sin
+        vco_tri = control.vco_tri
+        vco_saw = control.vco_saw
+        vco_sqr = control.vco_sqr
+        lfo_depth = control.lfo_depth
+        lfo_frequency = control.lfo_frequency
+        adsr_attack = control.adsr_attack
+        adsr_decay = control.adsr_decay
+        adsr_sustain = control.adsr_sustain
+        adsr_release = control.adsr_release
+        vca_envelope = control.vca_envelope
+
+    # compute the waveform for the whole block, it is between 0 and 1
+    waveform = renderer.render(offset, blocksize, last, vco_pitch, vco_sin, vco_tri, vco_saw, vco_sqr, lfo_depth, lfo_frequency, adsr_attack, adsr_decay, adsr_sustain, adsr_release, vca_envelope)
+
+    if sampletype == 'int16':
+        BUFFER = (waveform * 32767).astype(np.int16).tobytes()
+    else:
+        BUFFER = waveform.astype(np.float32).tobytes()
 
     # write the buffer content to the audio device
     stream.write(BUFFER)
@@ -365,13 +391,11 @@ def _loop_forever():
 def _stop(*args):
     '''Stop and clean up on SystemExit, KeyboardInterrupt
     '''
-    global monitor, control, trigger, r, stream, p
+    global monitor, control, trigger, dispatcher, r, stream, p
     monitor.success('Closing threads')
     control.stop()
-    trigger.stop()
-    r.publish('SYNTHESIZER_UNBLOCK', 1)
+    dispatcher.stop()
     control.join()
-    trigger.join()
     stream.stop_stream()
     stream.close()
     p.terminate()
@@ -98,7 +98,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input, name
-    global timeout, hdr_input, start, rectify, invert, prefix, window, scale_threshold, offset_threshold, scale_interval, offset_interval, channels, previous, begsample, endsample
+    global timeout, hdr_input, start, rectify, invert, prefix, window, scale_threshold, offset_threshold, scale_interval, offset_interval, channels, keys, reducer, begsample, endsample
 
     # this is the timeout for the FieldTrip buffer
     timeout = patch.getfloat('fieldtrip', 'timeout', default=30)
@@ -131,7 +131,11 @@ def _start():
     channels = patch.getint('input', 'channels', multiple=True)
     channels = [chan - 1 for chan in channels] # since python using indexing from 0 instead of 1
 
-    previous = [-np.Inf] * len(channels)
+    # the keys are constructed once, the triggers are sent as prefix.channelX=val
+    keys = ["%s.channel%d" % (prefix, channel+1) for channel in channels]
+
+    # this detects the threshold crossings in all channels at once
+    reducer = EEGsynth.channelreducer(window, len(channels))
 
     # jump to the end of the input stream
     if hdr_input.nSamples<window:
@@ -151,8 +155,8 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, monitor, debug, ft_host, ft_port, ft_input
-    global timeout, hdr_input, start, rectify, invert, prefix, window, scale_threshold, offset_threshold, scale_interval, offset_interval, channels, previous, begsample, endsample
-    global dat_input, threshold, interval, channel, maxind, maxval, sample, key
+    global timeout, hdr_input, start, rectify, invert, prefix, window, scale_threshold, offset_threshold, scale_interval, offset_interval, channels, keys, reducer, begsample, endsample
+    global dat_input, threshold, interval, hits, values
 
     # determine when we start polling for available data
     start = time.time()
@@ -168,6 +172,7 @@ def _loop_once():
 
     # get the input data
     dat_input = ft_input.getData([begsample, endsample]).astype(np.double)
+    dat_input = dat_input[:, channels]
 
     monitor.debug("read from sample %d to %d" % (begsample, endsample))
 
@@ -184,14 +189,12 @@ def _loop_once():
     interval  = patch.getfloat('processing', 'interval', default=0)
     interval  = EEGsynth.rescale(interval, slope=scale_interval, offset=offset_interval)
 
-    for channel in channels:
-        maxind = np.argmax(dat_input[:,channel])
-        maxval = dat_input[maxind,channel]
-        sample = maxind+begsample
-        if maxval>=threshold and (sample-previous[channel])>=(interval*hdr_input.fSample):
-            key = "%s.channel%d" % (patch.getstring('output','prefix'), channel+1)
-            patch.setvalue(key, float(maxval))
-            previous[channel] = sample
+    # detect the channels in which the maximum of this block exceeds the threshold
+    reducer.append(dat_input)
+    hits, values = reducer.crossings(threshold, interval*hdr_input.fSample)
+
+    # send all triggers at once
+    patch.setvalues(dict([(keys[hit], float(value)) for hit, value in zip(hits, values)]))
 
     # increment the counters for the next loop
     begsample += window
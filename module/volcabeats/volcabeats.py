@@ -51,34 +51,16 @@ sys.path.insert(0, os.path.join(path, '../../lib'))
 import EEGsynth
 
 
-class TriggerThread(threading.Thread):
-    def __init__(self, redischannel, note):
-        threading.Thread.__init__(self)
-        self.redischannel = redischannel
-        self.note = note
-        self.running = True
-
-    def stop(self):
-        self.running = False
-
-    def run(self):
-        pubsub = r.pubsub()
-        pubsub.subscribe('VOLCABEATS_UNBLOCK') # this message unblocks the redis listen command
-        pubsub.subscribe(self.redischannel)    # this message contains the note
-        while self.running:
-            for item in pubsub.listen():
-                if not self.running or not item['type'] == 'message':
-                    break
-                if item['channel'] == self.redischannel:
-                    monitor.trace(item)
-                    # map the Redis values to MIDI values
-                    val = EEGsynth.rescale(float(item['data']), slope=scale, offset=offset)
-                    val = EEGsynth.limit(val, 0, 127)
-                    val = int(val)
-                    monitor.update(item['channel'], val)
-                    msg = mido.Message('note_on', note=self.note, velocity=val, channel=midichannel)
-                    with lock:
-                        outputport.send(msg)
+def HandleTrigger(item, note):
+    monitor.trace(item)
+    # map the Redis values to MIDI values
+    val = EEGsynth.rescale(float(item['data']), slope=scale, offset=offset)
+    val = EEGsynth.limit(val, 0, 127)
+    val = int(val)
+    monitor.update(item['channel'], val)
+    msg = mido.Message('note_on', note=note, velocity=val, channel=midichannel)
+    with lock:
+        outputport.send(msg)
 
 
 def _setup():
@@ -113,7 +95,7 @@ def _start():
     This uses the global variables from setup and adds a set of global variables
     '''
     global parser, args, config, r, response, patch, name
-    global monitor, control_name, control_code, note_name, note_code, debug, port, midichannel, mididevice, outputport, scale, offset, lock, trigger, code, this, thread, previous_val
+    global monitor, control_name, control_code, note_name, note_code, debug, port, midichannel, mididevice, outputport, scale, offset, lock, trigger, code, previous_val
 
     # this can be used to show parameters that have changed
     monitor = EEGsynth.monitor(name=name, debug=patch.getint('general', 'debug'))
@@ -154,17 +136,14 @@ def _start():
     lock = threading.Lock()
 
     # each of the notes that can be played is mapped onto a different trigger
-    trigger = []
+    trigger = EEGsynth.dispatcher(r)
     for name, code in zip(note_name, note_code):
         if config.has_option('note', name):
-            # start the background thread that deals with this note
-            this = TriggerThread(patch.getstring('note', name), code)
-            trigger.append(this)
+            trigger.subscribe(patch.getstring('note', name), HandleTrigger, args=(code,))
             monitor.debug(name + ' trigger configured')
 
-    # start the thread for each of the notes
-    for thread in trigger:
-        thread.start()
+    # start receiving the messages for all notes
+    trigger.start()
 
     # control values are only relevant when different from the previous value
     previous_val = {}
@@ -181,7 +160,7 @@ def _loop_once():
     This uses the global variables from setup and start, and adds a set of global variables
     '''
     global parser, args, config, r, response, patch
-    global monitor, control_name, control_code, note_name, note_code, debug, port, midichannel, mididevice, outputport, scale, offset, lock, trigger, code, this, thread, previous_val
+    global monitor, control_name, control_code, note_name, note_code, debug, port, midichannel, mididevice, outputport, scale, offset, lock, trigger, code, previous_val
     global cmd, val, msg
 
     for name, cmd in zip(control_name, control_code):
@@ -221,11 +200,7 @@ def _stop(*args):
     '''
     global monitor, trigger, r
     monitor.success('Closing threads')
-    for thread in trigger:
-        thread.stop()
-    r.publish('VOLCABEATS_UNBLOCK', 1)
-    for thread in trigger:
-        thread.join()
+    trigger.stop()
     sys.exit()
 
 